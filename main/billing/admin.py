@@ -1,4 +1,6 @@
 from django.contrib import admin
+from django_wireguard.export import configs_zip_response
+from django_wireguard.models import WireguardPeer
 from .models import User, UserPeer, Tariff, Payment, PaymentGateway
 
 class UserPeerInline(admin.TabularInline):
@@ -9,11 +11,23 @@ class UserPeerInline(admin.TabularInline):
 class UserAdmin(admin.ModelAdmin):
     list_display = ('payment_name', 'tariff', 'activity_until', 'balance', 'status', 'admin')
     inlines = (UserPeerInline,)
+    actions = ('export_configs',)
+
+    @admin.action(description="Export peer configs as ZIP")
+    def export_configs(self, request, queryset):
+        return configs_zip_response(WireguardPeer.objects.filter(userpeer__user__in=queryset),
+                                    filename='-'.join(queryset.values_list('payment_name', flat=True)[:3]))
 
 
 @admin.register(Tariff)
 class TariffAdmin(admin.ModelAdmin):
     list_display = ('name', 'cost', 'cost_of_per_excess_peer', 'amount_peers')
+    actions = ('export_configs',)
+
+    @admin.action(description="Export peer configs as ZIP")
+    def export_configs(self, request, queryset):
+        return configs_zip_response(WireguardPeer.objects.filter(userpeer__user__tariff__in=queryset),
+                                    filename='-'.join(queryset.values_list('name', flat=True)[:3]))
 
 
 @admin.register(Payment)
@@ -23,6 +37,7 @@ class PaymentAdmin(admin.ModelAdmin):
 
 @admin.register(PaymentGateway)
 class PaymentGatewayAdmin(admin.ModelAdmin):
-    list_display = ('name', )
+    list_display = ('name', 'cursor', 'polled_at')
+    readonly_fields = ('polled_at',)
 
 
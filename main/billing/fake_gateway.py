@@ -0,0 +1,138 @@
+"""
+Local stand-in for the YooMoney API, to test payment ingestion offline.
+
+The server answers ``POST /api/operation-history`` like YooMoney does: successful
+depositions newest first, filtered by ``from``, paginated by ``records`` and
+``start_record``, and ``POST /api/operation-details`` for one operation.
+:func:`make_notification` signs the HTTP notification of an operation. The server can
+add latency and fail a share of the requests with 503 to exercise the timeouts and
+retries of :mod:`billing.gateways`. Point ``PAYMENTS_YOOMONEY_URL`` and
+``PAYMENTS_YOOMONEY_DETAILS_URL`` at it, e.g. ``http://127.0.0.1:8765/api/operation-history``.
+"""
+import hashlib
+import json
+import random
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import sleep
+from typing import List
+from urllib.parse import parse_qs
+
+
+__all__ = ('make_operations', 'make_notification', 'FakeGatewayServer')
+
+
+def make_operations(count: int, titles: List[str], start: datetime = None) -> List[dict]:
+    """
+    Generate successful depositions, one second apart, newest first.
+
+    :param count: number of operations
+    :param titles: payer names, used in turn
+    :param start: time of the oldest operation, an hour ago by default
+    :return: operations in the YooMoney format
+    """
+    start = start or datetime.now(timezone.utc).replace(microsecond=0) - timedelta(hours=1)
+    operations = []
+    for number in range(count):
+        operations.append({
+            'operation_id': f'fake-{start:%Y%m%d%H%M%S}-{number}',
+            'status': 'success',
+            'direction': 'in',
+            'title': titles[number % len(titles)] if titles else f'payer {number}',
+            'amount': float(random.choice((100, 150, 300))),
+            'amount_currency': '643',
+            'datetime': (start + timedelta(seconds=number)).strftime('%Y-%m-%dT%H:%M:%SZ'),
+        })
+    operations.reverse()
+    return operations
+
+
+def make_notification(operation: dict, secret: str, label: str = '') -> dict:
+    """
+    Signed YooMoney HTTP notification of an operation.
+
+    :param operation: operation, see :func:`make_operations`
+    :param secret: notification secret of the gateway
+    :param label: payment label
+    :return: notification fields
+    """
+    data = {
+        'notification_type': 'p2p-incoming',
+        'operation_id': operation['operation_id'],
+        'amount': f"{operation['amount']:.2f}",
+        'currency': operation['amount_currency'],
+        'datetime': operation['datetime'],
+        'sender': '41001000040',
+        'codepro': 'false',
+        'label': label,
+    }
+    fields = ('notification_type', 'operation_id', 'amount', 'currency', 'datetime', 'sender', 'codepro')
+    signed = '&'.join([data[field] for field in fields] + [secret, label])
+    data['sha1_hash'] = hashlib.sha1(signed.encode('utf-8')).hexdigest()
+    return data
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server: 'FakeGatewayServer'
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        params = {key: values[0] for key, values in parse_qs(self.rfile.read(length).decode()).items()}
+        if self.server.latency:
+            sleep(self.server.latency)
+        path = self.path.rstrip('/')
+        if path not in ('/api/operation-history', '/api/operation-details'):
+            return self.reply(404, {'error': 'not_found'})
+        if random.random() < self.server.fail_rate:
+            return self.reply(503, {'error': 'unavailable'})
+        self.server.requests += 1
+        if path == '/api/operation-details':
+            for operation in self.server.operations:
+                if operation['operation_id'] == params.get('operation_id'):
+                    return self.reply(200, operation)
+            return self.reply(200, {'error': 'illegal_param_operation_id'})
+
+        operations = self.server.operations
+        if params.get('from'):
+            operations = [operation for operation in operations if operation['datetime'] >= params['from']]
+        start = int(params.get('start_record') or 0)
+        records = min(int(params.get('records') or 30), 100)
+        content = {'operations': operations[start:start + records]}
+        if start + records < len(operations):
+            content['next_record'] = str(start + records)
+        self.reply(200, content)
+
+    def reply(self, status: int, content: dict):
+        body = json.dumps(content).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeGatewayServer(ThreadingHTTPServer):
+    """
+    Threaded HTTP server serving fake operations.
+
+    :param address: ``(host, port)`` to listen on, port 0 picks a free port
+    :param operations: operations newest first, see :func:`make_operations`
+    :param latency: seconds to wait before every answer
+    :param fail_rate: share of the requests answered with 503
+    """
+    daemon_threads = True
+
+    def __init__(self, address, operations: List[dict], latency: float = 0, fail_rate: float = 0):
+        super().__init__(address, _Handler)
+        self.operations = operations
+        self.latency = latency
+        self.fail_rate = fail_rate
+        self.requests = 0
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}/api/operation-history'
@@ -0,0 +1,248 @@
+"""
+Payment gateway providers.
+
+Every :class:`~billing.models.PaymentGateway` is polled by the provider registered for
+its name in :data:`PAYMENT_PROVIDERS`. Providers share one keep-alive HTTP session per
+gateway and process, with a timeout and retries with backoff on connection errors and
+overloaded responses, and follow the pagination of the operation history so busy
+periods are read in full. :func:`fetch_payments` polls all the gateways at once.
+
+Providers also verify and parse the HTTP notifications a gateway pushes on every
+payment, the polling is then only a reconciliation backstop.
+"""
+import hashlib
+import hmac
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal, InvalidOperation
+from typing import Dict, Iterable, List, Optional
+
+from requests import RequestException, Session
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from billing.settings import PAYMENTS_HTTP_BACKOFF, PAYMENTS_HTTP_RETRIES, PAYMENTS_HTTP_TIMEOUT, \
+    PAYMENTS_MAX_PAGES, PAYMENTS_POLL_WORKERS, PAYMENTS_YOOMONEY_DETAILS_URL, PAYMENTS_YOOMONEY_URL
+
+
+__all__ = ('GatewayException', 'NotificationException', 'PaymentProvider', 'YooMoneyProvider', 'QiwiProvider',
+           'PAYMENT_PROVIDERS', 'get_provider', 'get_session', 'fetch_payments')
+
+
+class GatewayException(Exception):
+    """
+    Exception raised when a payment gateway could not be polled.
+    """
+
+
+class NotificationException(Exception):
+    """
+    Exception raised when a payment notification is malformed or its signature is wrong.
+    """
+
+
+class PaymentProvider:
+    """
+    Read the incoming operations of a payment gateway.
+
+    :param gateway: PaymentGateway holding the credentials
+    :param session: HTTP session, the shared session of the gateway by default
+    """
+    name = None
+
+    def __init__(self, gateway, session: Optional[Session] = None):
+        self.gateway = gateway
+        self.session = session or get_session(gateway.name)
+
+    def get_operations(self, from_time: str) -> List[dict]:
+        """
+        Successful incoming operations since a time.
+
+        :param from_time: time in the ``YYYY-MM-DDTHH:MM:SSZ`` format
+        :return: operations with ``operation_id``, ``title``, ``amount``, ``amount_currency`` and ``datetime``
+        """
+        raise NotImplementedError
+
+    def get_operation(self, operation_id: str) -> Optional[dict]:
+        """
+        One successful incoming operation.
+
+        :param operation_id: operation id
+        :return: operation like :meth:`get_operations`, None if it is unknown or did not succeed
+        """
+        raise NotImplementedError
+
+    def parse_notification(self, data) -> Optional[dict]:
+        """
+        Verify a payment notification and read the operation it announces.
+
+        :param data: notification fields
+        :return: operation like :meth:`get_operations` without ``title``, None if nothing was credited
+        """
+        raise NotificationException(f"Gateway {self.name} sends no notifications")
+
+
+class YooMoneyProvider(PaymentProvider):
+    """
+    YooMoney wallet operation history, read 100 records per page, and HTTP notifications
+    signed with the SHA-1 of their fields and the notification secret.
+    """
+    name = 'YO'
+    page_size = 100
+    notification_fields = ('notification_type', 'operation_id', 'amount', 'currency', 'datetime', 'sender',
+                           'codepro')
+
+    def _post(self, url: str, data: dict) -> dict:
+        headers = {
+            'Accept': 'application/x-www-form-urlencoded',
+            'Authorization': f'Bearer {self.gateway.token}',
+            'Content-Type': 'application/x-www-form-urlencoded',
+        }
+        try:
+            resp = self.session.post(url, headers=headers, data=data, timeout=PAYMENTS_HTTP_TIMEOUT)
+        except RequestException as e:
+            raise GatewayException(f"YooMoney is unreachable: {e}")
+        if resp.status_code != 200:
+            raise GatewayException(f"YooMoney answered {resp.status_code}")
+        try:
+            content = json.loads(resp.content)
+        except ValueError:
+            raise GatewayException("YooMoney answered an invalid document")
+        if 'error' in content:
+            raise GatewayException(f"YooMoney error {content['error']}")
+        return content
+
+    @staticmethod
+    def _operation(operation: dict) -> dict:
+        return {
+            'operation_id': operation['operation_id'],
+            'title': operation['title'],
+            'amount': operation['amount'],
+            'amount_currency': operation['amount_currency'],
+            'datetime': operation['datetime'],
+        }
+
+    def get_operations(self, from_time: str) -> List[dict]:
+        operations = []
+        data = {'type': 'deposition', 'from': from_time, 'records': self.page_size}
+        for page in range(PAYMENTS_MAX_PAGES):
+            content = self._post(PAYMENTS_YOOMONEY_URL, data)
+            for operation in content.get('operations', []):
+                if operation.get('status') != 'success':
+                    continue
+                operations.append(self._operation(operation))
+            if not content.get('next_record'):
+                return operations
+            data['start_record'] = content['next_record']
+        raise GatewayException(f"YooMoney history has more than {PAYMENTS_MAX_PAGES} pages since {from_time}")
+
+    def get_operation(self, operation_id: str) -> Optional[dict]:
+        operation = self._post(PAYMENTS_YOOMONEY_DETAILS_URL, {'operation_id': operation_id})
+        if operation.get('status') != 'success' or operation.get('direction', 'in') != 'in':
+            return None
+        return self._operation(operation)
+
+    def parse_notification(self, data) -> Optional[dict]:
+        secret = self.gateway.notification_secret
+        if not secret:
+            raise NotificationException("YooMoney notification secret is not set")
+        try:
+            values = [data[field] for field in self.notification_fields] + [secret, data.get('label', '')]
+            signature = data['sha1_hash']
+        except KeyError as e:
+            raise NotificationException(f"YooMoney notification has no {e.args[0]}")
+        expected = hashlib.sha1('&'.join(values).encode('utf-8')).hexdigest()
+        if not hmac.compare_digest(expected, signature.lower()):
+            raise NotificationException("YooMoney notification signature is wrong")
+
+        # test notifications and protected transfers not accepted yet credit nothing
+        if data.get('test_notification') == 'true' or data.get('unaccepted') == 'true':
+            return None
+        try:
+            amount = Decimal(data['amount'])
+        except InvalidOperation:
+            raise NotificationException(f"YooMoney notification amount {data['amount']} is invalid")
+        return {
+            'operation_id': data['operation_id'],
+            'amount': amount,
+            'amount_currency': data['currency'],
+            'datetime': data['datetime'],
+        }
+
+
+class QiwiProvider(PaymentProvider):
+    """
+    QIWI wallets are not polled yet.
+    """
+    name = 'QI'
+
+    def get_operations(self, from_time: str) -> List[dict]:
+        return []
+
+    def get_operation(self, operation_id: str) -> Optional[dict]:
+        return None
+
+
+PAYMENT_PROVIDERS = {provider.name: provider for provider in (YooMoneyProvider, QiwiProvider)}
+
+_sessions = {}
+_lock = threading.Lock()
+
+
+def get_session(key: str) -> Session:
+    """
+    Keep-alive HTTP session of a gateway, shared by the polls of this process.
+
+    :param key: gateway name
+    :rtype: Session
+    """
+    with _lock:
+        session = _sessions.get(key)
+        if session is None:
+            retry = Retry(total=PAYMENTS_HTTP_RETRIES, backoff_factor=PAYMENTS_HTTP_BACKOFF,
+                          status_forcelist=(429, 500, 502, 503, 504),
+                          # the operation history is only read
+                          allowed_methods=None, respect_retry_after_header=True)
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=4, max_retries=retry)
+            session = Session()
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _sessions[key] = session
+        return session
+
+
+def get_provider(gateway) -> PaymentProvider:
+    """
+    Return the provider of a gateway.
+
+    :param gateway: PaymentGateway
+    :rtype: PaymentProvider
+    """
+    try:
+        return PAYMENT_PROVIDERS[gateway.name](gateway)
+    except KeyError:
+        raise GatewayException(f"Unknown payment gateway {gateway.name}")
+
+
+def fetch_payments(gateways: Iterable, from_times: Dict[int, str]) -> Dict[int, object]:
+    """
+    Poll many gateways concurrently, a slow or failing gateway does not hold the others.
+
+    :param gateways: PaymentGateways
+    :param from_times: time to read the operations from, by gateway primary key
+    :return: list of operations or the raised exception, by gateway primary key
+    """
+    gateways = list(gateways)
+    if not gateways:
+        return {}
+
+    def poll(gateway):
+        try:
+            return get_provider(gateway).get_operations(from_times[gateway.pk])
+        except Exception as e:
+            return e
+
+    with ThreadPoolExecutor(max_workers=min(PAYMENTS_POLL_WORKERS, len(gateways)),
+                            thread_name_prefix='payment-gateway') as executor:
+        return dict(zip((gateway.pk for gateway in gateways), executor.map(poll, gateways)))
@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand
+
+from billing.fake_gateway import FakeGatewayServer, make_operations
+from billing.models import User
+
+
+class Command(BaseCommand):
+    help = 'Serve fake YooMoney operations to test payment ingestion offline'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1',
+                            help='Address to listen on')
+        parser.add_argument('--port', type=int, default=8765,
+                            help='Port to listen on')
+        parser.add_argument('--operations', type=int, default=1000,
+                            help='Number of operations to serve')
+        parser.add_argument('--latency', type=float, default=0,
+                            help='Seconds to wait before every answer')
+        parser.add_argument('--fail-rate', type=float, default=0,
+                            help='Share of the requests answered with 503')
+        parser.add_argument('--unknown-payers', action='store_true',
+                            help='Use generated payer names instead of the users payment names')
+
+    def handle(self, *args, **options):
+        titles = [] if options['unknown_payers'] else list(User.objects.values_list('payment_name', flat=True))
+        server = FakeGatewayServer((options['host'], options['port']), make_operations(options['operations'], titles),
+                                   latency=options['latency'], fail_rate=options['fail_rate'])
+        self.stdout.write(f"Serving {options['operations']} operations on {server.url}\n"
+                          f"Set PAYMENTS_YOOMONEY_URL to this address and run billing.tasks.watch_payments\n")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            self.stdout.write(f"{server.requests} pages served\n")
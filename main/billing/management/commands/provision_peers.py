@@ -0,0 +1,69 @@
+from time import monotonic
+
+from django.core.management.base import BaseCommand, CommandError
+
+from billing.models import User, provision_user_peers
+from django_wireguard.models import WireguardIPAddress, WireguardKernelIntent, WireguardPeer
+from django_wireguard.placement import PlacementException, choose_interface_ip
+from django_wireguard.provisioning import ProvisioningException, create_peers
+
+
+class Command(BaseCommand):
+    help = 'Create many peers at once, for users or on an interface'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--count', type=int, default=1,
+                            help='Number of peers per user, or on the interface')
+        parser.add_argument('--user', action='append', default=[],
+                            help='Nickname of a user to provision, can be repeated')
+        parser.add_argument('--tariff', type=int, default=None,
+                            help='Provision every user of this tariff id')
+        parser.add_argument('--interface', default=None,
+                            help='Name of the interface of peers without a user')
+        parser.add_argument('--prefix', default='peer',
+                            help='Name prefix of peers without a user')
+
+    def handle(self, *args, **options):
+        count = options['count']
+        if count < 1:
+            raise CommandError("--count must be positive")
+        start = monotonic()
+        # the intents of this run come after the latest existing one
+        last_intent = WireguardKernelIntent.objects.order_by('-pk').values_list('pk', flat=True).first() or 0
+        try:
+            if options['interface']:
+                peers = self.provision_interface(options['interface'], options['prefix'], count)
+            elif options['user'] or options['tariff'] is not None:
+                users = User.objects.all()
+                if options['user']:
+                    users = users.filter(nickname__in=options['user'])
+                if options['tariff'] is not None:
+                    users = users.filter(tariff=options['tariff'])
+                if not users.exists():
+                    raise CommandError("No matching users")
+                peers = provision_user_peers(users, count)
+            else:
+                raise CommandError("Set --interface, --user or --tariff")
+        except (PlacementException, ProvisioningException) as e:
+            raise CommandError(str(e))
+        duration = monotonic() - start
+
+        failed = WireguardKernelIntent.objects.filter(pk__gt=last_intent, attempts__gt=0).count()
+        if failed:
+            self.stderr.write(self.style.ERROR(f"{failed} kernel changes failed and will be retried\n"))
+        self.stdout.write(f"{len(peers)} peers provisioned in {duration:.2f} s "
+                          f"({len(peers) / duration if duration else 0:.0f} peers/s)\n")
+
+    def provision_interface(self, interface_name, prefix, count):
+        interface_ips = WireguardIPAddress.objects.filter(interface__name=interface_name)
+        if not interface_ips.exists():
+            raise CommandError(f"Unknown interface {interface_name}")
+        interface_ip = choose_interface_ip(queryset=interface_ips)
+        taken = set(WireguardPeer.objects.filter(interface_ip=interface_ip, name__startswith=prefix)
+                    .values_list('name', flat=True))
+        names, index = [], 0
+        while len(names) < count:
+            index += 1
+            if f'{prefix}{index}' not in taken:
+                names.append(f'{prefix}{index}')
+        return create_peers(interface_ip, names)
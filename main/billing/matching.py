@@ -0,0 +1,164 @@
+"""
+Payment name matching.
+
+Payers are recognised by the name they write in the payment. Every
+:class:`~billing.models.User` stores ``payment_key``, its payment name normalized by
+:func:`normalize_payment_name`: casefolded, accents and punctuation removed, Cyrillic
+transliterated to Latin and common spelling variants folded, so ``Иван Петров``,
+``ivan  petrov`` and ``IVAN-PETROV`` share one key.
+
+:class:`PaymentNameIndex` looks titles up in memory, first by key in a dict, then by
+the same words in any order, then by key prefix with a binary search in the sorted
+keys. A title matching several users, or only found by prefix, e.g. a bare first name,
+is ambiguous: it matches none and its candidates are reported. The index of a
+process is rebuilt when the version stored in the shared cache changes, which every
+payment name change does.
+"""
+import bisect
+import re
+import threading
+import unicodedata
+from secrets import token_hex
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from django.core.cache import cache
+
+
+__all__ = ('KEY_LENGTH', 'normalize_payment_name', 'PaymentMatch', 'PaymentNameIndex', 'get_payment_index',
+           'invalidate_payment_index')
+
+
+_TRANSLIT = str.maketrans({
+    'а': 'a', 'б': 'b', 'в': 'v', 'г': 'g', 'д': 'd', 'е': 'e', 'ж': 'zh', 'з': 'z', 'и': 'i',
+    'к': 'k', 'л': 'l', 'м': 'm', 'н': 'n', 'о': 'o', 'п': 'p', 'р': 'r', 'с': 's', 'т': 't',
+    'у': 'u', 'ф': 'f', 'х': 'h', 'ц': 'c', 'ч': 'ch', 'ш': 'sh', 'щ': 'sch', 'ъ': '', 'ы': 'y',
+    'ь': '', 'э': 'e', 'ю': 'yu', 'я': 'ya', 'і': 'i', 'є': 'e', 'ґ': 'g',
+})
+# spellings of the same sounds in Latin transliterations
+_VARIANTS = (('shch', 'sch'), ('kh', 'h'), ('ts', 'c'), ('x', 'ks'), ('w', 'v'), ('j', 'i'), ('y', 'i'))
+_SEPARATORS = re.compile(r'[\W_]+')
+
+_VERSION_KEY = 'billing:payment-index:version'
+
+KEY_LENGTH = 255
+"""Length of ``User.payment_key``, transliteration makes a key longer than its name."""
+
+
+def normalize_payment_name(name: Optional[str]) -> str:
+    """
+    Matching key of a payment name.
+
+    :param name: payment name or payment title
+    :return: lowercase Latin words separated by one space
+    """
+    if not name:
+        return ''
+    # drops the accents, й becomes и and ё becomes е
+    name = ''.join(char for char in unicodedata.normalize('NFKD', name.casefold())
+                   if not unicodedata.combining(char))
+    name = name.translate(_TRANSLIT)
+    for variant, canonical in _VARIANTS:
+        name = name.replace(variant, canonical)
+    return ' '.join(_SEPARATORS.sub(' ', name).split())[:KEY_LENGTH].rstrip()
+
+
+def _words_key(key: str) -> str:
+    return ' '.join(sorted(key.split()))
+
+
+class PaymentMatch(NamedTuple):
+    """
+    Result of a title lookup: the matched user id, or all the candidates if ambiguous.
+    """
+    user_id: Optional[int]
+    candidates: Tuple[int, ...] = ()
+
+    @property
+    def ambiguous(self) -> bool:
+        return self.user_id is None and bool(self.candidates)
+
+
+class PaymentNameIndex:
+    """
+    In-memory lookup of users by payment key.
+
+    :param keys: ``(user id, payment key)`` pairs
+    """
+
+    def __init__(self, keys: Iterable[Tuple[int, str]]):
+        self.by_key: Dict[str, List[int]] = {}
+        self.by_words: Dict[str, List[int]] = {}
+        for user_id, key in keys:
+            if key:
+                self.by_key.setdefault(key, []).append(user_id)
+                self.by_words.setdefault(_words_key(key), []).append(user_id)
+        self.keys = sorted(self.by_key)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _prefixed(self, key: str) -> List[int]:
+        user_ids = []
+        position = bisect.bisect_left(self.keys, key)
+        while position < len(self.keys) and self.keys[position].startswith(key):
+            candidate = self.keys[position]
+            # a prefix must end on a word boundary, "ivan" is not a prefix of "ivanov"
+            if len(candidate) == len(key) or candidate[len(key)] == ' ':
+                user_ids += self.by_key[candidate]
+            position += 1
+        return user_ids
+
+    def match(self, title: str) -> PaymentMatch:
+        """
+        Look a payment title up.
+
+        :param title: payment title
+        :rtype: PaymentMatch
+        """
+        key = normalize_payment_name(title)
+        if not key:
+            return PaymentMatch(None)
+        for user_ids in (self.by_key.get(key), self.by_words.get(_words_key(key))):
+            if user_ids:
+                user_ids = tuple(sorted(set(user_ids)))
+                return PaymentMatch(user_ids[0] if len(user_ids) == 1 else None, user_ids)
+        # "anna" may be the only Anna known yet, a prefix is never credited
+        return PaymentMatch(None, tuple(sorted(set(self._prefixed(key)))))
+
+
+_index: Optional[PaymentNameIndex] = None
+_index_version = None
+_lock = threading.Lock()
+
+
+def invalidate_payment_index():
+    """
+    Make every process rebuild its index on next use.
+    """
+    cache.set(_VERSION_KEY, token_hex(8), None)
+
+
+def get_payment_index() -> PaymentNameIndex:
+    """
+    Index of the current payment names, rebuilt with one query when they changed.
+
+    :rtype: PaymentNameIndex
+    """
+    from billing.models import User
+
+    global _index, _index_version
+    version = cache.get(_VERSION_KEY)
+    if version is None:
+        invalidate_payment_index()
+        version = cache.get(_VERSION_KEY)
+    with _lock:
+        if _index is None or version is None or version != _index_version:
+            rows = list(User.objects.values_list('pk', 'payment_name', 'payment_key'))
+            # users saved before the key existed
+            missing = [User(pk=pk, payment_key=normalize_payment_name(name)) for pk, name, key in rows if not key]
+            if missing:
+                User.objects.bulk_update(missing, ['payment_key'], batch_size=500)
+            keys = {pk: key for pk, name, key in rows}
+            keys.update((user.pk, user.payment_key) for user in missing)
+            _index, _index_version = PaymentNameIndex(keys.items()), version
+        return _index
@@ -1,19 +1,25 @@
-from requests import post
-from requests.structures import CaseInsensitiveDict
-import json
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Count
 from django.utils.translation import gettext_lazy as _
 from datetime import date
 from dateutil.relativedelta import relativedelta
 import math
+from billing.gateways import fetch_payments, get_provider
+from billing.matching import KEY_LENGTH
 from billing.settings import CURRENCY, PAYMENTS_START_TIME
+from django_wireguard.metering import get_traffic_usage, get_last_seen
 from django_wireguard.models import WireguardPeer
+from django_wireguard.placement import PlacementException, choose_interface_ip, get_placement_candidates, \
+    get_placement_strategy
+from django_wireguard.provisioning import create_peers, set_peers_status
 
 class User(models.Model):
     admin = models.BooleanField(default=False, verbose_name=_('Administrator'))
     status = models.BooleanField(default=True, verbose_name=_('Status'))
     payment_name = models.CharField(max_length=150, unique=True, verbose_name=_('Payment name'),
                                     help_text=_('For Payment'))
+    payment_key = models.CharField(max_length=KEY_LENGTH, blank=True, db_index=True, editable=False,
+                                   verbose_name=_('Payment key'))
     nickname = models.CharField(max_length=150, unique=True, verbose_name=_('NickName'), help_text=_('For Config'))
     tariff = models.ForeignKey('Tariff', on_delete=models.PROTECT, related_name='persons', related_query_name='persons',
                                verbose_name=_('Tariff'))
@@ -23,6 +29,9 @@ class User(models.Model):
     telegram_id = models.CharField(max_length=100, null=True, unique=True, blank=True, verbose_name=_('Telegram ID'))
     peers = models.ManyToManyField(WireguardPeer, through='UserPeer', verbose_name=_('Peers'))
 
+    _loaded_status = None
+    _loaded_tariff_id = None
+
     def __repr__(self):
         return f'{self.nickname}'
 
@@ -34,6 +43,13 @@ class User(models.Model):
         verbose_name_plural = _('Users')
         ordering = ['-nickname']
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_status = instance.__dict__.get('status')
+        instance._loaded_tariff_id = instance.__dict__.get('tariff_id')
+        return instance
+
     @property
     def number_of_peers(self):
         return self.peers.all().count()
@@ -41,11 +57,17 @@ class User(models.Model):
     @property
     def payment_per_month(self):
         tariff = self.tariff
-        peers = self.peers
-        number_of_excess_peers = peers.count() - tariff.amount_peers if (peers.count() - tariff.amount_peers) > 0 else 0
+        number_of_excess_peers = max(self.peers.count() - tariff.amount_peers, 0)
         final_cost_for_per_month = tariff.cost + tariff.cost_of_per_excess_peer * number_of_excess_peers
         return final_cost_for_per_month
 
+    def get_traffic_usage(self, since=None):
+        usage = get_traffic_usage(self.peers.values_list('pk', flat=True), since).values()
+        return sum(rx for rx, _ in usage), sum(tx for _, tx in usage)
+
+    def get_last_seen(self):
+        return max(get_last_seen(self.peers.values_list('pk', flat=True)).values(), default=None)
+
     def block(self):
         if self.status:
             self.status = False
@@ -53,8 +75,9 @@ class User(models.Model):
 
     def add_money(self, amount):
         balance = self.balance + amount
-        self.balance = balance % self.payment_per_month
-        months = balance // self.payment_per_month
+        payment_per_month = self.payment_per_month
+        self.balance = balance % payment_per_month
+        months = balance // payment_per_month
         if months:
             if self.activity_until < date.today():
                 start_date = date.today()
@@ -123,9 +146,8 @@ class User(models.Model):
             return True, ''
 
     def add_peer(self):
-        peers = self.peers.all()
-        peers_count = peers.count()
-        interface_ip = peers.first().interface_ip
+        peers_count = self.peers.count()
+        interface_ip = choose_interface_ip()
         while True:
             name = f'{self.nickname}{peers_count + 1}'
             if WireguardPeer.objects.filter(name=name):
@@ -158,6 +180,12 @@ class Tariff(models.Model):
     amount_peers = models.PositiveSmallIntegerField(verbose_name=_('Number of peers'))
     max_peers = models.PositiveSmallIntegerField(default=10, verbose_name=_('Max number of peers'))
     cost_of_per_excess_peer = models.PositiveSmallIntegerField(verbose_name=_('Cost of per excess peer'))
+    rate_limit_down = models.PositiveIntegerField(null=True, blank=True, verbose_name=_('Download limit, kbit/s'),
+                                                  help_text=_('Per peer, empty for unlimited'))
+    rate_limit_up = models.PositiveIntegerField(null=True, blank=True, verbose_name=_('Upload limit, kbit/s'),
+                                                help_text=_('Per peer, empty for unlimited'))
+
+    _loaded_rate_limits = None
 
     def __repr__(self):
         return f'{self.name} - {self.cost}'
@@ -170,6 +198,93 @@ class Tariff(models.Model):
         verbose_name_plural = _('Tariffs')
         ordering = ['-name']
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_rate_limits = (instance.__dict__.get('rate_limit_down'),
+                                        instance.__dict__.get('rate_limit_up'))
+        return instance
+
+
+def get_peer_rate_limits(peer_ids):
+    """
+    Tariff bandwidth limits of peers, used as ``WIREGUARD_RATE_LIMITS_PROVIDER``.
+    """
+    rows = UserPeer.objects.filter(peer__in=peer_ids).values_list('peer_id', 'user__tariff__rate_limit_down',
+                                                                  'user__tariff__rate_limit_up')
+    return {peer_id: (rate_down, rate_up) for peer_id, rate_down, rate_up in rows}
+
+
+def provision_user_peers(users, count: int = 1, strategy=None):
+    """
+    Create ``count`` peers for each user in one transaction, without charging them.
+
+    Peers are named like :meth:`User.add_peer` does, and a user's peers share one interface
+    address, placed from the candidate loads measured once for the whole batch.
+
+    :param users: billing Users
+    :param count: number of peers per user
+    :param strategy: placement strategy name, ``WIREGUARD_PLACEMENT_STRATEGY`` by default
+    :return: the created WireguardPeers, programmed into the kernel on commit
+    """
+    users = list(users)
+    taken = set(WireguardPeer.objects.values_list('name', flat=True))
+    peers_count = dict(UserPeer.objects.filter(user__in=users).values('user_id').annotate(count=Count('id'))
+                       .values_list('user_id', 'count'))
+    strategy = get_placement_strategy(strategy)
+    candidates = get_placement_candidates()
+
+    batches = {}
+    for user in users:
+        candidate = strategy.choose([candidate for candidate in candidates if candidate.free >= count])
+        if candidate is None:
+            raise PlacementException(f"No interface address has room for {count} peers of {user}")
+        candidate.free -= count
+        candidate.peers += count
+        index = peers_count.get(user.pk, 0)
+        interface_ip, names, owners = batches.setdefault(candidate.interface_ip.pk, (candidate.interface_ip, [], []))
+        for number in range(count):
+            index += 1
+            while f'{user.nickname}{index}' in taken:
+                index += 1
+            taken.add(f'{user.nickname}{index}')
+            names.append(f'{user.nickname}{index}')
+            owners.append(user)
+
+    peers, links = [], []
+    with transaction.atomic():
+        for interface_ip, names, owners in batches.values():
+            created = create_peers(interface_ip, names)
+            peers += created
+            links += [UserPeer(user=user, peer=peer) for user, peer in zip(owners, created)]
+        UserPeer.objects.bulk_create(links, batch_size=500)
+    return peers
+
+
+def set_users_status(users, status: bool) -> list:
+    """
+    Block or unblock users with one update per model, the kernel is synced in batch on commit.
+
+    Administrators are never blocked.
+
+    :param users: billing Users queryset
+    :param status: new status
+    :return: the Users whose status changed
+    """
+    users = users.exclude(status=status)
+    if not status:
+        users = users.exclude(admin=True)
+    users = list(users)
+    if not users:
+        return []
+    with transaction.atomic():
+        # update() skips pre_save_user, the peers are propagated here
+        User.objects.filter(pk__in=[user.pk for user in users]).update(status=status)
+        set_peers_status(WireguardPeer.objects.filter(userpeer__user__in=users), status)
+    for user in users:
+        user.status = user._loaded_status = status
+    return users
+
 
 class PaymentGateway(models.Model):
     YOOMONEY = 'YO'
@@ -180,6 +295,12 @@ class PaymentGateway(models.Model):
     ]
     name = models.CharField(max_length=2, choices=PROVIDER_CHOICES, unique=True, verbose_name=_('Name'))
     token = models.TextField(max_length=500, verbose_name=_('Token'))
+    cursor = models.DateTimeField(null=True, blank=True, verbose_name=_('Latest operation'),
+                                  help_text=_('Operations are requested from this time'))
+    notification_secret = models.CharField(max_length=100, blank=True, verbose_name=_('Notification secret'),
+                                           help_text=_('Set it to receive payment notifications, '
+                                                       'the gateway is then only polled to reconcile'))
+    polled_at = models.DateTimeField(null=True, blank=True, verbose_name=_('Last poll'))
 
     def __repr__(self):
         return f'{self.name}'
@@ -192,38 +313,17 @@ class PaymentGateway(models.Model):
         verbose_name_plural = _('Payment Gateways')
 
     def get_last_payments(self, from_time: str = '') -> list:
-        payments = []
-        if not from_time:
-            from_time = PAYMENTS_START_TIME
-        headers = CaseInsensitiveDict()
-        headers["Accept"] = "application/x-www-form-urlencoded"
-        headers["Authorization"] = f"Bearer {self.token}"
-        headers["Content-Type"] = "application/x-www-form-urlencoded"
-        if self.name == self.YOOMONEY:
-            url = 'https://yoomoney.ru/api/operation-history'
-            resp = post(url, headers=headers, data=f'type=deposition&from={from_time}')
-            if resp.status_code == 200:
-                payments_dirty = json.loads(resp.content)['operations']
-                for payment in payments_dirty:
-                    if payment['status'] != 'success':
-                        continue
-                    payments.append({
-                        'operation_id': payment['operation_id'],
-                        'title': payment['title'],
-                        'amount': payment['amount'],
-                        'amount_currency': payment['amount_currency'],
-                        'datetime': payment['datetime'],
-                    })
-        elif self.name == self.QIWI:
-            pass
-        return payments
+        return get_provider(self).get_operations(from_time or PAYMENTS_START_TIME)
 
     @classmethod
     def get_all_last_payments(cls, from_time: str = '') -> list:
+        gateways = list(PaymentGateway.objects.all())
+        results = fetch_payments(gateways, {gateway.pk: from_time or PAYMENTS_START_TIME for gateway in gateways})
         payments = []
-        payment_gateways = PaymentGateway.objects.all()
-        for provider in payment_gateways:
-            payments += provider.get_last_payments(from_time=from_time)
+        for result in results.values():
+            if isinstance(result, Exception):
+                raise result
+            payments += result
         return payments
 
 
@@ -0,0 +1,168 @@
+"""
+Incremental payment ingestion.
+
+Every :class:`~billing.models.PaymentGateway` stores a cursor, the time of the latest
+operation it returned, and is only asked for the operations since then. A batch of
+operations is ingested with one lookup of the known operation ids, one lookup of the
+payers, one ``bulk_create`` and one balance update per payer, in a single transaction.
+Polls are serialized by a lock held in the shared cache, so overlapping runs are skipped,
+and every ingestion locks its gateway row, so a notification and a poll never store the
+same operation twice.
+"""
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import timezone as dt_timezone
+from typing import Dict, Iterable, List, Tuple
+from uuid import uuid4
+
+from django.core.cache import cache
+from django.db import transaction
+from django.utils.dateparse import parse_datetime
+
+from billing.gateways import get_provider
+from billing.matching import get_payment_index
+from billing.models import Payment, PaymentGateway, User
+from billing.settings import PAYMENTS_LOCK_TIMEOUT, PAYMENTS_START_TIME
+
+
+__all__ = ('payments_lock', 'get_from_time', 'match_payment_users', 'ingest_payments', 'ingest_notification')
+
+
+_LOCK_KEY = 'billing:payments:lock'
+_BATCH_SIZE = 500
+
+
+@contextmanager
+def payments_lock():
+    """
+    Hold the payment ingestion lock, yields False if another run holds it.
+    """
+    token = uuid4().hex
+    locked = cache.add(_LOCK_KEY, token, PAYMENTS_LOCK_TIMEOUT)
+    try:
+        yield locked
+    finally:
+        # the lock may have expired and been taken by another run meanwhile
+        if locked and cache.get(_LOCK_KEY) == token:
+            cache.delete(_LOCK_KEY)
+
+
+def get_from_time(gateway: PaymentGateway) -> str:
+    """
+    Time of the first operation to request from a gateway.
+
+    :param gateway: PaymentGateway
+    :return: time in the ``YYYY-MM-DDTHH:MM:SSZ`` format
+    """
+    cursor = gateway.cursor
+    if cursor is None:
+        # gateways added before the cursor start from the latest payment
+        cursor = Payment.objects.values_list('created_at', flat=True).first()
+    if cursor is None:
+        return PAYMENTS_START_TIME
+    return cursor.astimezone(dt_timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def match_payment_users(titles: Iterable[str]) -> Tuple[Dict[str, User], Dict[str, List[User]]]:
+    """
+    Payers of many operations, resolved at once with the payment name index.
+
+    :param titles: operation titles
+    :return: User by title, and the candidate Users of the ambiguous titles; unknown payers are left out
+    """
+    index = get_payment_index()
+    results = {title: index.match(title) for title in set(titles) if title}
+    users = User.objects.select_related('tariff').in_bulk(
+        {user_id for result in results.values() for user_id in result.candidates})
+    matches = {title: users[result.user_id] for title, result in results.items()
+               if result.user_id in users}
+    ambiguous = {title: [users[user_id] for user_id in result.candidates if user_id in users]
+                 for title, result in results.items() if result.ambiguous}
+    return matches, ambiguous
+
+
+def ingest_payments(gateway: PaymentGateway, operations: List[dict], keep_unknown: bool = False,
+                    move_cursor: bool = True) -> List[Payment]:
+    """
+    Store the new operations of a gateway, credit the payers and move its cursor.
+
+    :param gateway: PaymentGateway the operations come from
+    :param operations: operations as returned by :meth:`PaymentGateway.get_last_payments`
+    :param keep_unknown: also store the payments of unknown payers, with their title as comment
+    :param move_cursor: move the cursor to the latest operation, only a complete history may
+        move it past operations that were not read
+    :return: the created Payments
+    """
+    if not operations:
+        return []
+    times = [parse_datetime(operation['datetime']) for operation in operations] if move_cursor else []
+    cursor = max((time for time in times if time is not None), default=None)
+    with transaction.atomic():
+        # serializes the ingestions of a gateway, the known operations below stay known
+        list(PaymentGateway.objects.select_for_update().filter(pk=gateway.pk).values_list('pk', flat=True))
+        known = set(Payment.objects
+                    .filter(operation_id__in=[operation['operation_id'] for operation in operations])
+                    .values_list('operation_id', flat=True))
+        operations = [operation for operation in operations if operation['operation_id'] not in known]
+        users, ambiguous = match_payment_users(operation['title'] for operation in operations)
+
+        payments, seen = [], set()
+        for operation in operations:
+            if operation['operation_id'] in seen:
+                continue
+            seen.add(operation['operation_id'])
+            user = users.get(operation['title'])
+            # ambiguous payments are kept for an administrator to credit the right user
+            if user is None and not keep_unknown and operation['title'] not in ambiguous:
+                continue
+            payment = Payment(operation_id=operation['operation_id'], created_at=operation['datetime'],
+                              amount=int(operation['amount']), user=user,
+                              comment=None if user else operation['title'])
+            payment.currency = operation['amount_currency']
+            payment.title = operation['title']
+            payment.candidates = ambiguous.get(operation['title'], [])
+            payments.append(payment)
+        # bulk_create skips pre_save_payment, the balances are credited below
+        Payment.objects.bulk_create(payments, batch_size=_BATCH_SIZE)
+
+        # one balance update per payer, crediting the sum gives the same months as one by one
+        amounts, payers = defaultdict(int), {}
+        for payment in payments:
+            if payment.user is not None:
+                amounts[payment.user.pk] += payment.amount
+                payers.setdefault(payment.user.pk, payment.user)
+        for user_pk, amount in amounts.items():
+            payers[user_pk].add_money(amount)
+
+        if cursor is not None and (gateway.cursor is None or cursor > gateway.cursor):
+            gateway.cursor = cursor
+            PaymentGateway.objects.filter(pk=gateway.pk).update(cursor=cursor)
+    return payments
+
+
+def ingest_notification(gateway: PaymentGateway, data, keep_unknown: bool = False) -> List[Payment]:
+    """
+    Store the payment announced by a gateway notification, once whatever the number of deliveries.
+
+    :param gateway: PaymentGateway sending the notification
+    :param data: notification fields
+    :param keep_unknown: also store the payment of an unknown payer
+    :return: the created Payments
+    :raises NotificationException: if the notification is malformed or not signed by the gateway
+    :raises GatewayException: if the operation could not be read from the gateway, it is then polled later
+    """
+    provider = get_provider(gateway)
+    operation = provider.parse_notification(data)
+    if operation is None or Payment.objects.filter(operation_id=operation['operation_id']).exists():
+        return []
+    # notifications do not carry the title the payer is matched by
+    details = provider.get_operation(operation['operation_id'])
+    if details is None:
+        return []
+    operation['title'] = details['title']
+    if gateway.cursor is None:
+        # the poll of a gateway without cursor starts from the latest payment, pin it before this one
+        cursor = parse_datetime(get_from_time(gateway) or '')
+        if cursor is not None:
+            PaymentGateway.objects.filter(pk=gateway.pk, cursor=None).update(cursor=cursor)
+    return ingest_payments(gateway, [operation], keep_unknown=keep_unknown, move_cursor=False)
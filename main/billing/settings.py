@@ -5,3 +5,13 @@ from django.conf import settings
 
 PAYMENTS_START_TIME = getattr(settings, 'PAYMENTS_START_TIME', '2022-11-06T13:45:16Z')
 CURRENCY = getattr(settings, 'CURRENCY', 'RUB')
+PAYMENTS_LOCK_TIMEOUT = getattr(settings, 'PAYMENTS_LOCK_TIMEOUT', 10 * 60)
+PAYMENTS_YOOMONEY_URL = getattr(settings, 'PAYMENTS_YOOMONEY_URL', 'https://yoomoney.ru/api/operation-history')
+PAYMENTS_HTTP_TIMEOUT = getattr(settings, 'PAYMENTS_HTTP_TIMEOUT', (5, 30))
+PAYMENTS_HTTP_RETRIES = getattr(settings, 'PAYMENTS_HTTP_RETRIES', 3)
+PAYMENTS_HTTP_BACKOFF = getattr(settings, 'PAYMENTS_HTTP_BACKOFF', 0.5)
+PAYMENTS_MAX_PAGES = getattr(settings, 'PAYMENTS_MAX_PAGES', 100)
+PAYMENTS_POLL_WORKERS = getattr(settings, 'PAYMENTS_POLL_WORKERS', 4)
+PAYMENTS_YOOMONEY_DETAILS_URL = getattr(settings, 'PAYMENTS_YOOMONEY_DETAILS_URL',
+                                        'https://yoomoney.ru/api/operation-details')
+PAYMENTS_RECONCILE_INTERVAL = getattr(settings, 'PAYMENTS_RECONCILE_INTERVAL', 15 * 60)
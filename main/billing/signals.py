@@ -1,7 +1,13 @@
-from django.db.models.signals import pre_save
+from django.db import transaction
+from django.db.models.signals import pre_save, post_save, post_delete
 from django.dispatch import receiver
 from telebot import TeleBot
-from billing.models import User, Payment
+from billing.matching import invalidate_payment_index, normalize_payment_name
+from billing.models import User, Payment, Tariff, UserPeer
+from django_wireguard import settings as wireguard_settings
+from django_wireguard.models import WireguardPeer
+from django_wireguard.outbox import enqueue_peers
+from django_wireguard.provisioning import set_peers_status
 from bot.settings import TELEGRAM_USERBOT_TOKEN
 
 STATUS = {True: "возобновлен", False: "заблокирован"}
@@ -10,20 +16,73 @@ STATUS = {True: "возобновлен", False: "заблокирован"}
 @receiver(pre_save, sender=User)
 def pre_save_user(sender, **kwargs):
     user: User = kwargs['instance']
+    payment_key = normalize_payment_name(user.payment_name)
+    if not user.pk or payment_key != user.payment_key:
+        user.payment_key = payment_key
+        user._payment_key_changed = True
     if not user.status and user.admin:
         user.status = True
     elif user.id:
-        pre_user = User.objects.get(pk=user.pk)
-        peers = user.peers.all()
-        print(peers)
-        if user.status != pre_user.status:
-            print(user.status, pre_user.status)
-            if user.telegram_id:
-                bot = TeleBot(TELEGRAM_USERBOT_TOKEN, threaded=False)
-                bot.send_message(user.telegram_id, f'Доступ к VPN {STATUS[user.status]}.')
-            for peer in peers:
-                peer.status = user.status
-                peer.save()
+        if user._loaded_status is None:
+            # not loaded from the database, e.g. built with an existing pk
+            user._loaded_status, user._loaded_tariff_id = (
+                User.objects.filter(pk=user.pk).values_list('status', 'tariff_id').first() or (user.status, user.tariff_id))
+        if user.status != user._loaded_status:
+            # the peers follow once the new status is written, see post_save_user
+            user._status_changed = True
+        elif user.tariff_id != user._loaded_tariff_id:
+            # the limits are read from the database, queued once the new tariff is saved
+            user._limits_changed = True
+    user._loaded_status, user._loaded_tariff_id = user.status, user.tariff_id
+
+
+def _notify_user_status(telegram_id, status: bool):
+    bot = TeleBot(TELEGRAM_USERBOT_TOKEN, threaded=False)
+    bot.send_message(telegram_id, f'Доступ к VPN {STATUS[status]}.')
+
+
+@receiver(post_save, sender=User)
+def post_save_user(sender, **kwargs):
+    user: User = kwargs['instance']
+    if getattr(user, '_status_changed', False):
+        user._status_changed = False
+        # in the transaction of the user, rolled back with it; the kernel follows on commit
+        set_peers_status(WireguardPeer.objects.filter(userpeer__user=user), user.status)
+        if user.telegram_id:
+            telegram_id, status = user.telegram_id, user.status
+            transaction.on_commit(lambda: _notify_user_status(telegram_id, status))
+    if getattr(user, '_payment_key_changed', False):
+        user._payment_key_changed = False
+        # other processes could rebuild their index from the old names before the commit
+        transaction.on_commit(invalidate_payment_index)
+    if getattr(user, '_limits_changed', False):
+        user._limits_changed = False
+        if wireguard_settings.WIREGUARD_SHAPING:
+            enqueue_peers(WireguardPeer.objects.filter(userpeer__user=user).select_related('interface_ip__interface'))
+
+
+@receiver(post_delete, sender=User)
+def post_delete_user(sender, **kwargs):
+    transaction.on_commit(invalidate_payment_index)
+
+
+@receiver(post_save, sender=UserPeer)
+def post_save_user_peer(sender, **kwargs):
+    user_peer: UserPeer = kwargs['instance']
+    # the tariff limits of the peer apply from the link
+    if kwargs['created'] and wireguard_settings.WIREGUARD_SHAPING:
+        enqueue_peers([user_peer.peer])
+
+
+@receiver(post_save, sender=Tariff)
+def post_save_tariff(sender, **kwargs):
+    tariff: Tariff = kwargs['instance']
+    rate_limits = (tariff.rate_limit_down, tariff.rate_limit_up)
+    # limits of a tariff not loaded from the database may have changed
+    changed = tariff._loaded_rate_limits is None or rate_limits != tariff._loaded_rate_limits
+    tariff._loaded_rate_limits = rate_limits
+    if changed and not kwargs['created'] and wireguard_settings.WIREGUARD_SHAPING:
+        enqueue_peers(WireguardPeer.objects.filter(user__tariff=tariff).select_related('interface_ip__interface'))
 
 
 @receiver(pre_save, sender=Payment)
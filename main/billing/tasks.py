@@ -1,10 +1,15 @@
-from datetime import date, datetime
+from datetime import date, timedelta
 from dateutil.relativedelta import relativedelta
 from celery import shared_task
+from django.db.models import Q
+from django.utils import timezone
 from telebot import TeleBot
-from core.settings import PAYMENTS_ALL, TELEGRAM_ADMIN_ID, \
-    PAYMENTS_START_TIME
-from billing.models import Payment, User, PaymentGateway
+from core.settings import PAYMENTS_ALL, TELEGRAM_ADMIN_ID
+from billing.settings import PAYMENTS_RECONCILE_INTERVAL
+from billing.models import User, PaymentGateway, set_users_status
+from billing.gateways import fetch_payments
+from billing.payments import get_from_time, ingest_payments, payments_lock
+from billing.signals import STATUS
 from bot.settings import TELEGRAM_USERBOT_TOKEN, TELEGRAM_ADMINBOT_TOKEN
 
 
@@ -13,50 +18,63 @@ adminbot = TeleBot(TELEGRAM_ADMINBOT_TOKEN, threaded=False)
 
 @shared_task
 def watch_payments():
-    try:
-        from_time_dirty = Payment.objects.values_list('created_at').first()
-        if from_time_dirty:
-            from_time = datetime.strftime(from_time_dirty[0], "%Y-%m-%dT%H:%M:%SZ")
-        else:
-            from_time = PAYMENTS_START_TIME
-        payments = PaymentGateway.get_all_last_payments(from_time=from_time)
-        for payment in payments:
-            operation_id = payment['operation_id']
-            if Payment.objects.filter(operation_id=operation_id).exists():
-                break
-            name = payment['title']
-            user = User.objects.filter(payment_name__icontains=name).first()
-            amount = int(payment['amount'])
-            created_at = payment['datetime']
-            currency = payment['amount_currency']
-            if not user and PAYMENTS_ALL:
-                new_payment = Payment(operation_id=operation_id, created_at=created_at, amount=amount, comment=name)
-                new_payment.save()
+    with payments_lock() as locked:
+        if not locked:
+            # the previous run is still ingesting
+            return
+        # gateways sending notifications are only polled from time to time to catch up missed ones
+        now = timezone.now()
+        gateways = list(PaymentGateway.objects.filter(
+            Q(notification_secret='') | Q(polled_at=None) |
+            Q(polled_at__lte=now - timedelta(seconds=PAYMENTS_RECONCILE_INTERVAL))))
+        # the gateways are polled concurrently, then ingested one after another
+        results = fetch_payments(gateways, {gateway.pk: get_from_time(gateway) for gateway in gateways})
+        for gateway in gateways:
+            try:
+                if isinstance(results[gateway.pk], Exception):
+                    raise results[gateway.pk]
+                payments = ingest_payments(gateway, results[gateway.pk], keep_unknown=PAYMENTS_ALL)
+                PaymentGateway.objects.filter(pk=gateway.pk).update(polled_at=now)
+            except Exception as e:
+                error = f'{e}'[:500]
+                print(error)
+                adminbot.send_message(TELEGRAM_ADMIN_ID, f'[ERROR] send_status - {error}')
+                continue
+            notify_payments(payments)
+
+
+def notify_payments(payments):
+    for payment in payments:
+        name, amount, currency = payment.title, payment.amount, payment.currency
+        try:
+            if payment.candidates:
+                candidates = ', '.join(user.nickname for user in payment.candidates)
+                adminbot.send_message(TELEGRAM_ADMIN_ID,
+                                      f'[WARNING] Платеж {name} на сумму {amount} {currency} не сопоставлен однозначно, '
+                                      f'возможные пользователи: {candidates}. Баланс не пополнен.')
+            elif payment.user is None:
                 adminbot.send_message(TELEGRAM_ADMIN_ID,
                                       f'[INFO] Неизвестный пользователь {name} пополнил баланс на сумму {amount} {currency}.')
-            elif user:
-                new_payment = Payment(operation_id=operation_id, created_at=created_at, amount=amount,
-                                      user=user)
-                new_payment.save()
+            else:
                 adminbot.send_message(TELEGRAM_ADMIN_ID,
                                       f'[INFO] Пользователь {name} пополнил баланс на сумму {amount} {currency}.')
-                if user.telegram_id:
-                    bot.send_message(user.telegram_id, f'Баланс пополнен на сумму {amount} {currency}.')
-    except Exception as e:
-        error = f'{e}'[:500]
-        print(error)
-        adminbot.send_message(TELEGRAM_ADMIN_ID, f'[ERROR] send_status - {error}')
+                if payment.user.telegram_id:
+                    bot.send_message(payment.user.telegram_id, f'Баланс пополнен на сумму {amount} {currency}.')
+        except Exception as e:
+            error = f'{e}'[:500]
+            print(error)
 
 
 @shared_task
 def block_or_notification_user():
     try:
-        for user in User.objects.filter(status=True, activity_until__lte=(date.today() + relativedelta(days=1))):
-            if user.activity_until == date.today() + relativedelta(days=1):
-                if user.telegram_id:
-                    bot.send_message(user.telegram_id, f'Добрый день! Сегодня последний оплаченый день.')
-            else:
-                user.block()
+        for user in User.objects.filter(status=True, activity_until=(date.today() + relativedelta(days=1))):
+            if user.telegram_id:
+                bot.send_message(user.telegram_id, f'Добрый день! Сегодня последний оплаченый день.')
+        blocked = set_users_status(User.objects.filter(status=True, activity_until__lte=date.today()), False)
+        for user in blocked:
+            if user.telegram_id:
+                bot.send_message(user.telegram_id, f'Доступ к VPN {STATUS[False]}.')
     except Exception as e:
         error = f'{e}'[:500]
         print(error)
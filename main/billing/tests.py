@@ -1,3 +1,198 @@
-from django.test import TestCase
+import threading
+from datetime import date
+from itertools import cycle
+from unittest import mock
 
-# Create your tests here.
+from django.test import SimpleTestCase, TestCase
+
+from billing import fake_gateway, matching
+from billing.fake_gateway import FakeGatewayServer, make_notification, make_operations
+from billing.matching import PaymentNameIndex, get_payment_index, invalidate_payment_index, normalize_payment_name
+from billing.models import Payment, PaymentGateway, Tariff, User
+from billing.payments import ingest_payments
+from billing.tasks import watch_payments
+
+
+class NormalizePaymentNameTests(SimpleTestCase):
+    def test_spellings_share_a_key(self):
+        self.assertEqual(normalize_payment_name('Иван Петров'), 'ivan petrov')
+        self.assertEqual(normalize_payment_name('  IVAN-PETROV '), 'ivan petrov')
+        self.assertEqual(normalize_payment_name('ivan_petrov!'), 'ivan petrov')
+
+    def test_transliteration_variants(self):
+        self.assertEqual(normalize_payment_name('Хрущёв'), normalize_payment_name('Khrushchev'))
+        self.assertEqual(normalize_payment_name('Цой'), normalize_payment_name('Tsoy'))
+        self.assertEqual(normalize_payment_name('Юрий'), normalize_payment_name('Yuriy'))
+        self.assertEqual(normalize_payment_name('Алексей'), normalize_payment_name('Aleksey'))
+
+    def test_empty(self):
+        self.assertEqual(normalize_payment_name(None), '')
+        self.assertEqual(normalize_payment_name(' - '), '')
+
+
+class PaymentNameIndexTests(SimpleTestCase):
+    def setUp(self):
+        self.index = PaymentNameIndex([
+            (1, normalize_payment_name('Иван Петров')),
+            (2, normalize_payment_name('Anna Smirnova')),
+            (3, normalize_payment_name('Petr Ivanov')),
+            (4, normalize_payment_name('Petr Ivanov')),
+            (5, normalize_payment_name('Ivanov')),
+            (6, ''),
+        ])
+
+    def test_exact(self):
+        match = self.index.match('IVAN PETROV')
+        self.assertEqual(match.user_id, 1)
+        self.assertFalse(match.ambiguous)
+
+    def test_word_order(self):
+        self.assertEqual(self.index.match('Петров Иван').user_id, 1)
+
+    def test_prefix_is_not_credited(self):
+        match = self.index.match('Anna')
+        self.assertIsNone(match.user_id)
+        self.assertEqual(match.candidates, (2,))
+        self.assertTrue(match.ambiguous)
+
+    def test_prefix_ends_on_a_word(self):
+        self.assertEqual(self.index.match('Ivan').candidates, (1,))
+        match = self.index.match('Ivano')
+        self.assertEqual(match.candidates, ())
+        self.assertFalse(match.ambiguous)
+
+    def test_ambiguous(self):
+        match = self.index.match('Petr Ivanov')
+        self.assertIsNone(match.user_id)
+        self.assertEqual(match.candidates, (3, 4))
+        self.assertTrue(match.ambiguous)
+
+    def test_unknown(self):
+        self.assertEqual(self.index.match('Somebody Else'), (None, ()))
+        self.assertEqual(self.index.match(''), (None, ()))
+        self.assertEqual(len(self.index), 4)
+
+
+class PaymentIndexCacheTests(TestCase):
+    def setUp(self):
+        self.tariff = Tariff.objects.create(name='base', cost=100, amount_peers=1, cost_of_per_excess_peer=50)
+
+    def create_user(self, name: str) -> User:
+        return User.objects.create(nickname=name, payment_name=name, tariff=self.tariff,
+                                   created_at=date.today(), activity_until=date.today())
+
+    def test_rebuilt_on_version_change(self):
+        anna = self.create_user('Anna Smirnova')
+        self.assertEqual(get_payment_index().match('Anna Smirnova').user_id, anna.pk)
+        index = get_payment_index()
+        self.assertIs(get_payment_index(), index)
+
+        anna.payment_name = 'Anna Ivanova'
+        with self.captureOnCommitCallbacks(execute=True):
+            anna.save()
+        self.assertIsNot(get_payment_index(), index)
+        self.assertEqual(get_payment_index().match('Anna Ivanova').user_id, anna.pk)
+        self.assertIsNone(get_payment_index().match('Anna Smirnova').user_id)
+
+    def test_missing_keys_are_filled(self):
+        anna = self.create_user('Anna Smirnova')
+        User.objects.filter(pk=anna.pk).update(payment_key='')
+        invalidate_payment_index()
+        self.assertEqual(get_payment_index().match('Anna Smirnova').user_id, anna.pk)
+        anna.refresh_from_db()
+        self.assertEqual(anna.payment_key, 'anna smirnova')
+
+    def tearDown(self):
+        matching._index = None
+
+
+class FakeGatewayTestCase(TestCase):
+    operation_count = 3
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.operations = make_operations(cls.operation_count, ['Ivan Petrov', 'Anna Smirnova'])
+        cls.server = FakeGatewayServer(('127.0.0.1', 0), cls.operations)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.addClassCleanup(cls.server.server_close)
+        cls.addClassCleanup(cls.server.shutdown)
+        for patcher in (mock.patch('billing.gateways.PAYMENTS_YOOMONEY_URL', cls.server.url),
+                        mock.patch('billing.gateways.PAYMENTS_YOOMONEY_DETAILS_URL',
+                                   cls.server.url.replace('history', 'details')),
+                        mock.patch('billing.tasks.bot'), mock.patch('billing.tasks.adminbot'),
+                        mock.patch('billing.signals.TeleBot')):
+            patcher.start()
+            cls.addClassCleanup(patcher.stop)
+
+    def setUp(self):
+        tariff = Tariff.objects.create(name='base', cost=100, amount_peers=1, cost_of_per_excess_peer=50)
+        for name in ('Ivan Petrov', 'Anna Smirnova'):
+            User.objects.create(nickname=name, payment_name=name, tariff=tariff,
+                                created_at=date.today(), activity_until=date.today())
+        invalidate_payment_index()
+        self.gateway = PaymentGateway.objects.create(name=PaymentGateway.YOOMONEY, token='token',
+                                                     notification_secret='secret')
+        self.server.fail_rate = 0
+
+    def tearDown(self):
+        matching._index = None
+
+
+class PaymentNotificationTests(FakeGatewayTestCase):
+    url = '/api/payments/yo/notification/'
+
+    def test_valid_signature(self):
+        operation = self.operations[0]
+        response = self.client.post(self.url, make_notification(operation, 'secret'))
+        self.assertEqual(response.status_code, 200)
+        payment = Payment.objects.get()
+        self.assertEqual(payment.operation_id, operation['operation_id'])
+        self.assertEqual(payment.user.payment_name, operation['title'])
+
+    def test_wrong_signature(self):
+        notification = make_notification(self.operations[0], 'secret')
+        notification['amount'] = '999.00'
+        self.assertEqual(self.client.post(self.url, notification).status_code, 400)
+        self.assertEqual(self.client.post(self.url, make_notification(self.operations[0], 'other')).status_code, 400)
+        self.assertFalse(Payment.objects.exists())
+
+    def test_duplicate_delivery(self):
+        notification = make_notification(self.operations[0], 'secret')
+        for _ in range(2):
+            self.assertEqual(self.client.post(self.url, notification).status_code, 200)
+        self.assertEqual(Payment.objects.count(), 1)
+
+    def test_test_and_unaccepted_notifications(self):
+        for flag in ('test_notification', 'unaccepted'):
+            notification = dict(make_notification(self.operations[0], 'secret'), **{flag: 'true'})
+            self.assertEqual(self.client.post(self.url, notification).status_code, 200)
+        self.assertFalse(Payment.objects.exists())
+
+
+class PaymentPollTests(FakeGatewayTestCase):
+    # more than one page of 100 records
+    operation_count = 250
+
+    def test_poll(self):
+        # every page is answered with 503 once, then served by the retry
+        self.server.fail_rate = 0.5
+        with mock.patch('billing.gateways._sessions', {}), mock.patch('billing.gateways.PAYMENTS_HTTP_BACKOFF', 0), \
+                mock.patch.object(fake_gateway.random, 'random', side_effect=cycle((0.0, 1.0))) as rolls:
+            watch_payments()
+        self.assertEqual(rolls.call_count, 6)
+        self.assertEqual(self.server.requests, 3)
+        self.assertEqual(Payment.objects.count(), 250)
+        self.assertEqual(set(Payment.objects.values_list('operation_id', flat=True)),
+                         {operation['operation_id'] for operation in self.operations})
+        self.gateway.refresh_from_db()
+        self.assertEqual(self.gateway.cursor.strftime('%Y-%m-%dT%H:%M:%SZ'), self.operations[0]['datetime'])
+        self.assertIsNotNone(self.gateway.polled_at)
+
+        # the next poll starts from the cursor, and the operations read again are known
+        self.server.fail_rate = 0
+        PaymentGateway.objects.filter(pk=self.gateway.pk).update(polled_at=None)
+        watch_payments()
+        self.assertEqual(self.server.requests, 4)
+        self.assertEqual(ingest_payments(self.gateway, self.operations), [])
+        self.assertEqual(Payment.objects.count(), 250)
@@ -8,7 +8,9 @@ urlpatterns = [
     path('users/<int:telegram_id>', views.UserDetailApiView.as_view()),
     path('peers/', views.PeerListAllApiView.as_view()),
     path('peers/<int:pk>', views.PeerDetailApiView.as_view()),
+    path('peers/export/', views.PeerConfigsExportApiView.as_view()),
     path('peers_of_user/<str:telegram_id>', views.PeerListApiView.as_view()),
     path('dns/', views.DNSListApiView.as_view()),
     path('allowed_networks/', views.AllowedNetworksListApiView.as_view()),
+    path('payments/<str:gateway>/notification/', views.PaymentNotificationApiView.as_view()),
 ]
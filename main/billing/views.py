@@ -5,7 +5,11 @@ from rest_framework import permissions
 from django.shortcuts import get_object_or_404
 
 from billing.serializers import UserSerializer, WireguardPeerSerializer, DNSSerializer, AllowedNetworksSerializer
-from billing.models import User
+from billing.gateways import GatewayException, NotificationException
+from billing.models import User, PaymentGateway
+from billing.payments import ingest_notification
+from core.settings import PAYMENTS_ALL
+from django_wireguard.export import configs_zip_response
 from django_wireguard.models import WireguardPeer, WireguardDNS, WireguardAllowedNetworks
 
 
@@ -65,7 +69,7 @@ class PeerListAllApiView(APIView):
     permission_classes = [permissions.IsAuthenticated]
 
     def get(self, request, *args, **kwargs):
-        peers = WireguardPeer.objects.all().order_by('name',)
+        peers = WireguardPeer.objects.select_related('interface_ip__interface').order_by('name',)
         serializer = WireguardPeerSerializer(peers, many=True)
         return Response(serializer.data, status=status.HTTP_200_OK)
 
@@ -86,7 +90,7 @@ class PeerListApiView(APIView):
 
     def get_queryset(self, telegram_id):
         try:
-            return User.objects.get(telegram_id=telegram_id).peers
+            return User.objects.get(telegram_id=telegram_id).peers.select_related('interface_ip__interface')
         except User.DoesNotExist:
             return None
 
@@ -126,6 +130,29 @@ class PeerDetailApiView(APIView):
         serializer.save()
         return Response(data=serializer.data, status=status.HTTP_201_CREATED)
 
+class PeerConfigsExportApiView(APIView):
+    """
+    Stream a ZIP of peer configs, filtered by ``user`` (telegram id), ``interface`` (name)
+    and ``tariff`` (id); ``qr=1`` adds the QR codes.
+    """
+    permission_classes = [permissions.IsAdminUser]
+
+    def get(self, request, *args, **kwargs):
+        peers = WireguardPeer.objects.all()
+        filters = {'user': 'userpeer__user__telegram_id', 'interface': 'interface_ip__interface__name',
+                   'tariff': 'userpeer__user__tariff'}
+        names = []
+        for param, lookup in filters.items():
+            value = request.query_params.get(param)
+            if value:
+                if param == 'tariff' and not value.isdigit():
+                    return Response(status=status.HTTP_400_BAD_REQUEST)
+                peers = peers.filter(**{lookup: value})
+                names.append(f'{param}-{value}')
+        return configs_zip_response(peers, filename='-'.join(names) or 'configs',
+                                    qr=request.query_params.get('qr') in ('1', 'true'))
+
+
 class DNSListApiView(APIView):
     permission_classes = [permissions.IsAuthenticated]
 
@@ -143,3 +170,27 @@ class AllowedNetworksListApiView(APIView):
         serializer = AllowedNetworksSerializer(allowed_networks, many=True)
         return Response(serializer.data, status=status.HTTP_200_OK)
 
+
+class PaymentNotificationApiView(APIView):
+    """
+    Receive the payment notifications of a gateway, e.g. ``payments/YO/notification/`` for YooMoney.
+
+    Notifications are authenticated by their signature, a notification delivered twice
+    is stored once.
+    """
+    authentication_classes = []
+    permission_classes = [permissions.AllowAny]
+
+    def post(self, request, gateway, *args, **kwargs):
+        from billing.tasks import notify_payments
+
+        gateway = get_object_or_404(PaymentGateway, name=gateway.upper())
+        try:
+            payments = ingest_notification(gateway, request.data, keep_unknown=PAYMENTS_ALL)
+        except NotificationException as e:
+            return Response({'detail': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        except GatewayException as e:
+            # the gateway delivers the notification again, and the poller catches up anyway
+            return Response({'detail': str(e)}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        notify_payments(payments)
+        return Response(status=status.HTTP_200_OK)
@@ -2,9 +2,9 @@ from django.core.management.base import BaseCommand
 from django.utils.translation import gettext_lazy as _
 from telebot import TeleBot, types
 import json
-import qrcode
 
 from bot.models import Bot
+from django_wireguard.qr import submit_qr_png
 from bot.settings import PHONE_NUMBER, CURRENCY, TELEGRAM_USERBOT_TOKEN, TELEGRAM_ADMINBOT_TOKEN, TELEGRAM_ADMIN_ID
 
 
@@ -208,21 +208,9 @@ def query_handler(call):
                 # Download Config
                 elif sending_data['type'] == 'd_c':
                     config = Bot.get_config(call.message.chat.id, sending_data['peer_n'])
-                    name_config = config['name']
-                    text = config['config']
-                    qr = qrcode.QRCode(
-                        version=None,
-                        error_correction=qrcode.constants.ERROR_CORRECT_L,
-                        box_size=10,
-                        border=4,
-                    )
-                    qr.add_data(text)
-                    qr.make(fit=True)
-                    img = qr.make_image(fill_color="black", back_color="white")
-                    img.save(f"qr/{name_config}.png")
-                    file = text.encode('utf-8')
-                    bot.send_photo(call.message.chat.id, open(f"qr/{name_config}.png", "rb"), caption=f'{name_config}.conf')
-                    bot.send_document(call.message.chat.id, document=file, visible_file_name=f'{name_config}.conf')
+                    # the QR code is rendered and sent from the worker pool, the polling goes on
+                    submit_qr_png(config['config']).add_done_callback(
+                        lambda future, chat_id=call.message.chat.id: send_config(chat_id, config, future))
                 # Update Config
                 elif sending_data['type'] == 'u_c':
                     peer = Bot.get_peer(sending_data['peer_n'])
@@ -261,3 +249,13 @@ def query_handler(call):
         from_user = f'{call.message.chat.id} - {call.message.chat.first_name} ' \
                     f'{call.message.chat.last_name} {call.message.chat.username}'
         adminbot.send_message(TELEGRAM_ADMIN_ID,f'{from_user}\n{call.message.text}\n[ERROR] - {e}'[:1000])
+
+
+def send_config(chat_id, config, future):
+    name_config = config['name']
+    try:
+        bot.send_photo(chat_id, future.result(), caption=f'{name_config}.conf')
+        bot.send_document(chat_id, document=config['config'].encode('utf-8'),
+                          visible_file_name=f'{name_config}.conf')
+    except Exception as e:
+        adminbot.send_message(TELEGRAM_ADMIN_ID, f'{chat_id}\n{name_config}.conf\n[ERROR] - {e}'[:1000])
@@ -15,5 +15,21 @@ app.conf.beat_schedule = {
         'task': 'billing.tasks.block_or_notification_user',
         'schedule': crontab(hour='12', minute='0'),
     },
+    'refill_wireguard_pool': {
+        'task': 'django_wireguard.tasks.refill_pool',
+        'schedule': crontab(minute='*/5'),
+    },
+    'sample_wireguard_traffic': {
+        'task': 'django_wireguard.tasks.sample_traffic',
+        'schedule': crontab(minute='*/1'),
+    },
+    'apply_wireguard_intents': {
+        'task': 'django_wireguard.tasks.apply_kernel_intents',
+        'schedule': crontab(minute='*/1'),
+    },
+    'prune_wireguard_traffic': {
+        'task': 'django_wireguard.tasks.prune_traffic',
+        'schedule': crontab(hour='4', minute='30'),
+    },
 }
 app.autodiscover_tasks()
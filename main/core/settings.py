@@ -135,6 +135,13 @@ REST_FRAMEWORK = {
     ]
 }
 
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': 'redis://redis:6379/1',
+    }
+}
+
 CELERY_BROKER_URL = 'redis://redis:6379'
 CELERY_RESULT_BACKEND = 'redis://redis:6379'
 CELERY_ACCEPT_CONTENT = ['application/json']
@@ -143,12 +150,19 @@ CELERY_RESULT_SERIALIZER = 'json'
 
 WIREGUARD_ENDPOINT = os.environ.get('WIREGUARD_ENDPOINT')
 WIREGUARD_OUTPUT_INTERFACE = os.environ.get('WIREGUARD_OUTPUT_INTERFACE')
+WIREGUARD_SHAPING = bool(int(os.environ.get('WIREGUARD_SHAPING', '0')))
+WIREGUARD_AGENT_URL = os.environ.get('WIREGUARD_AGENT_URL')
+WIREGUARD_AGENT_TOKEN = os.environ.get('WIREGUARD_AGENT_TOKEN')
+WIREGUARD_RATE_LIMITS_PROVIDER = 'billing.models.get_peer_rate_limits'
 TELEGRAM_USERBOT_TOKEN = os.environ.get('TELEGRAM_USERBOT_TOKEN')
 TELEGRAM_ADMINBOT_TOKEN = os.environ.get('TELEGRAM_ADMINBOT_TOKEN')
 TELEGRAM_ADMIN_ID = os.environ.get('TELEGRAM_ADMIN_ID')
 PHONE_NUMBER = os.environ.get('PHONE_NUMBER')
 PAYMENTS_ALL = bool(int(os.environ.get('PAYMENTS_ALL')))
 PAYMENTS_START_TIME = os.environ.get('PAYMENTS_START_TIME')
+PAYMENTS_YOOMONEY_URL = os.environ.get('PAYMENTS_YOOMONEY_URL', 'https://yoomoney.ru/api/operation-history')
+PAYMENTS_YOOMONEY_DETAILS_URL = os.environ.get('PAYMENTS_YOOMONEY_DETAILS_URL',
+                                               'https://yoomoney.ru/api/operation-details')
 URL_API = os.environ.get('URL_API')
 WEB_LOGIN = os.environ.get('WEB_LOGIN')
 WEB_PASSWORD = os.environ.get('WEB_PASSWORD')
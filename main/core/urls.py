@@ -19,4 +19,5 @@ from django.urls import path, include
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/', include('billing.urls')),
+    path('api/wireguard/', include('django_wireguard.urls')),
 ]
@@ -2,7 +2,9 @@ from django.contrib import admin
 from django.utils.safestring import mark_safe
 
 from django_wireguard.models import WireguardPeer, WireguardInterface,\
-    WireguardIPAddress, WireguardAllowedNetworks,WireguardDNS
+    WireguardIPAddress, WireguardAllowedNetworks,WireguardDNS, WireguardNode, WireguardKernelIntent
+from django_wireguard import settings
+from django_wireguard.export import configs_zip_response
 from django_wireguard.forms import WireguardPeerForm
 
 
@@ -13,14 +15,32 @@ class WireguardIPAddressInline(admin.TabularInline):
 @admin.register(WireguardInterface)
 class WireguardInterfaceAdmin(admin.ModelAdmin):
     model = WireguardInterface
-    list_display = ('name', 'listen_port', 'public_key')
+    list_display = ('name', 'listen_port', 'node', 'public_key')
+    list_select_related = ('node',)
     inlines = (WireguardIPAddressInline,)
+    actions = ('export_configs',)
+
+    @admin.action(description="Export peer configs as ZIP")
+    def export_configs(self, request, queryset):
+        return configs_zip_response(WireguardPeer.objects.filter(interface_ip__interface__in=queryset),
+                                    filename='-'.join(queryset.values_list('name', flat=True)[:3]))
+
+
+@admin.register(WireguardNode)
+class WireguardNodeAdmin(admin.ModelAdmin):
+    model = WireguardNode
+    list_display = ('name', 'endpoint', 'last_seen')
+    readonly_fields = ('last_seen', 'last_errors')
 
 
 @admin.register(WireguardIPAddress)
 class WireguardInterfaceAdmin(admin.ModelAdmin):
     model = WireguardIPAddress
-    list_display = ('name', 'address', 'interface')
+    list_display = ('name', 'address', 'interface', 'free_addresses')
+    list_select_related = ('interface',)
+
+    def free_addresses(self, obj):
+        return obj.get_free_address_count()
 
 
 @admin.register(WireguardPeer)
@@ -30,6 +50,16 @@ class WireguardPeerAdmin(admin.ModelAdmin):
     change_form_template = 'django_wireguard/wireguardpeer_change_form.html'
     list_display = ('name', 'address', 'status', 'is_active')
     list_filter = ()
+    list_select_related = ('interface_ip__interface',)
+    actions = ('export_configs', 'export_configs_with_qr')
+
+    @admin.action(description="Export configs as ZIP")
+    def export_configs(self, request, queryset):
+        return configs_zip_response(queryset)
+
+    @admin.action(description="Export configs and QR codes as ZIP")
+    def export_configs_with_qr(self, request, queryset):
+        return configs_zip_response(queryset, qr=True)
 
     def is_active(self, obj):
         return obj.is_active
@@ -40,6 +70,10 @@ class WireguardPeerAdmin(admin.ModelAdmin):
         return mark_safe(f'<pre>{obj.get_config()}</pre>')
     config.short_description = 'Config'
 
+    def change_view(self, request, object_id, form_url='', extra_context=None):
+        extra_context = {'qr_svg': settings.WIREGUARD_ADMIN_QR_SVG, **(extra_context or {})}
+        return super().change_view(request, object_id, form_url, extra_context)
+
 
 @admin.register(WireguardAllowedNetworks)
 class WireguardAllowedNetworksAdmin(admin.ModelAdmin):
@@ -49,3 +83,24 @@ class WireguardAllowedNetworksAdmin(admin.ModelAdmin):
 @admin.register(WireguardDNS)
 class WireguardDNSAdmin(admin.ModelAdmin):
     list_display = ('name', 'addresses')
+
+
+@admin.register(WireguardKernelIntent)
+class WireguardKernelIntentAdmin(admin.ModelAdmin):
+    list_display = ('interface_name', 'kind', 'public_key', 'attempts', 'next_attempt_at', 'is_failed')
+    list_filter = ('interface_name', 'kind')
+    readonly_fields = ('interface_name', 'kind', 'public_key', 'address', 'created_at', 'attempts',
+                       'next_attempt_at', 'last_error')
+    actions = ('retry_intents',)
+
+    @admin.action(description="Retry the selected intents")
+    def retry_intents(self, request, queryset):
+        queryset.retry()
+
+    def is_failed(self, obj):
+        return obj.is_failed
+
+    is_failed.boolean = True
+
+    def has_add_permission(self, request):
+        return False
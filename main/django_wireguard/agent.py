@@ -0,0 +1,129 @@
+"""
+Node agent, run by the ``wireguard_agent`` command on every WireGuard server of a node.
+
+Each cycle pulls the desired state of the node interfaces from the control plane,
+reconciles the kernel with it, then reports the peer counters and handshakes.
+The agent needs no database: a lost cycle is caught up by the next one.
+"""
+import json
+from time import monotonic, sleep
+from typing import List, Optional
+from urllib.error import URLError
+from urllib.request import Request, urlopen
+
+from django_wireguard import settings
+from django_wireguard.reconcile import DesiredInterface, ReconcilePlan, reconcile_interfaces
+from django_wireguard.wireguard import WireGuard
+
+
+__all__ = ('AgentException', 'HttpTransport', 'LocalTransport', 'NodeAgent')
+
+
+class AgentException(Exception):
+    """
+    Exception raised when the control plane could not be reached.
+    """
+
+
+class HttpTransport:
+    """
+    Talk to the control plane API with the node token.
+
+    :param url: base URL of the API, e.g. ``https://vpn.example.com/api/wireguard/``
+    :param token: node token
+    :param timeout: request timeout in seconds, defaults to ``WIREGUARD_AGENT_TIMEOUT``
+    """
+
+    def __init__(self, url: str, token: str, timeout: Optional[float] = None):
+        self.url = url.rstrip('/') + '/'
+        self.token = token
+        self.timeout = timeout or settings.WIREGUARD_AGENT_TIMEOUT
+
+    def _request(self, path: str, data: Optional[dict] = None) -> dict:
+        request = Request(self.url + path,
+                          data=json.dumps(data).encode() if data is not None else None,
+                          headers={'Authorization': f'Token {self.token}',
+                                   'Content-Type': 'application/json',
+                                   'Accept': 'application/json'})
+        try:
+            with urlopen(request, timeout=self.timeout) as response:
+                return json.loads(response.read() or b'{}')
+        except (URLError, OSError, ValueError) as e:
+            raise AgentException(f"{request.get_method()} {request.full_url} failed: {e}")
+
+    def get_state(self) -> dict:
+        return self._request('node/state/')
+
+    def send_report(self, report: dict) -> dict:
+        return self._request('node/report/', report)
+
+
+class LocalTransport:
+    """
+    Call the control plane in process, for a node sharing the database.
+
+    :param node: WireguardNode
+    """
+
+    def __init__(self, node):
+        self.node = node
+
+    def get_state(self) -> dict:
+        from django_wireguard.nodes import get_desired_state
+
+        return get_desired_state(self.node)
+
+    def send_report(self, report: dict) -> dict:
+        from django_wireguard.nodes import record_node_report
+
+        return {'peers': record_node_report(self.node, report)}
+
+
+class NodeAgent:
+    """
+    :param transport: HttpTransport or LocalTransport
+    :param dry_run: only compute the plans, without touching the kernel
+    """
+
+    def __init__(self, transport, dry_run: bool = False):
+        self.transport = transport
+        self.dry_run = dry_run
+
+    def run_once(self) -> List[ReconcilePlan]:
+        """
+        Pull, reconcile and report once.
+
+        :return: the plan of each interface
+        """
+        state = self.transport.get_state()
+        interfaces = [DesiredInterface.from_dict(interface) for interface in state.get('interfaces', ())]
+        plans = reconcile_interfaces(interfaces, dry_run=self.dry_run)
+        report = {'interfaces': {}, 'errors': {}}
+        for plan in plans:
+            if plan.errors:
+                report['errors'][plan.interface_name] = [repr(error) for error in plan.errors]
+            wg = WireGuard.get_interface(plan.interface_name)
+            if wg is not None:
+                report['interfaces'][plan.interface_name] = [
+                    [peer.public_key, peer.rx_bytes, peer.tx_bytes, peer.latest_handshake]
+                    for peer in wg.iter_peers()]
+        self.transport.send_report(report)
+        return plans
+
+    def run(self, interval: Optional[float] = None, callback=None):
+        """
+        Run cycles forever, ``interval`` seconds apart.
+
+        :param interval: seconds between cycle starts, defaults to ``WIREGUARD_AGENT_INTERVAL``
+        :param callback: called with the plans or the exception of each cycle
+        """
+        interval = interval or settings.WIREGUARD_AGENT_INTERVAL
+        while True:
+            start = monotonic()
+            try:
+                result = self.run_once()
+            except Exception as e:
+                result = e
+            if callback is not None:
+                callback(result)
+            sleep(max(interval - (monotonic() - start), 0))
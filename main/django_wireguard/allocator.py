@@ -0,0 +1,228 @@
+"""
+Per-subnet peer address allocation.
+
+Every :class:`~django_wireguard.models.WireguardIPAddress` stores a bitmap of its subnet,
+one bit per address. Allocating or releasing addresses locks the row, flips the bits and
+writes them back, so concurrent peer creations on a subnet are serialized and never get
+the same address. The bitmap is rebuilt from the peers and the pool when it is missing.
+"""
+import re
+from contextlib import contextmanager
+from ipaddress import IPv4Address, IPv4Interface
+from typing import Iterable, List, Optional
+
+
+__all__ = ('AddressBitmap', 'allocate_addresses', 'reserve_addresses', 'release_addresses',
+           'rebuild_bitmap', 'get_free_address_count')
+
+
+_NOT_FULL = re.compile(rb'[^\xff]')
+
+
+class AddressBitmap:
+    """
+    Allocation bitmap of an IPv4 subnet.
+
+    The network, broadcast and interface addresses are allocated when the bitmap is created.
+
+    :param interface: interface address (IP with CIDR)
+    :param bitmap: stored bitmap, a new one is created if empty
+    :param hint: lowest offset that may be free
+    :param allocated: number of allocated addresses
+    """
+    __slots__ = ('interface', 'network', 'bits', 'hint', 'allocated')
+
+    def __init__(self, interface: str, bitmap: Optional[bytes] = None, hint: int = 0, allocated: int = 0):
+        self.interface = IPv4Interface(interface)
+        self.network = self.interface.network
+        if bitmap:
+            self.bits = bytearray(bitmap)
+            self.hint = hint
+            self.allocated = allocated
+            return
+        size = self.network.num_addresses
+        self.bits = bytearray((size + 7) // 8)
+        self.hint = 0
+        self.allocated = 0
+        # padding of the last byte, never allocated
+        for offset in range(size, len(self.bits) * 8):
+            self.bits[offset // 8] |= 1 << (offset % 8)
+        self.mark(self.interface.ip)
+        if self.network.prefixlen < 31:
+            self.mark(self.network.network_address)
+            self.mark(self.network.broadcast_address)
+
+    @property
+    def free(self) -> int:
+        return self.network.num_addresses - self.allocated
+
+    def _offset(self, address) -> int:
+        offset = int(IPv4Address(address)) - int(self.network.network_address)
+        if not 0 <= offset < self.network.num_addresses:
+            raise ValueError(f"{address} is not in {self.network}")
+        return offset
+
+    def __contains__(self, address) -> bool:
+        offset = self._offset(address)
+        return bool(self.bits[offset // 8] & (1 << (offset % 8)))
+
+    def allocate(self) -> Optional[IPv4Address]:
+        """
+        Allocate the lowest free address.
+
+        :return: the allocated address, None if the subnet is full
+        """
+        match = _NOT_FULL.search(self.bits, self.hint // 8)
+        if match is None:
+            self.hint = len(self.bits) * 8
+            return None
+        index = match.start()
+        byte = self.bits[index]
+        bit = (~byte & (byte + 1)).bit_length() - 1
+        self.bits[index] = byte | (1 << bit)
+        self.allocated += 1
+        offset = index * 8 + bit
+        self.hint = offset + 1
+        return self.network.network_address + offset
+
+    def mark(self, address) -> bool:
+        """
+        Allocate a given address.
+
+        :return: False if the address was already allocated
+        """
+        offset = self._offset(address)
+        mask = 1 << (offset % 8)
+        if self.bits[offset // 8] & mask:
+            return False
+        self.bits[offset // 8] |= mask
+        self.allocated += 1
+        return True
+
+    def release(self, address) -> bool:
+        """
+        Free an address, the network, broadcast and interface addresses stay allocated.
+
+        :return: False if the address was not allocated
+        """
+        address = IPv4Address(address)
+        if address == self.interface.ip or (self.network.prefixlen < 31 and address in (
+                self.network.network_address, self.network.broadcast_address)):
+            return False
+        offset = self._offset(address)
+        mask = 1 << (offset % 8)
+        if not self.bits[offset // 8] & mask:
+            return False
+        self.bits[offset // 8] &= ~mask
+        self.allocated -= 1
+        self.hint = min(self.hint, offset)
+        return True
+
+
+def rebuild_bitmap(interface_ip) -> AddressBitmap:
+    """
+    Build the bitmap of an interface address from its peers and pool entries.
+
+    :param interface_ip: WireguardIPAddress
+    :rtype: AddressBitmap
+    """
+    from django_wireguard.models import WireguardPeer, WireguardPoolEntry
+
+    bitmap = AddressBitmap(interface_ip.address)
+    used = list(WireguardPeer.objects.filter(interface_ip=interface_ip)
+                .exclude(address=None).values_list('address', flat=True))
+    used += WireguardPoolEntry.objects.filter(interface_ip=interface_ip).values_list('address', flat=True)
+    for address in used:
+        try:
+            bitmap.mark(address)
+        except ValueError:
+            pass
+    return bitmap
+
+
+@contextmanager
+def _locked_bitmap(interface_ip):
+    from django.db import transaction
+    from django_wireguard.models import WireguardIPAddress
+
+    with transaction.atomic():
+        row = (WireguardIPAddress.objects.select_for_update()
+               .only('address', 'address_bitmap', 'address_hint', 'allocated_addresses')
+               .get(pk=interface_ip.pk))
+        if row.address_bitmap:
+            bitmap = AddressBitmap(row.address, bytes(row.address_bitmap), row.address_hint, row.allocated_addresses)
+        else:
+            bitmap = rebuild_bitmap(row)
+        yield bitmap
+        # update() skips the pre_save receiver, nothing to sync with the kernel
+        WireguardIPAddress.objects.filter(pk=row.pk).update(address_bitmap=bytes(bitmap.bits),
+                                                            address_hint=bitmap.hint,
+                                                            allocated_addresses=bitmap.allocated)
+
+
+def allocate_addresses(interface_ip, count: int = 1) -> List[str]:
+    """
+    Allocate free addresses in the subnet of an interface address.
+
+    :param interface_ip: WireguardIPAddress
+    :param count: number of addresses wanted
+    :return: up to ``count`` addresses, fewer if the subnet is full
+    """
+    addresses = []
+    with _locked_bitmap(interface_ip) as bitmap:
+        while len(addresses) < count:
+            address = bitmap.allocate()
+            if address is None:
+                break
+            addresses.append(str(address))
+    return addresses
+
+
+def reserve_addresses(interface_ip, addresses: Iterable[str]) -> List[str]:
+    """
+    Allocate given addresses, e.g. set by hand on a peer.
+
+    :param interface_ip: WireguardIPAddress
+    :param addresses: addresses to allocate, the ones outside of the subnet are ignored
+    :return: the addresses that were already allocated
+    """
+    taken = []
+    with _locked_bitmap(interface_ip) as bitmap:
+        for address in addresses:
+            try:
+                if not bitmap.mark(address):
+                    taken.append(address)
+            except ValueError:
+                pass
+    return taken
+
+
+def release_addresses(interface_ip, addresses: Iterable[str]):
+    """
+    Free addresses of an interface address subnet.
+
+    :param interface_ip: WireguardIPAddress
+    :param addresses: addresses to free, the ones outside of the subnet are ignored
+    """
+    addresses = [address for address in addresses if address]
+    if not addresses:
+        return
+    with _locked_bitmap(interface_ip) as bitmap:
+        for address in addresses:
+            try:
+                bitmap.release(address)
+            except ValueError:
+                pass
+
+
+def get_free_address_count(interface_ip) -> int:
+    """
+    Number of free addresses in the subnet of an interface address, read without writing.
+
+    :param interface_ip: WireguardIPAddress
+    :rtype: int
+    """
+    if interface_ip.address_bitmap:
+        return IPv4Interface(interface_ip.address).network.num_addresses - interface_ip.allocated_addresses
+    # the missing bitmap is only stored by the next allocation, which holds the row lock
+    return rebuild_bitmap(interface_ip).free
@@ -0,0 +1,125 @@
+"""
+Rendered peer configurations, cached by config version.
+
+Every :class:`~django_wireguard.models.WireguardPeer` stores a ``config_version`` token,
+replaced whenever something its configuration depends on changes: the peer itself,
+its interface or node, or a shared :class:`~django_wireguard.models.WireguardDNS` or
+:class:`~django_wireguard.models.WireguardAllowedNetworks` row. The token is part of the
+cache key, so stale configs are never invalidated one by one: they are no longer read
+and expire.
+
+A cache hit costs no query, :func:`get_configs` renders the misses of many peers
+with a single query.
+"""
+import secrets
+import zlib
+from typing import Dict, Iterable
+
+from django.core.cache import caches
+from django.utils.translation import get_language, gettext as _
+
+from django_wireguard import settings
+
+
+__all__ = ('new_config_version', 'invalidate_configs', 'render_config', 'get_config', 'get_configs')
+
+
+def new_config_version() -> str:
+    return secrets.token_hex(8)
+
+
+def invalidate_configs(queryset) -> int:
+    """
+    Replace the config version of peers.
+
+    :param queryset: WireguardPeers whose configuration changed
+    :return: number of updated peers
+    """
+    # update() skips the peer pre_save receiver, nothing to sync with the kernel
+    return queryset.update(config_version=new_config_version())
+
+
+def _cache():
+    return caches[settings.WIREGUARD_CONFIG_CACHE]
+
+
+def _cache_key(peer) -> str:
+    # the default endpoint and the private key placeholder do not depend on the database
+    endpoint = zlib.crc32(str(settings.WIREGUARD_ENDPOINT).encode())
+    return f"wireguard:config:{peer.pk}:{peer.config_version}:{endpoint:x}:{get_language() or ''}"
+
+
+def render_config(peer) -> str:
+    """
+    Generate WireGuard configuration for peer as string.
+
+    :param peer: WireguardPeer, with ``interface_ip__interface__node``, ``dns`` and
+        ``allowed_networks`` selected to save queries
+    :return: Peer configuration as string.
+    """
+    private_key = peer.private_key or _(
+        '<INSERT-PRIVATE-KEY-FOR:%(pubkey)s>') % {'pubkey': peer.public_key}
+
+    config = f"[Interface]\n" \
+             f"Address={peer.address}/32\n" \
+             f"PrivateKey={private_key}\n"
+
+    if peer.dns:
+        config += f"DNS={peer.get_clean_dns()}\n"
+
+    config += f"[Peer]\n" \
+              f"Endpoint={peer.interface_ip.interface.get_endpoint()}\n" \
+              f"PublicKey={peer.interface_ip.interface.get_public_key()}\n" \
+              f"PresharedKey={peer.preshared_key}\n"
+    if peer.allowed_networks:
+        config += f"AllowedIPs={peer.allowed_networks.get_clean_allowed_networks()}\n"
+    else:
+        config += f"AllowedIPs=0.0.0.0/0\n"
+    if peer.persistent_keepalive:
+        config += f"PersistentKeepalive={peer.persistent_keepalive}\n"
+
+    return config
+
+
+def get_config(peer) -> str:
+    """
+    Cached configuration of a peer.
+
+    :param peer: saved WireguardPeer
+    :return: Peer configuration as string.
+    """
+    if not peer.pk or not peer.config_version:
+        return render_config(peer)
+    key = _cache_key(peer)
+    config = _cache().get(key)
+    if config is None:
+        config = render_config(peer)
+        _cache().set(key, config, settings.WIREGUARD_CONFIG_CACHE_TIMEOUT)
+    return config
+
+
+def get_configs(peers: Iterable) -> Dict[int, str]:
+    """
+    Cached configurations of many peers, the misses are rendered from one query.
+
+    :param peers: WireguardPeers or a queryset of them
+    :return: configuration by peer primary key
+    """
+    from django_wireguard.models import WireguardPeer
+
+    peers = list(peers)
+    keys = {_cache_key(peer): peer.pk for peer in peers if peer.config_version}
+    configs = {keys[key]: config for key, config in _cache().get_many(keys).items()}
+    missing = [peer.pk for peer in peers if peer.pk not in configs]
+    if not missing:
+        return configs
+
+    rendered = {}
+    for peer in (WireguardPeer.objects
+                 .filter(pk__in=missing)
+                 .select_related('interface_ip__interface__node', 'dns', 'allowed_networks')):
+        configs[peer.pk] = render_config(peer)
+        if peer.config_version:
+            rendered[_cache_key(peer)] = configs[peer.pk]
+    _cache().set_many(rendered, settings.WIREGUARD_CONFIG_CACHE_TIMEOUT)
+    return configs
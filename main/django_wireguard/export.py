@@ -0,0 +1,92 @@
+"""
+Streaming ZIP export of peer configurations.
+
+The archive is written to a non-seekable buffer that is drained after every member,
+so the response starts at once and memory stays flat whatever the number of peers.
+Peers are read with one query, fetched in chunks by a server-side cursor, and the
+configurations of a chunk are read from the cache at once, see :func:`~django_wireguard.configs.get_configs`.
+"""
+import zipfile
+from itertools import islice
+from typing import Iterator
+
+from django.http import StreamingHttpResponse
+from django.utils.text import slugify
+
+from django_wireguard.configs import get_configs
+from django_wireguard.qr import render_qr_png
+
+
+__all__ = ('iter_configs_zip', 'configs_zip_response')
+
+
+_CHUNK_SIZE = 500
+
+
+class _StreamBuffer:
+    """
+    Write-only file object, :mod:`zipfile` falls back on data descriptors when it cannot seek.
+    """
+
+    def __init__(self):
+        self._chunks = []
+        self._offset = 0
+
+    def write(self, data: bytes) -> int:
+        self._chunks.append(bytes(data))
+        self._offset += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._offset
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def iter_configs_zip(queryset, qr: bool = False) -> Iterator[bytes]:
+    """
+    Yield a ZIP archive of peer configurations, one ``.conf`` and optionally one QR ``.png`` per peer.
+
+    :param queryset: WireguardPeers to export
+    :param qr: include the QR codes
+    :return: iterator of archive chunks
+    """
+    buffer = _StreamBuffer()
+    peers = (queryset
+             .select_related('interface_ip__interface')
+             .only('name', 'config_version', 'interface_ip__interface__name')
+             .order_by('pk')
+             .iterator(chunk_size=_CHUNK_SIZE))
+    with zipfile.ZipFile(buffer, mode='w', compression=zipfile.ZIP_DEFLATED) as archive:
+        for chunk in iter(lambda: list(islice(peers, _CHUNK_SIZE)), []):
+            # the cache misses of a chunk are rendered from one query
+            configs = get_configs(chunk)
+            for peer in chunk:
+                name = f"{peer.interface_ip.interface.name}/{slugify(peer.name) or 'peer'}-{peer.pk}"
+                config = configs[peer.pk]
+                archive.writestr(f"{name}.conf", config)
+                if qr:
+                    # PNG data is already compressed
+                    archive.writestr(f"{name}.png", render_qr_png(config), compress_type=zipfile.ZIP_STORED)
+                yield buffer.drain()
+    yield buffer.drain()
+
+
+def configs_zip_response(queryset, filename: str = 'configs', qr: bool = False) -> StreamingHttpResponse:
+    """
+    Stream a ZIP archive of peer configurations as an attachment.
+
+    :param queryset: WireguardPeers to export
+    :param filename: archive name, without extension
+    :param qr: include the QR codes
+    :rtype: StreamingHttpResponse
+    """
+    response = StreamingHttpResponse(iter_configs_zip(queryset, qr=qr), content_type='application/zip')
+    response['Content-Disposition'] = f'attachment; filename="{slugify(filename) or "configs"}.zip"'
+    return response
@@ -0,0 +1,291 @@
+"""
+Firewall rules for WireGuard interfaces.
+
+Every interface gets its own chains and named address sets, so that:
+
+* isolating the interface subnets from each other costs one rule per subnet;
+* the whole ruleset of an interface is replaced in a single atomic transaction;
+* tearing an interface down only flushes and drops its own chains.
+
+Two backends are available, selected with ``WIREGUARD_FIREWALL_BACKEND``:
+
+* ``iptables``: ``ipset`` sets swapped in place, chains loaded with ``iptables-restore --noflush``;
+* ``nftables``: one ``nft -f`` transaction on the ``django_wireguard`` table.
+"""
+import subprocess
+from ipaddress import IPv4Interface, IPv4Network
+from typing import List, Iterable, Optional, Tuple
+
+from django_wireguard import settings
+
+
+__all__ = ('FirewallException', 'InterfaceRules', 'Firewall',
+           'IptablesFirewall', 'NftablesFirewall', 'get_firewall')
+
+
+class FirewallException(Exception):
+    """
+    Exception raised when the firewall ruleset could not be applied.
+    """
+
+
+class InterfaceRules:
+    """
+    Desired firewall state of a WireGuard interface.
+
+    :param interface_name: WireGuard interface name
+    :param listen_port: UDP port the interface listens on
+    :param addresses: interface addresses (IP with CIDR), their networks are NATed and isolated
+    :param output_interface: interface the peers traffic is masqueraded to
+    :param rejected_networks: networks the peers must not reach
+    """
+    __slots__ = ('interface_name', 'listen_port', 'networks', 'output_interface', 'rejected_networks')
+
+    def __init__(self, interface_name: str, listen_port: int, addresses: Iterable[str],
+                 output_interface: Optional[str] = None,
+                 rejected_networks: Optional[Iterable[str]] = None):
+        self.interface_name = interface_name
+        self.listen_port = listen_port
+        networks = []
+        for address in addresses:
+            network = str(IPv4Interface(address).network)
+            if network not in networks:
+                networks.append(network)
+        self.networks = networks
+        self.output_interface = output_interface or settings.WIREGUARD_OUTPUT_INTERFACE
+        if rejected_networks is None:
+            rejected_networks = settings.WIREGUARD_FIREWALL_REJECTED_NETWORKS
+        self.rejected_networks = [str(IPv4Network(network)) for network in rejected_networks]
+
+
+class Firewall:
+    """
+    Base firewall backend.
+
+    Subclasses return the backend tool invocations applying or removing the rules
+    of an interface, as ``(command, script)`` pairs fed to the tool's stdin.
+    """
+    name = None
+
+    def commands(self, rules: InterfaceRules, live: bool = True) -> List[Tuple[List[str], str]]:
+        """
+        Commands replacing the ruleset of an interface.
+
+        :param rules: interface firewall state
+        :param live: whether the current system state may be inspected
+        :rtype: list
+        """
+        raise NotImplementedError
+
+    def teardown_commands(self, interface_name: str, live: bool = True) -> List[Tuple[List[str], str]]:
+        """
+        Commands removing the chains and sets of an interface.
+
+        :param interface_name: WireGuard interface name
+        :param live: whether the current system state may be inspected
+        :rtype: list
+        """
+        raise NotImplementedError
+
+    def apply(self, rules: InterfaceRules, dry_run: bool = False) -> str:
+        """
+        Atomically replace the ruleset of an interface.
+
+        :param rules: interface firewall state
+        :param dry_run: only render the ruleset
+        :return: the rendered ruleset
+        :rtype: str
+        """
+        return self._execute(lambda live: self.commands(rules, live), dry_run)
+
+    def teardown(self, interface_name: str, dry_run: bool = False) -> str:
+        """
+        Remove the chains and sets of an interface.
+
+        :param interface_name: WireGuard interface name
+        :param dry_run: only render the commands
+        :return: the rendered commands
+        :rtype: str
+        """
+        return self._execute(lambda live: self.teardown_commands(interface_name, live), dry_run)
+
+    @staticmethod
+    def _execute(get_commands, dry_run: bool) -> str:
+        dry_run = dry_run or settings.WIREGUARD_FIREWALL_DRY_RUN
+        commands = get_commands(not dry_run)
+        if not dry_run:
+            for command, script in commands:
+                try:
+                    subprocess.run(command, input=script, text=True, check=True,
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                except subprocess.CalledProcessError as e:
+                    raise FirewallException(f"{' '.join(command)} failed: {e.stderr.strip()}")
+                except OSError as e:
+                    raise FirewallException(f"{' '.join(command)} failed: {e}")
+        return ''.join(f"# {' '.join(command)}\n{script}" for command, script in commands)
+
+
+class NftablesFirewall(Firewall):
+    """
+    nftables backend.
+
+    Each interface owns base chains in the ``ip django_wireguard`` table.
+    Accepting in these chains does not override a drop policy set with iptables,
+    use this backend on hosts whose forwarding policy is managed by nftables.
+    """
+    name = 'nftables'
+    table = 'ip django_wireguard'
+
+    def _declare(self, name: str) -> List[str]:
+        table = self.table
+        return [
+            f"add table {table}",
+            f"add set {table} {name}_networks {{ type ipv4_addr; flags interval; auto-merge; }}",
+            f"add set {table} {name}_rejected {{ type ipv4_addr; flags interval; auto-merge; }}",
+            f"add chain {table} {name}_forward {{ type filter hook forward priority 0; policy accept; }}",
+            f"add chain {table} {name}_input {{ type filter hook input priority 0; policy accept; }}",
+            f"add chain {table} {name}_postrouting {{ type nat hook postrouting priority 100; policy accept; }}",
+            f"flush chain {table} {name}_forward",
+            f"flush chain {table} {name}_input",
+            f"flush chain {table} {name}_postrouting",
+            f"flush set {table} {name}_networks",
+            f"flush set {table} {name}_rejected",
+        ]
+
+    def commands(self, rules: InterfaceRules, live: bool = True) -> List[Tuple[List[str], str]]:
+        table, name = self.table, rules.interface_name
+        lines = self._declare(name)
+        if rules.networks:
+            lines.append(f"add element {table} {name}_networks {{ {', '.join(rules.networks)} }}")
+        if rules.rejected_networks:
+            lines.append(f"add element {table} {name}_rejected {{ {', '.join(rules.rejected_networks)} }}")
+        for network in rules.networks:
+            lines.append(f"add rule {table} {name}_forward "
+                         f"ip saddr {network} ip daddr != {network} ip daddr @{name}_networks reject")
+        lines += [
+            f"add rule {table} {name}_forward ip saddr @{name}_networks ip daddr @{name}_rejected reject",
+            f"add rule {table} {name}_forward iifname \"{name}\" accept",
+            f"add rule {table} {name}_forward oifname \"{name}\" accept",
+            f"add rule {table} {name}_input udp dport {rules.listen_port} accept",
+            f"add rule {table} {name}_postrouting "
+            f"ip saddr @{name}_networks oifname \"{rules.output_interface}\" masquerade",
+        ]
+        return [(['nft', '-f', '-'], '\n'.join(lines) + '\n')]
+
+    def teardown_commands(self, interface_name: str, live: bool = True) -> List[Tuple[List[str], str]]:
+        table, name = self.table, interface_name
+        lines = self._declare(name)
+        lines += [
+            f"delete chain {table} {name}_forward",
+            f"delete chain {table} {name}_input",
+            f"delete chain {table} {name}_postrouting",
+            f"delete set {table} {name}_networks",
+            f"delete set {table} {name}_rejected",
+        ]
+        return [(['nft', '-f', '-'], '\n'.join(lines) + '\n')]
+
+
+class IptablesFirewall(Firewall):
+    """
+    iptables backend.
+
+    Address sets are ``ipset`` hash:net sets, refilled through a temporary set
+    and swapped in place. Chains are loaded in one ``iptables-restore --noflush``
+    transaction; declaring a chain in the restore file flushes it.
+    """
+    name = 'iptables'
+
+    @staticmethod
+    def _chains(name: str) -> dict:
+        return {
+            'filter': ((f'WG-{name}-FWD', 'FORWARD'), (f'WG-{name}-IN', 'INPUT')),
+            'nat': ((f'WG-{name}-NAT', 'POSTROUTING'),),
+        }
+
+    @staticmethod
+    def _sets(name: str) -> (str, str):
+        return f'wg-{name}-networks', f'wg-{name}-rejected'
+
+    @staticmethod
+    def _has_jump(table: str, parent: str, chain: str) -> bool:
+        result = subprocess.run(['iptables', '-t', table, '-C', parent, '-j', chain],
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        return result.returncode == 0
+
+    def _render_sets(self, rules: InterfaceRules) -> str:
+        lines = []
+        for ipset, networks in zip(self._sets(rules.interface_name), (rules.networks, rules.rejected_networks)):
+            lines += [f"create {ipset} hash:net -exist",
+                      f"create {ipset}-new hash:net -exist",
+                      f"flush {ipset}-new"]
+            lines += [f"add {ipset}-new {network}" for network in networks]
+            lines += [f"swap {ipset}-new {ipset}",
+                      f"destroy {ipset}-new"]
+        return '\n'.join(lines) + '\n'
+
+    def _render_chains(self, rules: InterfaceRules, check_jumps: bool = True) -> str:
+        name = rules.interface_name
+        networks_set, rejected_set = self._sets(name)
+        chains = self._chains(name)
+        (forward, _), (input_, _) = chains['filter']
+        ((nat, _),) = chains['nat']
+        body = {
+            'filter': [
+                *(f"-A {forward} -s {network} -m set --match-set {networks_set} dst "
+                  f"! -d {network} -j REJECT" for network in rules.networks),
+                f"-A {forward} -m set --match-set {networks_set} src "
+                f"-m set --match-set {rejected_set} dst -j REJECT",
+                f"-A {forward} -i {name} -j ACCEPT",
+                f"-A {forward} -o {name} -j ACCEPT",
+                f"-A {input_} -p udp -m udp --dport {rules.listen_port} -j ACCEPT",
+            ],
+            'nat': [
+                f"-A {nat} -m set --match-set {networks_set} src -o {rules.output_interface} -j MASQUERADE",
+            ],
+        }
+        lines = []
+        for table, table_chains in chains.items():
+            lines.append(f"*{table}")
+            lines += [f":{chain} - [0:0]" for chain, _ in table_chains]
+            for chain, parent in table_chains:
+                if not check_jumps or not self._has_jump(table, parent, chain):
+                    lines.append(f"-I {parent} 1 -j {chain}")
+            lines += body[table]
+            lines.append("COMMIT")
+        return '\n'.join(lines) + '\n'
+
+    def _render_chains_teardown(self, name: str, check_jumps: bool = True) -> str:
+        lines = []
+        for table, table_chains in self._chains(name).items():
+            lines.append(f"*{table}")
+            lines += [f":{chain} - [0:0]" for chain, _ in table_chains]
+            for chain, parent in table_chains:
+                if not check_jumps or self._has_jump(table, parent, chain):
+                    lines.append(f"-D {parent} -j {chain}")
+            lines += [f"-X {chain}" for chain, _ in table_chains]
+            lines.append("COMMIT")
+        return '\n'.join(lines) + '\n'
+
+    def commands(self, rules: InterfaceRules, live: bool = True) -> List[Tuple[List[str], str]]:
+        return [(['ipset', 'restore'], self._render_sets(rules)),
+                (['iptables-restore', '--noflush'], self._render_chains(rules, check_jumps=live))]
+
+    def teardown_commands(self, interface_name: str, live: bool = True) -> List[Tuple[List[str], str]]:
+        sets = ''.join(f"create {ipset} hash:net -exist\ndestroy {ipset}\n" for ipset in self._sets(interface_name))
+        return [(['iptables-restore', '--noflush'], self._render_chains_teardown(interface_name, check_jumps=live)),
+                (['ipset', 'restore'], sets)]
+
+
+FIREWALL_BACKENDS = {backend.name: backend for backend in (IptablesFirewall, NftablesFirewall)}
+
+
+def get_firewall() -> Firewall:
+    """
+    Return the firewall backend selected by ``WIREGUARD_FIREWALL_BACKEND``.
+
+    :rtype: Firewall
+    """
+    try:
+        return FIREWALL_BACKENDS[settings.WIREGUARD_FIREWALL_BACKEND]()
+    except KeyError:
+        raise FirewallException(f"Unknown firewall backend {settings.WIREGUARD_FIREWALL_BACKEND}")
@@ -1,25 +1,63 @@
+from time import monotonic
+
 from django.core.management.base import BaseCommand
 
-from django_wireguard.models import WireguardInterface
+from django_wireguard.configs import invalidate_configs
+from django_wireguard.models import WireguardInterface, WireguardPeer
+from django_wireguard.outbox import apply_intents
+from django_wireguard.reconcile import reconcile
+from django_wireguard.wireguard import PrivateKey
 
 
 class Command(BaseCommand):
     help = 'Start WireGuard interfaces'
 
-    def handle(self, *args, **options):
-        for interface in WireguardInterface.objects.all():
-            interface.wg.set_interface(private_key=interface.private_key,
-                                       listen_port=interface.listen_port)
-            interface.wg.set_ip_addresses(interface.get_address_list())
-            self.stderr.write(self.style.SUCCESS(f"Interface started: {interface.name}.\n"))
-            for address in interface.addresses.all():
-                for peer in address.peers.all():
-                    if not peer.status:
-                        continue
-                    # update/create the wireguard peer
-                    interface.wg.set_peer(peer.public_key, peer.preshared_key,
-                                          peer.get_interface_allowed_ip())
-                    self.stderr.write(self.style.SUCCESS(f"Peer added successfully: {peer.name}.\n"))
-
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Print the changes without applying them')
+        parser.add_argument('--report', action='store_true',
+                            help='Print the changes and the time spent on each interface')
+        parser.add_argument('--workers', type=int, default=None,
+                            help='Number of interfaces processed in parallel')
 
+    def handle(self, *args, **options):
+        start = monotonic()
+        if not options['dry_run']:
+            self.fill_public_keys()
+        plans = reconcile(WireguardInterface.objects.local(), dry_run=options['dry_run'], workers=options['workers'],
+                          rebuild_shaping=True)
+        for plan in plans:
+            if plan.errors:
+                for error in plan.errors:
+                    self.stderr.write(self.style.ERROR(f"Interface {plan.interface_name} failed: {error!r}\n"))
+            elif options['dry_run'] or options['report']:
+                self.stdout.write(f"{plan.summary()} ({plan.duration * 1000:.1f} ms)\n")
+            else:
+                self.stderr.write(self.style.SUCCESS(f"Interface started: {plan.interface_name}.\n"))
+            if options['dry_run'] and options['report']:
+                for peer in plan.peers_to_add:
+                    self.stdout.write(f"  + {peer['public_key']} {','.join(peer['allowed_ips'])}\n")
+                for peer in plan.peers_to_update:
+                    self.stdout.write(f"  ~ {peer['public_key']} {','.join(peer['allowed_ips'])}\n")
+                for public_key in plan.peers_to_remove:
+                    self.stdout.write(f"  - {public_key}\n")
+                self.stdout.write(plan.firewall)
+                self.stdout.write(plan.shaping)
+        if not options['dry_run']:
+            # changes committed while the interfaces were down
+            for error in apply_intents():
+                self.stderr.write(self.style.ERROR(f"Kernel update failed, retried later: {error!r}\n"))
+        if options['report']:
+            self.stdout.write(f"{len(plans)} interfaces reconciled in {monotonic() - start:.2f} s\n")
 
+    def fill_public_keys(self):
+        interfaces = list(WireguardInterface.objects.filter(public_key=None).exclude(private_key=''))
+        for interface in interfaces:
+            WireguardInterface.objects.filter(pk=interface.pk).update(
+                public_key=str(PrivateKey(interface.private_key).public_key()))
+        if interfaces:
+            # update() skips the receivers, the configs cached meanwhile are replaced here
+            invalidate_configs(WireguardPeer.objects.filter(interface_ip__interface__in=interfaces))
+        filled = WireguardPeer.objects.fill_public_keys()
+        if filled:
+            self.stderr.write(self.style.SUCCESS(f"Stored the public key of {filled} peers.\n"))
@@ -8,7 +8,7 @@ class Command(BaseCommand):
     help = 'Start WireGuard interfaces'
 
     def handle(self, *args, **options):
-        for interface in WireguardInterface.objects.all():
+        for interface in WireguardInterface.objects.local():
             interface.wg.delete()
             interface_deleted.send(WireguardInterface, instance=interface)
 
@@ -0,0 +1,53 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from django_wireguard import settings
+from django_wireguard.agent import AgentException, HttpTransport, LocalTransport, NodeAgent
+from django_wireguard.models import WireguardNode
+
+
+class Command(BaseCommand):
+    help = 'Run the agent of a WireGuard node: pull its interfaces from the control plane and report their peers'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default=settings.WIREGUARD_AGENT_URL,
+                            help='Base URL of the control plane node API')
+        parser.add_argument('--token', default=settings.WIREGUARD_AGENT_TOKEN,
+                            help='Node token')
+        parser.add_argument('--node', default=None,
+                            help='Name of the node, read from the local database instead of the API')
+        parser.add_argument('--interval', type=float, default=settings.WIREGUARD_AGENT_INTERVAL,
+                            help='Seconds between two cycles')
+        parser.add_argument('--once', action='store_true',
+                            help='Run a single cycle and exit')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Print the changes without applying them')
+
+    def handle(self, *args, **options):
+        if options['node']:
+            try:
+                transport = LocalTransport(WireguardNode.objects.get(name=options['node']))
+            except WireguardNode.DoesNotExist:
+                raise CommandError(f"Unknown node {options['node']}")
+        elif options['url'] and options['token']:
+            transport = HttpTransport(options['url'], options['token'])
+        else:
+            raise CommandError("Set --url and --token, or --node")
+
+        agent = NodeAgent(transport, dry_run=options['dry_run'])
+        if options['once']:
+            try:
+                self.report(agent.run_once())
+            except AgentException as e:
+                raise CommandError(str(e))
+        else:
+            agent.run(options['interval'], callback=self.report)
+
+    def report(self, result):
+        if isinstance(result, Exception):
+            self.stderr.write(self.style.ERROR(f"Agent cycle failed: {result!r}\n"))
+            return
+        for plan in result:
+            for error in plan.errors:
+                self.stderr.write(self.style.ERROR(f"Interface {plan.interface_name} failed: {error!r}\n"))
+            if not plan.errors and not plan.is_empty():
+                self.stdout.write(f"{plan.summary()} ({plan.duration * 1000:.1f} ms)\n")
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+
+from django_wireguard.firewall import FirewallException
+from django_wireguard.models import WireguardInterface
+
+
+class Command(BaseCommand):
+    help = 'Apply the firewall rules of WireGuard interfaces'
+
+    def add_arguments(self, parser):
+        parser.add_argument('interfaces', nargs='*', help='Interface names, all interfaces if omitted')
+        parser.add_argument('--dry-run', action='store_true', help='Print the rules instead of applying them')
+        parser.add_argument('--teardown', action='store_true', help='Remove the rules instead of applying them')
+
+    def handle(self, *args, **options):
+        interfaces = WireguardInterface.objects.local()
+        if options['interfaces']:
+            interfaces = interfaces.filter(name__in=options['interfaces'])
+        for interface in interfaces:
+            try:
+                if options['teardown']:
+                    script = interface.remove_firewall(dry_run=options['dry_run'])
+                else:
+                    script = interface.apply_firewall(dry_run=options['dry_run'])
+            except FirewallException as e:
+                self.stderr.write(self.style.ERROR(f"Firewall failed for {interface.name}: {e}\n"))
+                continue
+            if options['dry_run']:
+                self.stdout.write(script)
+            else:
+                self.stderr.write(self.style.SUCCESS(f"Firewall applied: {interface.name}.\n"))
@@ -0,0 +1,229 @@
+"""
+Per-peer traffic metering.
+
+:func:`sample_traffic` reads one peer dump per local interface, node agents report theirs,
+and :func:`record_peer_states` turns the kernel counters into deltas. Every dump writes,
+in one transaction per interface:
+
+* one :class:`~django_wireguard.models.WireguardTrafficSample` per peer that exchanged traffic;
+* the :class:`~django_wireguard.models.WireguardPeerTraffic` counters, which also total the current
+  hour and day; these totals are rolled up into hourly and daily samples when the period ends.
+
+Each resolution is complete on its own, usage queries read the finest one still retained
+for the requested period. :func:`prune_traffic` applies the retention settings.
+"""
+from datetime import datetime, timedelta, timezone as dt_timezone
+from typing import Dict, Iterable, Optional, Tuple
+
+from django.db import transaction
+from django.db.models import QuerySet, Sum
+from django.utils import timezone
+
+from django_wireguard import settings
+
+
+__all__ = ('sample_traffic', 'record_peer_states', 'prune_traffic', 'get_traffic_usage', 'get_last_seen')
+
+
+_BATCH_SIZE = 500
+
+_COUNTER_FIELDS = ('rx_counter', 'tx_counter', 'rx_bytes', 'tx_bytes',
+                   'hour_start', 'hour_rx_bytes', 'hour_tx_bytes',
+                   'day_start', 'day_rx_bytes', 'day_tx_bytes', 'last_seen', 'sampled_at')
+
+
+def _periods(now: datetime) -> Tuple[datetime, datetime]:
+    hour = timezone.localtime(now).replace(minute=0, second=0, microsecond=0)
+    return hour, hour.replace(hour=0)
+
+
+def _delta(counter: int, previous: int) -> int:
+    # the kernel counters restart from zero when the interface or the peer is re-created
+    return counter - previous if counter >= previous else counter
+
+
+def _roll_up(traffic, hour: datetime, day: datetime, rollups: list):
+    from django_wireguard.models import WireguardTrafficSample
+
+    if traffic.hour_start != hour:
+        if traffic.hour_start and (traffic.hour_rx_bytes or traffic.hour_tx_bytes):
+            rollups.append(WireguardTrafficSample(peer_id=traffic.peer_id, resolution=WireguardTrafficSample.HOUR,
+                                                  period_start=traffic.hour_start,
+                                                  rx_bytes=traffic.hour_rx_bytes, tx_bytes=traffic.hour_tx_bytes))
+        traffic.hour_start, traffic.hour_rx_bytes, traffic.hour_tx_bytes = hour, 0, 0
+    if traffic.day_start != day:
+        if traffic.day_start and (traffic.day_rx_bytes or traffic.day_tx_bytes):
+            rollups.append(WireguardTrafficSample(peer_id=traffic.peer_id, resolution=WireguardTrafficSample.DAY,
+                                                  period_start=traffic.day_start,
+                                                  rx_bytes=traffic.day_rx_bytes, tx_bytes=traffic.day_tx_bytes))
+        traffic.day_start, traffic.day_rx_bytes, traffic.day_tx_bytes = day, 0, 0
+
+
+def record_peer_states(interface, states: Iterable, now: Optional[datetime] = None) -> int:
+    """
+    Record the traffic of the peers of an interface from a peer dump.
+
+    :param interface: WireguardInterface
+    :param states: PeerStates of the interface peers, from the local kernel or a node agent
+    :param now: dump time, defaults to the current time
+    :return: number of peers of the interface
+    """
+    from django_wireguard.models import WireguardInterface, WireguardPeer, WireguardPeerTraffic, \
+        WireguardTrafficSample
+
+    now = now or timezone.now()
+    live = {state.public_key: state for state in states}
+    peers = dict(WireguardPeer.objects
+                 .filter(interface_ip__interface=interface)
+                 .exclude(public_key=None)
+                 .values_list('public_key', 'pk'))
+    hour, day = _periods(now)
+
+    with transaction.atomic():
+        # one sampler at a time per interface, the deltas depend on the stored counters
+        WireguardInterface.objects.select_for_update().filter(pk=interface.pk).exists()
+        counters = WireguardPeerTraffic.objects.in_bulk(peers.values())
+        samples, created, updated = [], [], []
+        for public_key, peer_id in peers.items():
+            state = live.get(public_key)
+            traffic = counters.get(peer_id)
+            if traffic is None:
+                if state is None:
+                    continue
+                # the first dump only sets the baseline
+                traffic = WireguardPeerTraffic(peer_id=peer_id, rx_counter=state.rx_bytes,
+                                               tx_counter=state.tx_bytes, hour_start=hour, day_start=day)
+                created.append(traffic)
+            else:
+                updated.append(traffic)
+                _roll_up(traffic, hour, day, samples)
+                if state is not None:
+                    rx_bytes = _delta(state.rx_bytes, traffic.rx_counter)
+                    tx_bytes = _delta(state.tx_bytes, traffic.tx_counter)
+                    traffic.rx_counter, traffic.tx_counter = state.rx_bytes, state.tx_bytes
+                    if rx_bytes or tx_bytes:
+                        samples.append(WireguardTrafficSample(peer_id=peer_id,
+                                                              resolution=WireguardTrafficSample.SAMPLE,
+                                                              period_start=now,
+                                                              rx_bytes=rx_bytes, tx_bytes=tx_bytes))
+                        traffic.rx_bytes += rx_bytes
+                        traffic.tx_bytes += tx_bytes
+                        traffic.hour_rx_bytes += rx_bytes
+                        traffic.hour_tx_bytes += tx_bytes
+                        traffic.day_rx_bytes += rx_bytes
+                        traffic.day_tx_bytes += tx_bytes
+            if state is not None:
+                if state.latest_handshake:
+                    traffic.last_seen = datetime.fromtimestamp(state.latest_handshake, tz=dt_timezone.utc)
+                traffic.sampled_at = now
+
+        WireguardTrafficSample.objects.bulk_create(samples, batch_size=_BATCH_SIZE)
+        WireguardPeerTraffic.objects.bulk_create(created, batch_size=_BATCH_SIZE)
+        WireguardPeerTraffic.objects.bulk_update(updated, _COUNTER_FIELDS, batch_size=_BATCH_SIZE)
+    return len(peers)
+
+
+def sample_traffic(queryset: Optional[QuerySet] = None, now: Optional[datetime] = None) -> int:
+    """
+    Record the traffic of the peers of the interfaces.
+
+    :param queryset: WireguardInterfaces to sample, the local ones by default
+    :param now: sampling time, defaults to the current time
+    :return: number of sampled peers
+    """
+    from django_wireguard.models import WireguardInterface
+
+    if queryset is None:
+        queryset = WireguardInterface.objects.local()
+    now = now or timezone.now()
+    return sum(record_peer_states(interface, interface.wg.iter_peers(), now) for interface in queryset)
+
+
+def prune_traffic(now: Optional[datetime] = None) -> int:
+    """
+    Delete the samples older than their resolution retention.
+
+    :param now: reference time, defaults to the current time
+    :return: number of deleted samples
+    """
+    from django_wireguard.models import WireguardTrafficSample
+
+    now = now or timezone.now()
+    deleted = 0
+    for resolution, retention in _retentions():
+        count, _ = WireguardTrafficSample.objects.filter(resolution=resolution,
+                                                         period_start__lt=now - retention).delete()
+        deleted += count
+    return deleted
+
+
+def _retentions() -> Iterable[Tuple[int, timedelta]]:
+    from django_wireguard.models import WireguardTrafficSample
+
+    return ((WireguardTrafficSample.SAMPLE, timedelta(hours=settings.WIREGUARD_METERING_SAMPLE_RETENTION)),
+            (WireguardTrafficSample.HOUR, timedelta(days=settings.WIREGUARD_METERING_HOURLY_RETENTION)),
+            (WireguardTrafficSample.DAY, timedelta(days=settings.WIREGUARD_METERING_DAILY_RETENTION)))
+
+
+def get_traffic_usage(peer_ids: Iterable[int], since: Optional[datetime] = None) -> Dict[int, Tuple[int, int]]:
+    """
+    Received and sent bytes of peers.
+
+    Periods within the sample retention are exact, older ones start at the
+    beginning of the hour or the day of ``since``.
+
+    :param peer_ids: peer primary keys
+    :param since: start of the period, lifetime totals by default
+    :return: (rx_bytes, tx_bytes) by peer primary key
+    """
+    from django_wireguard.models import WireguardPeerTraffic, WireguardTrafficSample
+
+    peer_ids = list(peer_ids)
+    traffic = WireguardPeerTraffic.objects.filter(peer__in=peer_ids)
+    if since is None:
+        return {peer_id: (rx_bytes, tx_bytes)
+                for peer_id, rx_bytes, tx_bytes in traffic.values_list('peer_id', 'rx_bytes', 'tx_bytes')}
+
+    now = timezone.now()
+    hour, day = _periods(since)
+    resolution, start, open_fields = WireguardTrafficSample.DAY, day, ('day_start', 'day_rx_bytes', 'day_tx_bytes')
+    for candidate, retention in _retentions():
+        if since >= now - retention:
+            resolution = candidate
+            break
+    if resolution == WireguardTrafficSample.SAMPLE:
+        start, open_fields = since, None
+    elif resolution == WireguardTrafficSample.HOUR:
+        start, open_fields = hour, ('hour_start', 'hour_rx_bytes', 'hour_tx_bytes')
+
+    usage = {}
+    rows = (WireguardTrafficSample.objects
+            .filter(peer__in=peer_ids, resolution=resolution, period_start__gte=start)
+            .values('peer_id')
+            .annotate(rx=Sum('rx_bytes'), tx=Sum('tx_bytes'))
+            .values_list('peer_id', 'rx', 'tx'))
+    for peer_id, rx_bytes, tx_bytes in rows:
+        usage[peer_id] = (rx_bytes, tx_bytes)
+    if open_fields:
+        # the current hour or day is not rolled up yet
+        period_field, rx_field, tx_field = open_fields
+        for peer_id, rx_bytes, tx_bytes in (traffic.filter(**{f'{period_field}__gte': start})
+                                            .values_list('peer_id', rx_field, tx_field)):
+            previous_rx, previous_tx = usage.get(peer_id, (0, 0))
+            usage[peer_id] = (previous_rx + rx_bytes, previous_tx + tx_bytes)
+    return usage
+
+
+def get_last_seen(peer_ids: Iterable[int]) -> Dict[int, datetime]:
+    """
+    Latest handshake of peers recorded by the sampler.
+
+    :param peer_ids: peer primary keys
+    :return: latest handshake by peer primary key, peers never seen are missing
+    """
+    from django_wireguard.models import WireguardPeerTraffic
+
+    return dict(WireguardPeerTraffic.objects
+                .filter(peer__in=list(peer_ids))
+                .exclude(last_seen=None)
+                .values_list('peer_id', 'last_seen'))
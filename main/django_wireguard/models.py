@@ -1,13 +1,21 @@
+import secrets
 from ipaddress import IPv4Interface
-from os import system
 from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Tuple
 from django.core.validators import MinValueValidator, MaxValueValidator, RegexValidator
-from django.db import models
-from django.db.models.signals import pre_save, pre_delete
+from django.db import models, transaction
+from django.db.models.signals import pre_save, post_save, pre_delete
 from django.dispatch import receiver
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 
 from django_wireguard import settings
+from django_wireguard.configs import get_config, invalidate_configs, new_config_version
+from django_wireguard.allocator import allocate_addresses, reserve_addresses, release_addresses, \
+    get_free_address_count
+from django_wireguard.firewall import InterfaceRules, get_firewall
+from django_wireguard.outbox import enqueue_interface, enqueue_interface_deletion, enqueue_peer_removal, \
+    enqueue_peers
 from django_wireguard.signals import interface_created, interface_deleted
 from django_wireguard.utils import clean_comma_separated_str
 from django_wireguard.validators import validate_private_ipv4, validate_wireguard_private_key, \
@@ -16,8 +24,45 @@ from django_wireguard.validators import validate_private_ipv4, validate_wireguar
 from django_wireguard.wireguard import WireGuard, PrivateKey
 
 
-__all__ = ('WireguardInterface', 'WireguardPeer',
-           'WireguardDNS', 'WireguardAllowedNetworks')
+__all__ = ('WireguardNode', 'WireguardInterface', 'WireguardPeer',
+           'WireguardDNS', 'WireguardAllowedNetworks', 'WireguardKernelIntent')
+
+
+class WireguardNode(models.Model):
+    """
+    WireGuard server running the ``wireguard_agent`` command for its interfaces.
+    """
+    name = models.CharField(max_length=100, unique=True, verbose_name=_("Name"))
+    endpoint = models.CharField(max_length=255,
+                                verbose_name=_("Endpoint"),
+                                help_text=_("Public IP address or domain of the server."))
+    token = models.CharField(max_length=64, unique=True, blank=True,
+                             verbose_name=_("Token (leave empty to auto generate)"))
+    last_seen = models.DateTimeField(null=True, editable=False, verbose_name=_("Last seen"))
+    last_errors = models.TextField(blank=True, editable=False, verbose_name=_("Errors of the last report"))
+
+    class Meta:
+        verbose_name = _("Node")
+        verbose_name_plural = _("Nodes")
+
+    def __repr__(self):
+        return f"{self._meta.verbose_name} {self.name}"
+
+    def __str__(self):
+        return f"{self.name}"
+
+    def save(self, *args, **kwargs):
+        if not self.token:
+            self.token = secrets.token_hex(32)
+        super().save(*args, **kwargs)
+
+
+class WireguardInterfaceQuerySet(models.QuerySet):
+    def local(self):
+        """
+        Interfaces managed by this process, the other ones are managed by their node agent.
+        """
+        return self.filter(node=None)
 
 
 class WireguardInterface(models.Model):
@@ -34,14 +79,28 @@ class WireguardInterface(models.Model):
                                    blank=True,
                                    validators=[validate_wireguard_private_key],
                                    verbose_name=_("Private Key (leave empty to auto generate)"))
+    public_key = models.CharField(max_length=44,
+                                  unique=True,
+                                  null=True,
+                                  editable=False,
+                                  verbose_name=_("Public Key"))
+    node = models.ForeignKey(WireguardNode,
+                             null=True,
+                             blank=True,
+                             on_delete=models.PROTECT,
+                             related_name='interfaces',
+                             related_query_name='interface',
+                             verbose_name=_("Node (leave empty to run on this server)"))
+
+    objects = WireguardInterfaceQuerySet.as_manager()
 
     class Meta:
         verbose_name = _("Interface")
         verbose_name_plural = _("Interfaces")
 
     @property
-    def public_key(self) -> str:
-        return str(PrivateKey(self.private_key).public_key())
+    def is_local(self) -> bool:
+        return self.node_id is None
 
     @property
     def wg(self) -> WireGuard:
@@ -59,8 +118,41 @@ class WireguardInterface(models.Model):
     def get_address_list(self):
         return list(self.addresses.all().values_list('address', flat=True))
 
+    def get_public_key(self) -> Optional[str]:
+        """
+        Public key of the interface, derived from the private key until it is stored.
+        """
+        if self.public_key is None and self.private_key:
+            return str(PrivateKey(self.private_key).public_key())
+        return self.public_key
+
     def get_endpoint(self):
-        return f"{settings.WIREGUARD_ENDPOINT}:{self.listen_port}"
+        endpoint = self.node.endpoint if self.node_id else settings.WIREGUARD_ENDPOINT
+        return f"{endpoint}:{self.listen_port}"
+
+    def get_firewall_rules(self, addresses=None) -> InterfaceRules:
+        if addresses is None:
+            addresses = self.get_address_list() if self.pk else []
+        return InterfaceRules(self.name, self.listen_port, addresses)
+
+    def apply_firewall(self, addresses=None, dry_run: bool = False) -> str:
+        """
+        Replace the interface firewall rules.
+
+        :param addresses: interface addresses, defaults to the stored ones
+        :param dry_run: only return the rules that would be applied
+        :return: the rendered rules
+        """
+        return get_firewall().apply(self.get_firewall_rules(addresses), dry_run=dry_run)
+
+    def remove_firewall(self, dry_run: bool = False) -> str:
+        """
+        Remove the interface firewall chains and sets.
+
+        :param dry_run: only return the commands that would be run
+        :return: the rendered commands
+        """
+        return get_firewall().teardown(self.name, dry_run=dry_run)
 
 
 class WireguardIPAddress(models.Model):
@@ -73,6 +165,9 @@ class WireguardIPAddress(models.Model):
                                   related_name='addresses',
                                   related_query_name='address',
                                   verbose_name=_("Interface"))
+    address_bitmap = models.BinaryField(null=True, editable=False)
+    address_hint = models.PositiveIntegerField(default=0, editable=False)
+    allocated_addresses = models.PositiveIntegerField(default=0, editable=False)
 
     class Meta:
         verbose_name = _("IP Address")
@@ -84,6 +179,37 @@ class WireguardIPAddress(models.Model):
     def __str__(self):
         return f"{self.interface}-{self.name} - {self.address}"
 
+    def get_free_address_count(self) -> int:
+        return get_free_address_count(self)
+
+
+class WireguardPeerQuerySet(models.QuerySet):
+    def get_by_public_key(self, public_key: str) -> 'WireguardPeer':
+        return self.get(public_key=public_key)
+
+    def get_by_address(self, address: str) -> 'WireguardPeer':
+        return self.get(address=str(IPv4Interface(address).ip))
+
+    def in_bulk_by_public_key(self, public_keys: Iterable[str] = None) -> Dict[str, 'WireguardPeer']:
+        """
+        Map public keys to peers with a single query.
+
+        :param public_keys: public keys to look up, all peers of the queryset by default
+        :return: peers by public key
+        """
+        return self.in_bulk(public_keys, field_name='public_key')
+
+    def fill_public_keys(self) -> int:
+        """
+        Store the public key of the peers saved before it was persisted.
+
+        :return: number of updated peers
+        """
+        peers = list(self.filter(public_key=None).exclude(private_key=None).only('private_key'))
+        for peer in peers:
+            peer.public_key = str(PrivateKey(peer.private_key).public_key())
+        return self.model.objects.bulk_update(peers, ['public_key'], batch_size=500)
+
 
 class WireguardPeer(models.Model):
     status = models.BooleanField(default=True, verbose_name=_("Enabled"))
@@ -99,6 +225,11 @@ class WireguardPeer(models.Model):
                                    blank=True,
                                    validators=[validate_wireguard_private_key],
                                    verbose_name=_("Peer's Private Key"))
+    public_key = models.CharField(max_length=44,
+                                  unique=True,
+                                  null=True,
+                                  editable=False,
+                                  verbose_name=_("Peer's Public Key"))
     preshared_key = models.CharField(max_length=64,
                                      unique=True,
                                      blank=True,
@@ -107,7 +238,7 @@ class WireguardPeer(models.Model):
                                      verbose_name=_("Peer's Pre-Shared Key"))
     dns = models.ForeignKey('WireguardDNS', blank=True, null=True,
                             on_delete=models.SET_NULL, verbose_name=_("DNS"))
-    address = models.GenericIPAddressField(protocol='IPv4', blank=True, null=True,
+    address = models.GenericIPAddressField(protocol='IPv4', blank=True, null=True, unique=True,
                                            validators=[validate_private_ipv4],
                                            verbose_name=_("IP-address"))
     allowed_networks = models.ForeignKey("WireguardAllowedNetworks", blank=True, null=True, on_delete=models.SET_NULL,
@@ -118,6 +249,20 @@ class WireguardPeer(models.Model):
                                                             validators=[MinValueValidator(
                                                                 0), MaxValueValidator(65535)],
                                                             verbose_name=_("Persistent Keepalive"))
+    rate_limit_down = models.PositiveIntegerField(blank=True, null=True,
+                                                  verbose_name=_("Download limit, kbit/s"),
+                                                  help_text=_("Overrides the tariff limit, 0 for unlimited."))
+    rate_limit_up = models.PositiveIntegerField(blank=True, null=True,
+                                                verbose_name=_("Upload limit, kbit/s"),
+                                                help_text=_("Overrides the tariff limit, 0 for unlimited."))
+    config_version = models.CharField(max_length=16, blank=True, editable=False)
+
+    objects = WireguardPeerQuerySet.as_manager()
+
+    KERNEL_FIELDS = ('interface_ip_id', 'address', 'private_key', 'public_key', 'preshared_key', 'status',
+                     'persistent_keepalive', 'rate_limit_down', 'rate_limit_up')
+    """Fields programmed into the kernel, the others only change the client configuration."""
+    _loaded_values = {}
 
     class Meta:
         verbose_name = _("Peer")
@@ -130,18 +275,35 @@ class WireguardPeer(models.Model):
     def __str__(self):
         return f"{self.name} - {self.address}"
 
-    @property
-    def public_key(self) -> str:
-        return str(PrivateKey(self.private_key).public_key())
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._store_loaded_values()
+        return instance
+
+    def _store_loaded_values(self):
+        self._loaded_values = {field: self.__dict__.get(field) for field in self.KERNEL_FIELDS}
+
+    def get_changed_kernel_fields(self) -> set:
+        """
+        Kernel fields changed since the peer was loaded or saved, all of them for a new peer.
+        """
+        if not self._loaded_values:
+            return set(self.KERNEL_FIELDS)
+        return {field for field in self.KERNEL_FIELDS if self.__dict__.get(field) != self._loaded_values[field]}
 
     @property
     def is_active(self):
+        if self.status and not self.interface_ip.interface.is_local:
+            last_seen = self.get_last_seen()
+            return bool(last_seen and (timezone.now() - last_seen).total_seconds() < 3*60)
         if self.status:
             try:
-                if (datetime.now() - self.get_latest_handshake()).seconds < 3*60:
-                    return True
+                latest_handshake = self.interface_ip.interface.wg.get_latest_handshake_of_peer(self.public_key)
             except Exception:
                 return None
+            if latest_handshake and (datetime.now() - latest_handshake).total_seconds() < 3*60:
+                return True
         return False
 
     def set_dns(self, pk: int):
@@ -153,6 +315,9 @@ class WireguardPeer(models.Model):
         self.save()
 
     def get_latest_handshake(self):
+        if self.status and not self.interface_ip.interface.is_local:
+            last_seen = self.get_last_seen()
+            return timezone.make_naive(last_seen) if last_seen else None
         if self.status:
             try:
                 return self.interface_ip.interface.wg.get_latest_handshake_of_peer(self.public_key)
@@ -164,43 +329,276 @@ class WireguardPeer(models.Model):
     def get_clean_dns(self) -> str:
         return clean_comma_separated_str(str(self.dns.addresses))
 
-    def get_interface_allowed_ip(self) -> str:
-        return f'{self.address}/32'
+    def get_last_seen(self) -> Optional[datetime]:
+        """
+        Latest handshake recorded by the traffic sampler, kept across restarts.
+        """
+        from django_wireguard.metering import get_last_seen
 
-    def get_config(self) -> str:
+        return get_last_seen([self.pk]).get(self.pk)
+
+    def get_traffic_usage(self, since: Optional[datetime] = None) -> Tuple[int, int]:
         """
-        Generate WireGuard configuration for peer as string.
+        Received and sent bytes of the peer.
 
-        :return: Peer configuration as string.
+        :param since: start of the period, lifetime totals by default
+        :return: (rx_bytes, tx_bytes)
         """
-        private_key = self.private_key or _(
-            '<INSERT-PRIVATE-KEY-FOR:%(pubkey)s>') % {'pubkey': self.public_key}
+        from django_wireguard.metering import get_traffic_usage
 
-        config = f"[Interface]\n" \
-                 f"Address={self.address}/32\n" \
-                 f"PrivateKey={private_key}\n"
+        return get_traffic_usage([self.pk], since).get(self.pk, (0, 0))
 
-        if self.dns:
-            config += f"DNS={self.get_clean_dns()}\n"
+    def get_interface_allowed_ip(self) -> str:
+        return f'{self.address}/32'
 
-        config += f"[Peer]\n" \
-                  f"Endpoint={self.interface_ip.interface.get_endpoint()}\n" \
-                  f"PublicKey={self.interface_ip.interface.public_key}\n" \
-                  f"PresharedKey={self.preshared_key}\n"
-        if self.allowed_networks:
-            config += f"AllowedIPs={self.allowed_networks.get_clean_allowed_networks()}\n"
-        else:
-            config += f"AllowedIPs=0.0.0.0/0\n"
-        if self.persistent_keepalive:
-            config += f"PersistentKeepalive={self.persistent_keepalive}\n"
+    def get_config(self) -> str:
+        """
+        Generate WireGuard configuration for peer as string, cached by config version.
 
-        return config
+        :return: Peer configuration as string.
+        """
+        return get_config(self)
 
     def update_keys(self):
         self.preshared_key = None
         self.private_key = None
         self.save()
 
+    def save(self, *args, **kwargs):
+        # the pool entry and addresses taken before the write are given back if it fails
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+
+
+def request_pool_refill(interface_ip_id: int):
+    """
+    Queue a pool refill, the periodic refill catches up if the broker is unavailable.
+    """
+    from kombu.exceptions import OperationalError
+    from django_wireguard.tasks import refill_pool
+
+    try:
+        refill_pool.delay(interface_ip_id)
+    except OperationalError:
+        pass
+
+
+class WireguardPoolEntryQuerySet(models.QuerySet):
+    def claim(self, interface_ip: WireguardIPAddress) -> Optional['WireguardPoolEntry']:
+        """
+        Take a pre-generated entry out of the pool of an interface address.
+
+        A refill is queued once the pool falls under ``WIREGUARD_POOL_LOW_WATERMARK``.
+
+        :param interface_ip: interface address of the new peer
+        :return: the claimed entry, None if the pool is empty
+        """
+        entries = self.claim_many(interface_ip, 1)
+        return entries[0] if entries else None
+
+    def claim_many(self, interface_ip: WireguardIPAddress, count: int) -> List['WireguardPoolEntry']:
+        """
+        Take up to ``count`` pre-generated entries out of the pool of an interface address.
+
+        :param interface_ip: interface address of the new peers
+        :param count: number of entries wanted
+        :return: the claimed entries, fewer than ``count`` if the pool runs out
+        """
+        if not settings.WIREGUARD_POOL_SIZE or count <= 0:
+            return []
+        entries = []
+        with transaction.atomic():
+            while len(entries) < count:
+                candidates = list(self.filter(interface_ip=interface_ip).order_by('pk')[:count - len(entries)])
+                if not candidates:
+                    break
+                # no row locks, SQLite has none: an entry is claimed by the delete that removes it
+                for entry in candidates:
+                    if self.filter(pk=entry.pk).delete()[0] == 1:
+                        entries.append(entry)
+        if self.filter(interface_ip=interface_ip).count() < settings.WIREGUARD_POOL_LOW_WATERMARK:
+            interface_ip_id = interface_ip.pk
+            transaction.on_commit(lambda: request_pool_refill(interface_ip_id))
+        return entries
+
+    def refill(self, interface_ip: Optional[WireguardIPAddress] = None, size: Optional[int] = None) -> int:
+        """
+        Top up the pools with one bulk insert per interface address.
+
+        :param interface_ip: interface address to refill, all of them by default
+        :param size: target pool size, defaults to ``WIREGUARD_POOL_SIZE``
+        :return: number of created entries
+        """
+        size = settings.WIREGUARD_POOL_SIZE if size is None else size
+        interface_ips = [interface_ip] if interface_ip else WireguardIPAddress.objects.all()
+        created = 0
+        for interface_ip in interface_ips:
+            with transaction.atomic():
+                # serialize the refills of an interface address, they compete for the same addresses
+                WireguardIPAddress.objects.select_for_update().filter(pk=interface_ip.pk).exists()
+                missing = size - self.filter(interface_ip=interface_ip).count()
+                if missing <= 0:
+                    continue
+                entries = []
+                for address in allocate_addresses(interface_ip, missing):
+                    private_key = PrivateKey.generate()
+                    entries.append(WireguardPoolEntry(interface_ip=interface_ip,
+                                                      address=address,
+                                                      private_key=str(private_key),
+                                                      public_key=str(private_key.public_key()),
+                                                      preshared_key=str(PrivateKey.generate())))
+                created += len(self.bulk_create(entries))
+        return created
+
+
+class WireguardPoolEntry(models.Model):
+    """
+    Pre-generated key material and reserved address claimed by a new peer.
+    """
+    interface_ip = models.ForeignKey(WireguardIPAddress,
+                                     on_delete=models.CASCADE,
+                                     related_name='pool',
+                                     verbose_name=_("Interface IP"))
+    address = models.GenericIPAddressField(protocol='IPv4', unique=True,
+                                           verbose_name=_("IP-address"))
+    private_key = models.CharField(max_length=64, verbose_name=_("Private Key"))
+    public_key = models.CharField(max_length=44, unique=True, verbose_name=_("Public Key"))
+    preshared_key = models.CharField(max_length=64, unique=True, verbose_name=_("Pre-Shared Key"))
+
+    objects = WireguardPoolEntryQuerySet.as_manager()
+
+    class Meta:
+        verbose_name = _("Pool Entry")
+        verbose_name_plural = _("Pool Entries")
+
+    def __str__(self):
+        return f"{self.interface_ip} - {self.address}"
+
+
+class WireguardPeerTraffic(models.Model):
+    """
+    Traffic counters of a peer, updated by :func:`~django_wireguard.metering.sample_traffic`.
+
+    Holds the last kernel counters to compute deltas, the lifetime totals,
+    and the totals of the current hour and day until they are rolled up.
+    """
+    peer = models.OneToOneField(WireguardPeer, primary_key=True,
+                                on_delete=models.CASCADE,
+                                related_name='traffic',
+                                verbose_name=_("Peer"))
+    rx_counter = models.PositiveBigIntegerField(default=0)
+    tx_counter = models.PositiveBigIntegerField(default=0)
+    rx_bytes = models.PositiveBigIntegerField(default=0, verbose_name=_("Received"))
+    tx_bytes = models.PositiveBigIntegerField(default=0, verbose_name=_("Sent"))
+    hour_start = models.DateTimeField(null=True)
+    hour_rx_bytes = models.PositiveBigIntegerField(default=0)
+    hour_tx_bytes = models.PositiveBigIntegerField(default=0)
+    day_start = models.DateTimeField(null=True)
+    day_rx_bytes = models.PositiveBigIntegerField(default=0)
+    day_tx_bytes = models.PositiveBigIntegerField(default=0)
+    last_seen = models.DateTimeField(null=True, verbose_name=_("Last seen"))
+    sampled_at = models.DateTimeField(null=True)
+
+    class Meta:
+        verbose_name = _("Peer Traffic")
+        verbose_name_plural = _("Peer Traffic")
+
+    def __str__(self):
+        return f"{self.peer_id} - {self.rx_bytes}/{self.tx_bytes}"
+
+
+class WireguardTrafficSample(models.Model):
+    """
+    Bytes exchanged by a peer during a sampling interval, an hour or a day.
+    """
+    SAMPLE = 0
+    HOUR = 1
+    DAY = 2
+    RESOLUTIONS = (
+        (SAMPLE, _("Sample")),
+        (HOUR, _("Hour")),
+        (DAY, _("Day")),
+    )
+
+    peer = models.ForeignKey(WireguardPeer,
+                             on_delete=models.CASCADE,
+                             related_name='traffic_samples',
+                             db_index=False,
+                             verbose_name=_("Peer"))
+    resolution = models.PositiveSmallIntegerField(choices=RESOLUTIONS, verbose_name=_("Resolution"))
+    period_start = models.DateTimeField(verbose_name=_("Period start"))
+    rx_bytes = models.PositiveBigIntegerField(verbose_name=_("Received"))
+    tx_bytes = models.PositiveBigIntegerField(verbose_name=_("Sent"))
+
+    class Meta:
+        verbose_name = _("Traffic Sample")
+        verbose_name_plural = _("Traffic Samples")
+        indexes = [
+            models.Index(fields=['peer', 'resolution', 'period_start']),
+            models.Index(fields=['resolution', 'period_start']),
+        ]
+
+    def __str__(self):
+        return f"{self.peer_id} - {self.period_start} - {self.rx_bytes}/{self.tx_bytes}"
+
+
+class WireguardKernelIntentQuerySet(models.QuerySet):
+    def due(self):
+        """
+        Intents to apply now, the dead letters are left out.
+        """
+        return self.filter(next_attempt_at__lte=timezone.now(), attempts__lt=settings.WIREGUARD_OUTBOX_MAX_ATTEMPTS)
+
+    def failed(self):
+        """
+        Dead letters, intents that failed ``WIREGUARD_OUTBOX_MAX_ATTEMPTS`` times.
+        """
+        return self.filter(attempts__gte=settings.WIREGUARD_OUTBOX_MAX_ATTEMPTS)
+
+    def retry(self) -> int:
+        """
+        Apply the intents again on the next round, with a fresh attempt count.
+
+        :return: number of intents
+        """
+        return self.update(attempts=0, next_attempt_at=timezone.now())
+
+
+class WireguardKernelIntent(models.Model):
+    """
+    Kernel change recorded with a database change, applied once it is committed.
+    """
+    PEER = 'peer'
+    INTERFACE = 'interface'
+    DELETE = 'delete'
+    KINDS = (
+        (PEER, _("Sync peer")),
+        (INTERFACE, _("Reconcile interface")),
+        (DELETE, _("Delete interface")),
+    )
+
+    interface_name = models.CharField(max_length=100, verbose_name=_("Interface"))
+    kind = models.CharField(max_length=10, choices=KINDS, verbose_name=_("Kind"))
+    public_key = models.CharField(max_length=44, null=True, blank=True, verbose_name=_("Peer's Public Key"))
+    address = models.GenericIPAddressField(protocol='IPv4', null=True, blank=True, verbose_name=_("IP-address"))
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name=_("Date of creation"))
+    attempts = models.PositiveIntegerField(default=0, verbose_name=_("Attempts"))
+    next_attempt_at = models.DateTimeField(default=timezone.now, db_index=True, verbose_name=_("Next attempt"))
+    last_error = models.TextField(blank=True, verbose_name=_("Last error"))
+
+    objects = WireguardKernelIntentQuerySet.as_manager()
+
+    class Meta:
+        verbose_name = _("Kernel Intent")
+        verbose_name_plural = _("Kernel Intents")
+
+    def __str__(self):
+        return f"{self.interface_name} - {self.kind} {self.public_key or ''}"
+
+    @property
+    def is_failed(self) -> bool:
+        return self.attempts >= settings.WIREGUARD_OUTBOX_MAX_ATTEMPTS
+
 
 class WireguardAllowedNetworks(models.Model):
     name = models.CharField(max_length=100,
@@ -248,102 +646,148 @@ def sync_wireguard_interface(sender, **kwargs):
     interface = kwargs['instance']
     if not interface.private_key:
         interface.private_key = str(PrivateKey.generate())
+    interface.public_key = str(PrivateKey(interface.private_key).public_key())
+
 
-    interface.wg.set_interface(private_key=interface.private_key,
-                               listen_port=interface.listen_port)
-    # interface.wg.set_ip_addresses(interface.get_address_list())
+@receiver(post_save, sender=WireguardInterface)
+def queue_interface_sync(sender, **kwargs):
+    enqueue_interface(kwargs['instance'])
 
 
 @receiver(pre_save, sender=WireguardIPAddress)
 def sync_wireguard_address(sender, **kwargs):
     address = kwargs['instance']
-    interface = address.interface
-    interface.wg.set_ip_addresses([address.address])
+    # the allocation bitmap is rebuilt from the peers on next use
+    address.address_bitmap = None
+    if address.pk:
+        previous = WireguardIPAddress.objects.filter(pk=address.pk).values_list('address', flat=True).first()
+        address._subnet_changed = previous is not None and previous != address.address
+
+
+@receiver(post_save, sender=WireguardIPAddress)
+def queue_address_sync(sender, **kwargs):
+    address = kwargs['instance']
+    if getattr(address, '_subnet_changed', False):
+        address._subnet_changed = False
+        # the pool entries hold addresses of the previous subnet
+        address.pool.all().delete()
+        interface_ip_id = address.pk
+        transaction.on_commit(lambda: request_pool_refill(interface_ip_id))
+    enqueue_interface(address.interface)
 
 
 @receiver(pre_save, sender=WireguardPeer)
 def sync_wireguard_peer(sender, **kwargs):
     peer: WireguardPeer = kwargs['instance']
-    interface_ip = peer.interface_ip.address
-    interface = peer.interface_ip.interface
-    if not peer.address:
-        address = IPv4Interface(interface_ip)
-        interface_address = str(address.ip)
-        subnet = address.network
-
-        # fetch other peers for checks
-        peers = WireguardPeer.objects.all().only('address')
-        # auto assign IP address
-        peer_addresses = [peer.address for peer in peers]
-        peer_addresses.append(interface_address)
+
+    # take the address and keys from the pool, generate them only if it is empty
+    entry = None
+    if not peer.address or not peer.private_key or not peer.preshared_key:
+        entry = WireguardPoolEntry.objects.claim(peer.interface_ip)
+    if entry is not None:
+        peer.preshared_key = peer.preshared_key or entry.preshared_key
         if not peer.address:
-            for host in subnet.hosts():
-                if str(host) not in peer_addresses:
-                    peer.address = str(host)
-                    break
-            else:
-                raise RuntimeWarning(
-                    "WireGuard interface's subnets have no available IP left")
+            peer.address = entry.address
         else:
+            release_addresses(peer.interface_ip, [entry.address])
+
+    previous_address = peer._loaded_values.get('address')
+    previous_interface_ip_id = peer._loaded_values.get('interface_ip_id')
+    moved = (peer.address, peer.interface_ip_id) != (previous_address, previous_interface_ip_id)
+    if not peer.address:
+        addresses = allocate_addresses(peer.interface_ip, 1)
+        if not addresses:
             raise RuntimeWarning(
                 "WireGuard interface's subnets have no available IP left")
-
-    if not peer.private_key:
-        peer.private_key = str(PrivateKey.generate())
-
+        peer.address = addresses[0]
+    elif moved and (entry is None or peer.address != entry.address):
+        # address set by hand
+        WireguardPoolEntry.objects.filter(address=peer.address).delete()
+        reserve_addresses(peer.interface_ip, [peer.address])
+    if previous_address and moved:
+        # the previous address belongs to the subnet the peer was loaded in
+        release_addresses(WireguardIPAddress(pk=previous_interface_ip_id), [previous_address])
+
+    previous_public_key = peer.public_key
+    if not peer.private_key and entry is not None:
+        peer.private_key = entry.private_key
+        peer.public_key = entry.public_key
+    else:
+        if not peer.private_key:
+            peer.private_key = str(PrivateKey.generate())
+        if not peer.public_key or peer.private_key != peer._loaded_values.get('private_key'):
+            peer.public_key = str(PrivateKey(peer.private_key).public_key())
     if not peer.preshared_key:
         peer.preshared_key = str(PrivateKey.generate())
+    peer.config_version = new_config_version()
 
-    # update/create the wireguard peer
-    if peer.status:
-        interface.wg.set_peer(peer.public_key, peer.preshared_key,
-                              peer.get_interface_allowed_ip())
-    elif peer.pk and not peer.status and WireguardPeer.objects.get(pk=peer.pk):
-        peer.interface_ip.interface.wg.remove_peers(peer.public_key)
+    # the kernel is synced after the row is written, the outbox reads the peer from the database
+    peer._stale_keys = []
+    if peer.pk and previous_public_key and previous_public_key != peer.public_key:
+        peer._stale_keys.append((peer.interface_ip.interface, previous_public_key))
+    if previous_interface_ip_id not in (None, peer.interface_ip_id):
+        previous_interface = WireguardInterface.objects.filter(address=previous_interface_ip_id).first()
+        if previous_interface is not None and previous_interface.pk != peer.interface_ip.interface_id:
+            peer._stale_keys.append((previous_interface, previous_public_key or peer.public_key))
+
+
+@receiver(post_save, sender=WireguardPeer)
+def queue_peer_sync(sender, **kwargs):
+    peer: WireguardPeer = kwargs['instance']
+    # DNS or allowed networks only change the client configuration, its version is replaced above
+    if kwargs['created'] or peer.get_changed_kernel_fields():
+        for interface, public_key in getattr(peer, '_stale_keys', ()):
+            enqueue_peer_removal(interface, public_key, peer.address)
+        enqueue_peers([peer])
+    peer._stale_keys = []
+    peer._store_loaded_values()
+
+
+@receiver(post_save, sender=WireguardNode)
+@receiver(post_save, sender=WireguardInterface)
+@receiver(post_save, sender=WireguardIPAddress)
+@receiver(post_save, sender=WireguardDNS)
+@receiver(post_save, sender=WireguardAllowedNetworks)
+@receiver(pre_delete, sender=WireguardDNS)
+@receiver(pre_delete, sender=WireguardAllowedNetworks)
+def invalidate_peer_configs(sender, **kwargs):
+    instance = kwargs['instance']
+    if kwargs.get('created'):
+        return
+    lookup = {
+        WireguardNode: 'interface_ip__interface__node',
+        WireguardInterface: 'interface_ip__interface',
+        WireguardIPAddress: 'interface_ip',
+        WireguardDNS: 'dns',
+        WireguardAllowedNetworks: 'allowed_networks',
+    }[sender]
+    invalidate_configs(WireguardPeer.objects.filter(**{lookup: instance}))
 
 
 @receiver(pre_delete, sender=WireguardInterface)
 def delete_interface(sender, **kwargs):
-    interface: WireguardInterface = kwargs['instance']
-    interface.wg.delete()
-    interface_deleted.send(sender, instance=interface)
+    enqueue_interface_deletion(kwargs['instance'])
 
 
 @receiver(pre_delete, sender=WireguardIPAddress)
 def del_wireguard_address(sender, **kwargs):
-    address = kwargs['instance']
-    interface = address.interface
-    iptables_config = ''
-    for network in interface.get_address_list():
-        if address.address == network:
-            continue
-        iptables_config += f'iptables -D FORWARD -s {address.address} -d {network} -j REJECT;' \
-                           f'iptables -D FORWARD -s {network} -d {address.address} -j REJECT;'
-    iptables_config += f'iptables -D FORWARD -s {address.address} -d 10.8.88.253/32 -j REJECT'
-    system(iptables_config)
+    enqueue_interface(kwargs['instance'].interface)
 
 
 @receiver(pre_delete, sender=WireguardPeer)
 def delete_peer(sender, **kwargs):
     peer: WireguardPeer = kwargs['instance']
-    peer.interface_ip.interface.wg.remove_peers(peer.public_key)
+    enqueue_peer_removal(peer.interface_ip.interface, peer.public_key, peer.address)
+    release_addresses(peer.interface_ip, [peer.address])
 
 
 @receiver(interface_created, sender=WireguardInterface)
 def postup_iptables_route(sender, **kwargs):
     interface: WireguardInterface = kwargs['instance']
-    iptables_config = f"iptables -A FORWARD -i {interface.name} -j ACCEPT; " \
-                      f"iptables -A FORWARD -o {interface.name} -j ACCEPT; "
-    iptables_config += f"iptables -A INPUT -p udp -m udp --dport {interface.listen_port} -j ACCEPT"
-    system(iptables_config)
+    interface.apply_firewall()
 
 
 @receiver(interface_deleted, sender=WireguardInterface)
 def postdown_iptables_route(sender, **kwargs):
     interface: WireguardInterface = kwargs['instance']
-    iptables_config = f"iptables -D FORWARD -i {interface.name} -j ACCEPT; " \
-                      f"iptables -D FORWARD -o {interface.name} -j ACCEPT; "
-    for network in interface.get_address_list():
-        iptables_config += f"iptables -t nat -D POSTROUTING -s {network} -o {settings.WIREGUARD_OUTPUT_INTERFACE} -j MASQUERADE;"
-    iptables_config += f"iptables -D INPUT -p udp -m udp --dport {interface.listen_port} -j ACCEPT"
-    system(iptables_config)
+    interface.remove_firewall()
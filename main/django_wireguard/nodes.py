@@ -0,0 +1,71 @@
+"""
+Control plane side of the node agents.
+
+Interfaces attached to a :class:`~django_wireguard.models.WireguardNode` are not touched by
+this host: the agent running on the node pulls their desired state with :func:`get_desired_state`,
+reconciles its kernel and reports back the peer counters and handshakes, recorded by
+:func:`record_node_report` like a local traffic sample.
+
+A report is a JSON object::
+
+    {"interfaces": {"wg1": [[public_key, rx_bytes, tx_bytes, latest_handshake], ...]},
+     "errors": {"wg1": ["..."]}}
+"""
+from datetime import datetime
+from typing import Optional
+
+from django.utils import timezone
+
+from django_wireguard.metering import record_peer_states
+from django_wireguard.reconcile import load_desired_state
+from django_wireguard.wireguard import PeerState
+
+
+__all__ = ('NodeException', 'get_desired_state', 'record_node_report')
+
+
+class NodeException(Exception):
+    """
+    Exception raised when a node report is malformed.
+    """
+
+
+def get_desired_state(node) -> dict:
+    """
+    Desired state of the interfaces of a node, with the peer bandwidth limits.
+
+    :param node: WireguardNode
+    :return: JSON serializable state
+    """
+    interfaces = load_desired_state(node.interfaces.all(), limits=True)
+    return {'node': node.name, 'interfaces': [interface.to_dict() for interface in interfaces]}
+
+
+def record_node_report(node, report: dict, now: Optional[datetime] = None) -> int:
+    """
+    Record the peer counters reported by a node agent.
+
+    Interfaces that do not belong to the node are ignored.
+
+    :param node: WireguardNode
+    :param report: agent report
+    :param now: report time, defaults to the current time
+    :return: number of peers of the reported interfaces
+    """
+    now = now or timezone.now()
+    try:
+        reported = report.get('interfaces') or {}
+        errors = '\n'.join(f"{name}: {error}" for name, interface_errors in (report.get('errors') or {}).items()
+                           for error in interface_errors)
+        states = {name: [PeerState(public_key, None, [], int(latest_handshake or 0), int(rx_bytes), int(tx_bytes), 0)
+                         for public_key, rx_bytes, tx_bytes, latest_handshake in peers]
+                  for name, peers in reported.items()}
+    except (AttributeError, TypeError, ValueError) as e:
+        raise NodeException(f"Malformed report: {e}")
+
+    count = 0
+    for interface in node.interfaces.filter(name__in=states.keys()):
+        count += record_peer_states(interface, states[interface.name], now)
+    type(node).objects.filter(pk=node.pk).update(last_seen=now, last_errors=errors)
+    node.last_seen, node.last_errors = now, errors
+    return count
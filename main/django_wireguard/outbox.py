@@ -0,0 +1,252 @@
+"""
+Transactional outbox of kernel side effects.
+
+Model receivers do not touch the kernel: they record :class:`~django_wireguard.models.WireguardKernelIntent`
+rows in the same transaction as the change, which are dispatched once it is committed.
+A rolled back transaction leaves no intent behind and the kernel untouched.
+
+Intents only name what must be synced, the worker reads the desired state from the database
+when it applies them, so repeated edits of a peer coalesce into one kernel change:
+
+* ``peer``: set the peer with its current keys and address, or remove it if it is gone,
+  disabled or moved to another interface; its bandwidth limits follow;
+* ``interface``: reconcile the whole interface (settings, addresses, firewall, peers);
+* ``delete``: delete the interface and its firewall rules unless it was re-created.
+
+The worker holds a host-wide file lock, so gunicorn, celery and the bot never write the
+kernel at the same time. It applies the peers of an interface in one batch and retries
+failed intents with an exponential backoff, up to ``WIREGUARD_OUTBOX_MAX_ATTEMPTS`` times;
+the intents failing more often are dead letters, kept for an administrator to retry.
+After a commit the intents of the transaction are applied at once if the lock is free,
+any older backlog is left to the ``apply_kernel_intents`` task.
+"""
+import fcntl
+import os
+from contextlib import contextmanager
+from datetime import timedelta
+from typing import Iterable, List
+
+from django.db import connection, transaction
+from django.utils import timezone
+
+from django_wireguard import settings
+
+
+__all__ = ('enqueue_peers', 'enqueue_peer_removal', 'enqueue_interface', 'enqueue_interface_deletion',
+           'apply_intents')
+
+
+_BATCH_SIZE = 500
+
+
+def _create(intents: list):
+    from django_wireguard.models import WireguardKernelIntent
+
+    if not intents:
+        return
+    WireguardKernelIntent.objects.bulk_create(intents, batch_size=_BATCH_SIZE)
+    # the dispatch of the commit applies the intents of the connection it finds committed,
+    # the ones of a rolled back transaction are gone from the database
+    if not hasattr(connection, '_wireguard_intents'):
+        connection._wireguard_intents = []
+    connection._wireguard_intents += intents
+    transaction.on_commit(_dispatch)
+
+
+def enqueue_peers(peers: Iterable):
+    """
+    Sync peers with the kernel after commit.
+
+    :param peers: WireguardPeers, with ``interface_ip__interface`` selected to save queries
+    """
+    from django_wireguard.models import WireguardKernelIntent
+
+    _create([WireguardKernelIntent(interface_name=peer.interface_ip.interface.name,
+                                   kind=WireguardKernelIntent.PEER,
+                                   public_key=peer.public_key, address=peer.address)
+             for peer in peers if peer.public_key and peer.interface_ip.interface.is_local])
+
+
+def enqueue_peer_removal(interface, public_key: str, address: str = None):
+    """
+    Remove a peer key from an interface after commit, unless it is still configured there.
+
+    :param interface: WireguardInterface the key was set on
+    :param public_key: peer public key
+    :param address: peer address, to remove its bandwidth limits
+    """
+    from django_wireguard.models import WireguardKernelIntent
+
+    if public_key and interface.is_local:
+        _create([WireguardKernelIntent(interface_name=interface.name, kind=WireguardKernelIntent.PEER,
+                                       public_key=public_key, address=address)])
+
+
+def enqueue_interface(interface):
+    """
+    Reconcile an interface after commit.
+
+    :param interface: WireguardInterface
+    """
+    from django_wireguard.models import WireguardKernelIntent
+
+    if interface.is_local:
+        _create([WireguardKernelIntent(interface_name=interface.name, kind=WireguardKernelIntent.INTERFACE)])
+
+
+def enqueue_interface_deletion(interface):
+    """
+    Delete an interface after commit.
+
+    :param interface: WireguardInterface
+    """
+    from django_wireguard.models import WireguardKernelIntent
+
+    if interface.is_local:
+        _create([WireguardKernelIntent(interface_name=interface.name, kind=WireguardKernelIntent.DELETE)])
+
+
+def _dispatch():
+    from kombu.exceptions import OperationalError
+    from django_wireguard.models import WireguardKernelIntent
+    from django_wireguard.tasks import apply_kernel_intents
+
+    # the first dispatch of a commit takes all its intents, the next ones find none
+    intents = getattr(connection, '_wireguard_intents', None)
+    if not intents:
+        return
+    connection._wireguard_intents = []
+    pks = [intent.pk for intent in intents]
+
+    backlog = True
+    if None not in pks:
+        with _host_lock(blocking=False) as locked:
+            if locked:
+                try:
+                    _apply(list(WireguardKernelIntent.objects.filter(pk__in=pks).order_by('pk')))
+                    backlog = WireguardKernelIntent.objects.due().exists()
+                except Exception:
+                    # the change is committed, its intents are retried by the worker
+                    pass
+    if not backlog:
+        return
+    try:
+        apply_kernel_intents.delay()
+    except OperationalError:
+        # the periodic task catches up
+        pass
+
+
+@contextmanager
+def _host_lock(blocking: bool = True):
+    fd = os.open(settings.WIREGUARD_OUTBOX_LOCK_FILE, os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+    finally:
+        os.close(fd)
+
+
+def apply_intents() -> List:
+    """
+    Apply the due intents, waiting for the host lock.
+
+    :return: the errors of the failed intents, which are retried later
+    """
+    with _host_lock():
+        return _apply_due()
+
+
+def _apply_due() -> List:
+    from django_wireguard.models import WireguardKernelIntent
+
+    errors = []
+    while True:
+        intents = list(WireguardKernelIntent.objects.due().order_by('pk')[:settings.WIREGUARD_OUTBOX_BATCH_SIZE])
+        if not intents:
+            return errors
+        errors += _apply(intents)
+
+
+def _apply(intents: list) -> List:
+    from django_wireguard.models import WireguardKernelIntent
+
+    errors = []
+    by_interface = {}
+    for intent in intents:
+        by_interface.setdefault(intent.interface_name, []).append(intent)
+    for interface_name, interface_intents in by_interface.items():
+        try:
+            interface_errors = _apply_interface(interface_name, interface_intents)
+        except Exception as e:
+            interface_errors = [e]
+        if interface_errors:
+            _retry(interface_intents, interface_errors)
+            errors += interface_errors
+        else:
+            WireguardKernelIntent.objects.filter(pk__in=[intent.pk for intent in interface_intents]).delete()
+    return errors
+
+
+def _retry(intents: list, errors: list):
+    from django_wireguard.models import WireguardKernelIntent
+
+    now = timezone.now()
+    for intent in intents:
+        intent.attempts += 1
+        delay = min(settings.WIREGUARD_OUTBOX_RETRY_DELAY * 2 ** (intent.attempts - 1),
+                    settings.WIREGUARD_OUTBOX_MAX_RETRY_DELAY)
+        intent.next_attempt_at = now + timedelta(seconds=delay)
+        intent.last_error = '\n'.join(repr(error) for error in errors)[:1000]
+    WireguardKernelIntent.objects.bulk_update(intents, ['attempts', 'next_attempt_at', 'last_error'],
+                                              batch_size=_BATCH_SIZE)
+
+
+def _apply_interface(interface_name: str, intents: list) -> List:
+    from django_wireguard.models import WireguardInterface, WireguardKernelIntent, WireguardPeer
+    from django_wireguard.firewall import get_firewall
+    from django_wireguard.provisioning import push_peers
+    from django_wireguard.reconcile import reconcile
+    from django_wireguard.shaping import Shaper
+    from django_wireguard.wireguard import WireGuard
+
+    interface = WireguardInterface.objects.filter(name=interface_name).first()
+    if interface is None or not interface.is_local:
+        if any(intent.kind == WireguardKernelIntent.DELETE for intent in intents):
+            wg = WireGuard.get_interface(interface_name)
+            if wg is not None:
+                wg.delete()
+            get_firewall().teardown(interface_name)
+        return []
+
+    if any(intent.kind != WireguardKernelIntent.PEER for intent in intents):
+        # the diff-based reconciliation also brings every peer of the interface in line
+        return [error for plan in reconcile([interface]) for error in plan.errors]
+
+    keys = {intent.public_key: intent.address for intent in intents}
+    peers = WireguardPeer.objects.select_related('interface_ip__interface').in_bulk_by_public_key(keys)
+    enabled = [peer for peer in peers.values() if peer.status and peer.interface_ip.interface_id == interface.pk]
+    enabled_keys = {peer.public_key for peer in enabled}
+    removed = {public_key: address for public_key, address in keys.items() if public_key not in enabled_keys}
+    for public_key in removed:
+        if public_key in peers and peers[public_key].address:
+            removed[public_key] = peers[public_key].address
+
+    errors = []
+    if removed:
+        errors += interface.wg.apply_peers([{'public_key': public_key, 'remove': True} for public_key in removed])
+        if settings.WIREGUARD_SHAPING:
+            addresses = {address for address in removed.values() if address}
+            # the address of a deleted peer may already be reused
+            addresses -= set(WireguardPeer.objects.filter(interface_ip__interface=interface, status=True,
+                                                          address__in=addresses).values_list('address', flat=True))
+            Shaper(interface.name).remove(addresses)
+    errors += push_peers(enabled)
+    return errors
@@ -0,0 +1,192 @@
+"""
+Placement of new peers on interface addresses.
+
+A strategy picks the :class:`~django_wireguard.models.WireguardIPAddress` of a new peer
+among the ones with free addresses, from their free capacity, the number of peers of
+their interface and the traffic their interface carries in the current hour.
+Spreading peers over several interfaces spreads them over several devices, ports and
+CPU queues.
+
+The strategy is selected with ``WIREGUARD_PLACEMENT_STRATEGY``: one of
+:data:`PLACEMENT_STRATEGIES` or the dotted path of a custom :class:`PlacementStrategy`.
+"""
+from typing import List, Optional
+
+from django.db.models import Count, Sum, F
+from django.utils.module_loading import import_string
+
+from django_wireguard import settings
+
+
+__all__ = ('PlacementException', 'PlacementCandidate', 'PlacementStrategy', 'MostFreeStrategy',
+           'LeastPeersStrategy', 'LeastTrafficStrategy', 'BalancedStrategy', 'PLACEMENT_STRATEGIES',
+           'get_placement_strategy', 'get_placement_candidates', 'choose_interface_ip')
+
+
+class PlacementException(Exception):
+    """
+    Exception raised when no interface address has room for a new peer.
+    """
+
+
+class PlacementCandidate:
+    """
+    Load of an interface address.
+
+    :param interface_ip: WireguardIPAddress
+    :param capacity: number of peer addresses of the subnet
+    :param free: free addresses, including the ones reserved in the pool
+    :param peers: number of peers of the interface
+    :param traffic: bytes exchanged by the interface peers in the current hour
+    """
+    __slots__ = ('interface_ip', 'capacity', 'free', 'peers', 'traffic')
+
+    def __init__(self, interface_ip, capacity: int, free: int, peers: int, traffic: int):
+        self.interface_ip = interface_ip
+        self.capacity = capacity
+        self.free = free
+        self.peers = peers
+        self.traffic = traffic
+
+    def __repr__(self):
+        return (f"<PlacementCandidate {self.interface_ip.address} free={self.free}/{self.capacity} "
+                f"peers={self.peers} traffic={self.traffic}>")
+
+
+class PlacementStrategy:
+    """
+    Base placement strategy, picks the candidate with the lowest :meth:`score`.
+    """
+    name = None
+
+    def score(self, candidate: PlacementCandidate, candidates: List[PlacementCandidate]):
+        raise NotImplementedError
+
+    def choose(self, candidates: List[PlacementCandidate]) -> Optional[PlacementCandidate]:
+        """
+        Pick a candidate with free addresses.
+
+        :param candidates: interface address loads
+        :return: the chosen candidate, None if all subnets are full
+        """
+        candidates = [candidate for candidate in candidates if candidate.free > 0]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda candidate: (self.score(candidate, candidates),
+                                                      candidate.interface_ip.pk))
+
+
+class MostFreeStrategy(PlacementStrategy):
+    """
+    Fill the subnet with the most free addresses.
+    """
+    name = 'most_free'
+
+    def score(self, candidate, candidates):
+        return -candidate.free
+
+
+class LeastPeersStrategy(PlacementStrategy):
+    """
+    Place on the interface with the fewest peers.
+    """
+    name = 'least_peers'
+
+    def score(self, candidate, candidates):
+        return candidate.peers
+
+
+class LeastTrafficStrategy(PlacementStrategy):
+    """
+    Place on the interface carrying the least traffic in the current hour.
+    """
+    name = 'least_traffic'
+
+    def score(self, candidate, candidates):
+        return candidate.traffic, candidate.peers
+
+
+class BalancedStrategy(PlacementStrategy):
+    """
+    Weigh the interface traffic and peers and the subnet fill, each relative to the busiest candidate.
+    """
+    name = 'balanced'
+
+    def score(self, candidate, candidates):
+        max_traffic = max(item.traffic for item in candidates) or 1
+        max_peers = max(item.peers for item in candidates) or 1
+        fill = 1 - candidate.free / candidate.capacity if candidate.capacity else 1
+        return candidate.traffic / max_traffic + candidate.peers / max_peers + fill
+
+
+PLACEMENT_STRATEGIES = {strategy.name: strategy for strategy in (MostFreeStrategy, LeastPeersStrategy,
+                                                                 LeastTrafficStrategy, BalancedStrategy)}
+
+
+def get_placement_strategy(name: Optional[str] = None) -> PlacementStrategy:
+    """
+    Return a placement strategy, ``WIREGUARD_PLACEMENT_STRATEGY`` by default.
+
+    :param name: strategy name or dotted path of a PlacementStrategy subclass
+    :rtype: PlacementStrategy
+    """
+    name = name or settings.WIREGUARD_PLACEMENT_STRATEGY
+    strategy = PLACEMENT_STRATEGIES.get(name)
+    if strategy is None:
+        try:
+            strategy = import_string(name)
+        except ImportError:
+            raise PlacementException(f"Unknown placement strategy {name}")
+    return strategy()
+
+
+def get_placement_candidates(queryset=None) -> List[PlacementCandidate]:
+    """
+    Measure the load of interface addresses with one query per model.
+
+    :param queryset: WireguardIPAddresses to consider, all of them by default
+    :return: one candidate per interface address
+    """
+    from django_wireguard.allocator import AddressBitmap
+    from django_wireguard.models import WireguardIPAddress, WireguardPeerTraffic
+
+    if queryset is None:
+        queryset = WireguardIPAddress.objects.all()
+    interface_ips = list(queryset.select_related('interface')
+                         .annotate(pooled=Count('pool', distinct=True)))
+    interface_ids = {interface_ip.interface_id for interface_ip in interface_ips}
+
+    peers = dict(WireguardIPAddress.objects
+                 .filter(interface__in=interface_ids)
+                 .values('interface_id')
+                 .annotate(count=Count('peer'))
+                 .values_list('interface_id', 'count'))
+    traffic = dict(WireguardPeerTraffic.objects
+                   .filter(peer__interface_ip__interface__in=interface_ids)
+                   .values('peer__interface_ip__interface_id')
+                   .annotate(total=Sum(F('hour_rx_bytes') + F('hour_tx_bytes')))
+                   .values_list('peer__interface_ip__interface_id', 'total'))
+
+    candidates = []
+    for interface_ip in interface_ips:
+        capacity = AddressBitmap(interface_ip.address).free
+        candidates.append(PlacementCandidate(interface_ip,
+                                             capacity=capacity,
+                                             free=interface_ip.get_free_address_count() + interface_ip.pooled,
+                                             peers=peers.get(interface_ip.interface_id, 0),
+                                             traffic=traffic.get(interface_ip.interface_id) or 0))
+    return candidates
+
+
+def choose_interface_ip(strategy: Optional[str] = None, queryset=None):
+    """
+    Choose the interface address of a new peer.
+
+    :param strategy: strategy name or dotted path, ``WIREGUARD_PLACEMENT_STRATEGY`` by default
+    :param queryset: WireguardIPAddresses to consider, all of them by default
+    :return: WireguardIPAddress
+    """
+    candidate = get_placement_strategy(strategy).choose(get_placement_candidates(queryset))
+    if candidate is None:
+        raise PlacementException("WireGuard interface's subnets have no available IP left")
+    return candidate.interface_ip
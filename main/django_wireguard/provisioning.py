@@ -0,0 +1,117 @@
+"""
+Bulk peer provisioning.
+
+:func:`create_peers` inserts many peers of an interface address with one ``bulk_create``,
+bypassing the per-peer ``pre_save`` receiver: addresses and keys come from the warm pool
+first, then from one bitmap allocation and a batch of generated keys. :func:`set_peers_status`
+enables or disables many peers with one update. Both record kernel intents in the outbox,
+applied once the transaction is committed with :func:`push_peers`: one batched call and
+one ``tc`` batch per interface.
+"""
+from typing import Iterable, List
+
+from django.db import transaction
+
+from django_wireguard.configs import new_config_version
+from django_wireguard.outbox import enqueue_peers
+from django_wireguard.shaping import apply_peer_limits
+from django_wireguard.wireguard import PrivateKey, PeerChunkError
+
+
+__all__ = ('ProvisioningException', 'create_peers', 'push_peers', 'set_peers_status')
+
+
+_BATCH_SIZE = 500
+
+
+class ProvisioningException(Exception):
+    """
+    Exception raised when an interface address has not enough free addresses for the new peers.
+    """
+
+
+def create_peers(interface_ip, names: List[str], **fields) -> List:
+    """
+    Create peers of an interface address in bulk, the kernel is synced once the transaction is committed.
+
+    :param interface_ip: WireguardIPAddress of the new peers
+    :param names: names of the new peers, one peer per name
+    :param fields: other WireguardPeer fields, e.g. ``dns`` or ``allowed_networks``
+    :return: the created WireguardPeers
+    """
+    from django_wireguard.allocator import allocate_addresses
+    from django_wireguard.models import WireguardPeer, WireguardPoolEntry
+
+    if not names:
+        return []
+    with transaction.atomic():
+        entries = WireguardPoolEntry.objects.claim_many(interface_ip, len(names))
+        addresses = allocate_addresses(interface_ip, len(names) - len(entries))
+        if len(entries) + len(addresses) < len(names):
+            raise ProvisioningException(f"{interface_ip.address} has no room for {len(names)} peers")
+
+        peers = []
+        for name, entry in zip(names, entries):
+            peers.append(WireguardPeer(interface_ip=interface_ip, name=name, address=entry.address,
+                                       private_key=entry.private_key, public_key=entry.public_key,
+                                       preshared_key=entry.preshared_key, **fields))
+        for name, address in zip(names[len(entries):], addresses):
+            private_key = PrivateKey.generate()
+            peers.append(WireguardPeer(interface_ip=interface_ip, name=name, address=address,
+                                       private_key=str(private_key), public_key=str(private_key.public_key()),
+                                       preshared_key=str(PrivateKey.generate()), **fields))
+        version = new_config_version()
+        for peer in peers:
+            peer.config_version = version
+            peer._store_loaded_values()
+        WireguardPeer.objects.bulk_create(peers, batch_size=_BATCH_SIZE)
+        enqueue_peers(peers)
+    return peers
+
+
+def push_peers(peers: Iterable) -> List[PeerChunkError]:
+    """
+    Program new or changed peers into the kernel with one batched call per interface.
+
+    Used by the outbox worker, which holds the kernel lock.
+
+    Node interfaces are left to their agent, disabled peers are skipped.
+
+    :param peers: WireguardPeers, with ``interface_ip__interface`` selected to save queries
+    :return: the failed chunks
+    """
+    peers = list(peers)
+    interfaces, structs = {}, {}
+    for peer in peers:
+        interface = peer.interface_ip.interface
+        if peer.status and interface.is_local:
+            interfaces[interface.pk] = interface
+            structs.setdefault(interface.pk, []).append({'public_key': peer.public_key,
+                                                         'preshared_key': peer.preshared_key,
+                                                         'allowed_ips': [peer.get_interface_allowed_ip()]})
+    errors = []
+    for interface_id, interface_structs in structs.items():
+        errors += interfaces[interface_id].wg.apply_peers(interface_structs)
+    apply_peer_limits(peers)
+    return errors
+
+
+def set_peers_status(queryset, status: bool) -> List:
+    """
+    Enable or disable peers with one update, the kernel is synced once the transaction is committed.
+
+    :param queryset: WireguardPeers
+    :param status: new status
+    :return: the WireguardPeers whose status changed
+    """
+    from django_wireguard.models import WireguardPeer
+
+    peers = list(queryset.exclude(status=status).select_related('interface_ip__interface'))
+    if not peers:
+        return []
+    # update() skips the peer receivers, the kernel is synced in batch below
+    WireguardPeer.objects.filter(pk__in=[peer.pk for peer in peers]).update(status=status)
+    for peer in peers:
+        peer.status = status
+    enqueue_peers(peers)
+    return peers
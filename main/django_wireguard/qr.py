@@ -0,0 +1,104 @@
+"""
+QR codes of peer configurations, rendered in memory.
+
+Images are kept in a per-process LRU cache keyed by the SHA-256 of the configuration,
+a configuration change gives a new key. :func:`submit_qr_png` renders in a shared
+thread pool, so a slow render does not hold the caller.
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from io import BytesIO
+
+import qrcode
+import qrcode.image.svg
+
+from django_wireguard import settings
+
+
+__all__ = ('render_qr_png', 'render_qr_svg', 'submit_qr_png', 'clear_qr_cache')
+
+
+_cache = OrderedDict()
+_lock = threading.Lock()
+_executor = None
+
+
+def _make_qr(text: str, box_size: int) -> qrcode.QRCode:
+    qr = qrcode.QRCode(
+        version=None,
+        error_correction=qrcode.constants.ERROR_CORRECT_L,
+        box_size=box_size,
+        border=4,
+    )
+    qr.add_data(text)
+    qr.make(fit=True)
+    return qr
+
+
+def _cached(kind: str, text: str, render):
+    key = (kind, hashlib.sha256(text.encode('utf-8')).digest())
+    with _lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key]
+    # rendered outside the lock, two threads may render the same image once each
+    image = render(text)
+    with _lock:
+        _cache[key] = image
+        _cache.move_to_end(key)
+        while len(_cache) > settings.WIREGUARD_QR_CACHE_SIZE:
+            _cache.popitem(last=False)
+    return image
+
+
+def _render_png(text: str) -> bytes:
+    buffer = BytesIO()
+    _make_qr(text, box_size=10).make_image(fill_color="black", back_color="white").save(buffer)
+    return buffer.getvalue()
+
+
+def _render_svg(text: str) -> str:
+    image = _make_qr(text, box_size=10).make_image(image_factory=qrcode.image.svg.SvgPathImage)
+    return image.to_string(encoding='unicode')
+
+
+def render_qr_png(text: str) -> bytes:
+    """
+    PNG QR code of a text.
+
+    :param text: peer configuration
+    :return: PNG image
+    """
+    return _cached('png', text, _render_png)
+
+
+def render_qr_svg(text: str) -> str:
+    """
+    SVG QR code of a text, drawn as a single path.
+
+    :param text: peer configuration
+    :return: SVG document
+    """
+    return _cached('svg', text, _render_svg)
+
+
+def submit_qr_png(text: str) -> Future:
+    """
+    Render a PNG QR code in the worker pool.
+
+    :param text: peer configuration
+    :return: future of the PNG image
+    """
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=settings.WIREGUARD_QR_WORKERS,
+                                           thread_name_prefix='wireguard-qr')
+    return _executor.submit(render_qr_png, text)
+
+
+def clear_qr_cache():
+    with _lock:
+        _cache.clear()
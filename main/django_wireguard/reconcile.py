@@ -0,0 +1,238 @@
+"""
+Diff-based synchronization of the database WireGuard configuration with the kernel.
+
+The live state of every interface is dumped once and compared with the
+:class:`~django_wireguard.models.WireguardInterface`, :class:`~django_wireguard.models.WireguardIPAddress`
+and :class:`~django_wireguard.models.WireguardPeer` rows. Only the differences are applied:
+missing or changed peers are set in batch, peers unknown to the database are removed.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from ipaddress import IPv4Interface
+from time import monotonic
+from typing import List, Optional, Union, Iterable
+
+from django.db.models import QuerySet
+
+from django_wireguard import settings
+from django_wireguard.firewall import InterfaceRules, get_firewall
+from django_wireguard.shaping import PeerLimit, Shaper, get_peer_limits
+from django_wireguard.wireguard import WireGuard, PrivateKey
+
+
+__all__ = ('DesiredInterface', 'ReconcilePlan', 'load_desired_state', 'reconcile', 'reconcile_interfaces')
+
+
+class DesiredInterface:
+    """
+    Interface configuration as stored in the database.
+
+    :param name: WireGuard interface name
+    :param private_key: interface private key
+    :param listen_port: interface listen port
+    :param addresses: interface addresses (IP with CIDR)
+    :param peers: enabled peer structs by public key
+    :param limits: bandwidth limits of the enabled peers
+    """
+    __slots__ = ('name', 'private_key', 'listen_port', 'addresses', 'peers', 'limits')
+
+    def __init__(self, name: str, private_key: str, listen_port: int, addresses: List[str], peers: dict,
+                 limits: Optional[list] = None):
+        self.name = name
+        self.private_key = private_key
+        self.listen_port = listen_port
+        self.addresses = addresses
+        self.peers = peers
+        self.limits = limits if limits is not None else []
+
+    def to_dict(self) -> dict:
+        return {
+            'name': self.name,
+            'private_key': self.private_key,
+            'listen_port': self.listen_port,
+            'addresses': self.addresses,
+            'peers': list(self.peers.values()),
+            'limits': [[limit.address, limit.rate_down, limit.rate_up, limit.handle] for limit in self.limits],
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'DesiredInterface':
+        return cls(data['name'], data['private_key'], data['listen_port'], list(data['addresses']),
+                   {peer['public_key']: peer for peer in data['peers']},
+                   [PeerLimit(*limit) for limit in data.get('limits', ())])
+
+
+class ReconcilePlan:
+    """
+    Changes needed to bring one kernel interface in line with the database.
+
+    After :func:`reconcile` ran, ``errors`` holds the failures and ``duration``
+    the seconds spent on the interface.
+    """
+    __slots__ = ('interface_name', 'create', 'interface_settings', 'addresses_to_add', 'addresses_to_remove',
+                 'peers_to_add', 'peers_to_update', 'peers_to_remove', 'firewall', 'shaping', 'errors', 'duration')
+
+    def __init__(self, interface_name: str):
+        self.interface_name = interface_name
+        self.create = False
+        self.interface_settings = {}
+        self.addresses_to_add = []
+        self.addresses_to_remove = []
+        self.peers_to_add = []
+        self.peers_to_update = []
+        self.peers_to_remove = []
+        self.firewall = ''
+        self.shaping = ''
+        self.errors = []
+        self.duration = 0.0
+
+    def is_empty(self) -> bool:
+        return not (self.create or self.interface_settings or self.addresses_to_add or self.addresses_to_remove
+                    or self.peers_to_add or self.peers_to_update or self.peers_to_remove)
+
+    def summary(self) -> str:
+        changes = []
+        if self.create:
+            changes.append("created")
+        if self.interface_settings:
+            changes.append(f"settings: {', '.join(sorted(self.interface_settings))}")
+        changes.append(f"addresses +{len(self.addresses_to_add)} -{len(self.addresses_to_remove)}")
+        changes.append(f"peers +{len(self.peers_to_add)} ~{len(self.peers_to_update)} -{len(self.peers_to_remove)}")
+        return f"{self.interface_name}: {', '.join(changes)}"
+
+
+def load_desired_state(queryset: Optional[Union[QuerySet, Iterable]] = None,
+                       limits: Optional[bool] = None) -> List[DesiredInterface]:
+    """
+    Load the configuration of the interfaces with one query per model.
+
+    :param queryset: WireguardInterfaces to load, the local ones by default
+    :param limits: resolve the peer bandwidth limits, defaults to ``WIREGUARD_SHAPING``
+    :return: desired state of each interface
+    """
+    from django_wireguard.models import WireguardInterface, WireguardIPAddress, WireguardPeer
+
+    if limits is None:
+        limits = settings.WIREGUARD_SHAPING
+    if queryset is None:
+        queryset = WireguardInterface.objects.local()
+    elif isinstance(queryset, WireguardInterface):
+        queryset = [queryset]
+
+    interfaces = {interface.pk: DesiredInterface(interface.name, interface.private_key, interface.listen_port, [], {})
+                  for interface in queryset}
+
+    addresses = WireguardIPAddress.objects.filter(interface__in=interfaces.keys())
+    for interface_id, address in addresses.values_list('interface_id', 'address'):
+        interfaces[interface_id].addresses.append(str(IPv4Interface(address)))
+
+    peers = (WireguardPeer.objects
+             .filter(status=True, interface_ip__interface__in=interfaces.keys())
+             .select_related('interface_ip')
+             .only('public_key', 'private_key', 'preshared_key', 'address', 'rate_limit_down', 'rate_limit_up',
+                   'interface_ip__interface_id'))
+    if limits:
+        peers = list(peers)
+        peer_interfaces = {peer.pk: peer.interface_ip.interface_id for peer in peers}
+        for peer_id, limit in get_peer_limits(peers).items():
+            interfaces[peer_interfaces[peer_id]].limits.append(limit)
+    for peer in peers:
+        public_key = peer.public_key or str(PrivateKey(peer.private_key).public_key())
+        interfaces[peer.interface_ip.interface_id].peers[public_key] = {
+            'public_key': public_key,
+            'preshared_key': peer.preshared_key,
+            'allowed_ips': [peer.get_interface_allowed_ip()],
+        }
+
+    return list(interfaces.values())
+
+
+def _plan_peers(plan: ReconcilePlan, desired: DesiredInterface, live_peers: dict):
+    for public_key, peer in desired.peers.items():
+        live = live_peers.get(public_key)
+        if live is None:
+            plan.peers_to_add.append(peer)
+        elif sorted(live.allowed_ips) != sorted(peer['allowed_ips']) or (
+                live.preshared_key is not None and live.preshared_key != peer['preshared_key']):
+            plan.peers_to_update.append({**peer, 'replace_allowed_ips': True})
+    plan.peers_to_remove = [public_key for public_key in live_peers if public_key not in desired.peers]
+
+
+def _reconcile_interface(desired: DesiredInterface, dry_run: bool, rebuild_shaping: bool) -> ReconcilePlan:
+    plan = ReconcilePlan(desired.name)
+    start = monotonic()
+    try:
+        wg = WireGuard.get_interface(desired.name)
+        if wg is None:
+            plan.create = True
+            if not dry_run:
+                wg = WireGuard.create_interface(desired.name)
+
+        if wg is None:
+            device, live_addresses = None, []
+        else:
+            device = wg.dump()
+            live_addresses = [str(IPv4Interface(address)) for address in wg.get_ip_addresses()]
+
+        if device is None or device.private_key != desired.private_key:
+            plan.interface_settings['private_key'] = desired.private_key
+        if device is None or device.listen_port != desired.listen_port:
+            plan.interface_settings['listen_port'] = desired.listen_port
+        plan.addresses_to_add = [address for address in desired.addresses if address not in live_addresses]
+        plan.addresses_to_remove = [address for address in live_addresses if address not in desired.addresses]
+        _plan_peers(plan, desired, device.peers if device else {})
+
+        plan.firewall = get_firewall().apply(InterfaceRules(desired.name, desired.listen_port, desired.addresses),
+                                             dry_run=dry_run)
+        if not dry_run and not plan.is_empty():
+            if plan.interface_settings:
+                wg.set_interface(**plan.interface_settings)
+            if plan.addresses_to_remove:
+                wg.del_ip_addresses(plan.addresses_to_remove)
+            if plan.addresses_to_add:
+                wg.set_ip_addresses(plan.addresses_to_add)
+            removals = [{'public_key': public_key, 'remove': True} for public_key in plan.peers_to_remove]
+            plan.errors += wg.apply_peers(removals + plan.peers_to_add + plan.peers_to_update)
+        if settings.WIREGUARD_SHAPING and (wg is not None or dry_run):
+            shaper = Shaper(desired.name)
+            plan.shaping = (shaper.rebuild if rebuild_shaping else shaper.sync)(desired.limits, dry_run=dry_run)
+    except Exception as e:
+        plan.errors.append(e)
+    plan.duration = monotonic() - start
+    return plan
+
+
+def reconcile(queryset: Optional[Union[QuerySet, Iterable]] = None, dry_run: bool = False,
+              workers: Optional[int] = None, rebuild_shaping: bool = False) -> List[ReconcilePlan]:
+    """
+    Bring the kernel WireGuard interfaces in line with the database.
+
+    Interfaces are processed in parallel, each one with a single dump and
+    the minimal set of changes.
+
+    :param queryset: WireguardInterfaces to reconcile, the local ones by default
+    :param dry_run: only compute the plans, without touching the kernel or the firewall
+    :param workers: number of interfaces processed at once, defaults to ``WIREGUARD_RECONCILE_WORKERS``
+    :param rebuild_shaping: rebuild the ``tc`` shaping from scratch instead of applying the differences
+    :return: the plan of each interface, with errors and durations
+    """
+    return reconcile_interfaces(load_desired_state(queryset), dry_run=dry_run, workers=workers,
+                                rebuild_shaping=rebuild_shaping)
+
+
+def reconcile_interfaces(interfaces: List[DesiredInterface], dry_run: bool = False,
+                         workers: Optional[int] = None, rebuild_shaping: bool = False) -> List[ReconcilePlan]:
+    """
+    Bring the kernel WireGuard interfaces in line with a desired state, e.g. pulled by a node agent.
+
+    :param interfaces: desired state of each interface
+    :param dry_run: only compute the plans, without touching the kernel or the firewall
+    :param workers: number of interfaces processed at once, defaults to ``WIREGUARD_RECONCILE_WORKERS``
+    :param rebuild_shaping: rebuild the ``tc`` shaping from scratch instead of applying the differences
+    :return: the plan of each interface, with errors and durations
+    """
+    if not interfaces:
+        return []
+    workers = workers or settings.WIREGUARD_RECONCILE_WORKERS
+    with ThreadPoolExecutor(max_workers=min(workers, len(interfaces))) as executor:
+        return list(executor.map(lambda interface: _reconcile_interface(interface, dry_run, rebuild_shaping),
+                                 interfaces))
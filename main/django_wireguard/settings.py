@@ -1,6 +1,9 @@
 """
 Default settings for `django_wireguard` package.
 """
+import os
+import tempfile
+
 from django.conf import settings
 
 WIREGUARD_ENDPOINT = getattr(settings, 'WIREGUARD_ENDPOINT', 'localhost')
@@ -13,3 +16,115 @@ WIREGUARD_WAGTAIL_SHOW_IN_SETTINGS = getattr(settings, 'WIREGUARD_WAGTAIL_SHOW_I
 """Set this to False to show WireGuard models in root sidebar instead of settings panel."""
 
 WIREGUARD_OUTPUT_INTERFACE = getattr(settings, 'WIREGUARD_OUTPUT_INTERFACE', 'eth0')
+
+WIREGUARD_NETLINK_MESSAGE_SIZE = getattr(settings, 'WIREGUARD_NETLINK_MESSAGE_SIZE', 16384)
+"""Max size in bytes of a batched peer set-device netlink message."""
+
+WIREGUARD_SNAPSHOT_TTL = getattr(settings, 'WIREGUARD_SNAPSHOT_TTL', 10)
+"""Seconds an interface peer dump is reused for handshake and activity lookups."""
+
+WIREGUARD_FIREWALL_BACKEND = getattr(settings, 'WIREGUARD_FIREWALL_BACKEND', 'iptables')
+"""Firewall backend used for the interfaces rules: ``iptables`` (with ipset) or ``nftables``."""
+
+WIREGUARD_FIREWALL_DRY_RUN = getattr(settings, 'WIREGUARD_FIREWALL_DRY_RUN', False)
+"""Set this to True to render the firewall rules without applying them."""
+
+WIREGUARD_FIREWALL_REJECTED_NETWORKS = getattr(settings, 'WIREGUARD_FIREWALL_REJECTED_NETWORKS', ['10.8.88.253/32'])
+"""Networks the peers are not allowed to reach."""
+
+WIREGUARD_RECONCILE_WORKERS = getattr(settings, 'WIREGUARD_RECONCILE_WORKERS', 4)
+"""Number of interfaces reconciled in parallel by ``start_wireguard``."""
+
+WIREGUARD_BACKEND = getattr(settings, 'WIREGUARD_BACKEND', 'netlink')
+"""
+WireGuard device backend: ``netlink`` for the kernel module, ``uapi`` for a userspace
+implementation (wireguard-go, boringtun) or the dotted path of a custom backend class.
+"""
+
+WIREGUARD_UAPI_SOCKET_DIR = getattr(settings, 'WIREGUARD_UAPI_SOCKET_DIR', '/var/run/wireguard')
+"""Directory holding the ``<interface>.sock`` UAPI sockets of the userspace implementation."""
+
+WIREGUARD_UAPI_COMMAND = getattr(settings, 'WIREGUARD_UAPI_COMMAND', ['wireguard-go'])
+"""Command starting a userspace interface, the interface name is appended."""
+
+WIREGUARD_UAPI_TIMEOUT = getattr(settings, 'WIREGUARD_UAPI_TIMEOUT', 10)
+"""Seconds to wait for UAPI socket operations and for a new interface socket to appear."""
+
+WIREGUARD_POOL_SIZE = getattr(settings, 'WIREGUARD_POOL_SIZE', 32)
+"""Number of key pairs and addresses kept ready for new peers per interface address, 0 disables the pool."""
+
+WIREGUARD_POOL_LOW_WATERMARK = getattr(settings, 'WIREGUARD_POOL_LOW_WATERMARK', 8)
+"""A pool refill is queued when a peer creation leaves fewer entries than this."""
+
+WIREGUARD_METERING_SAMPLE_RETENTION = getattr(settings, 'WIREGUARD_METERING_SAMPLE_RETENTION', 6)
+"""Hours the per-run traffic samples are kept."""
+
+WIREGUARD_METERING_HOURLY_RETENTION = getattr(settings, 'WIREGUARD_METERING_HOURLY_RETENTION', 31)
+"""Days the hourly traffic rollups are kept."""
+
+WIREGUARD_METERING_DAILY_RETENTION = getattr(settings, 'WIREGUARD_METERING_DAILY_RETENTION', 730)
+"""Days the daily traffic rollups are kept."""
+
+WIREGUARD_SHAPING = getattr(settings, 'WIREGUARD_SHAPING', False)
+"""Set this to True to enforce the peers bandwidth limits with ``tc`` on the WireGuard interfaces."""
+
+WIREGUARD_SHAPING_DRY_RUN = getattr(settings, 'WIREGUARD_SHAPING_DRY_RUN', False)
+"""Set this to True to render the ``tc`` commands without running them."""
+
+WIREGUARD_SHAPING_LINK_RATE = getattr(settings, 'WIREGUARD_SHAPING_LINK_RATE', '10gbit')
+"""Rate of the default class, shared by the peers without a download limit."""
+
+WIREGUARD_RATE_LIMITS_PROVIDER = getattr(settings, 'WIREGUARD_RATE_LIMITS_PROVIDER', None)
+"""
+Dotted path of a function returning ``{peer_pk: (rate_down, rate_up)}`` in kbit/s for a list of peer
+primary keys, used for the peers without their own limits.
+"""
+
+WIREGUARD_PLACEMENT_STRATEGY = getattr(settings, 'WIREGUARD_PLACEMENT_STRATEGY', 'balanced')
+"""
+Placement of new peers: ``balanced``, ``most_free``, ``least_peers``, ``least_traffic``
+or the dotted path of a custom ``PlacementStrategy``.
+"""
+
+WIREGUARD_AGENT_URL = getattr(settings, 'WIREGUARD_AGENT_URL', None)
+"""Base URL of the control plane node API used by ``wireguard_agent``, e.g. ``https://vpn.example.com/api/wireguard/``."""
+
+WIREGUARD_AGENT_TOKEN = getattr(settings, 'WIREGUARD_AGENT_TOKEN', None)
+"""Token of the node running ``wireguard_agent``."""
+
+WIREGUARD_AGENT_INTERVAL = getattr(settings, 'WIREGUARD_AGENT_INTERVAL', 30)
+"""Seconds between two ``wireguard_agent`` cycles."""
+
+WIREGUARD_AGENT_TIMEOUT = getattr(settings, 'WIREGUARD_AGENT_TIMEOUT', 10)
+"""Seconds to wait for the control plane API."""
+
+WIREGUARD_CONFIG_CACHE = getattr(settings, 'WIREGUARD_CONFIG_CACHE', 'default')
+"""Alias of the cache holding the rendered peer configurations."""
+
+WIREGUARD_CONFIG_CACHE_TIMEOUT = getattr(settings, 'WIREGUARD_CONFIG_CACHE_TIMEOUT', 7 * 24 * 3600)
+"""Seconds a rendered peer configuration is kept, stale versions are never read again."""
+
+WIREGUARD_QR_CACHE_SIZE = getattr(settings, 'WIREGUARD_QR_CACHE_SIZE', 256)
+"""Number of rendered QR codes kept in memory per process."""
+
+WIREGUARD_QR_WORKERS = getattr(settings, 'WIREGUARD_QR_WORKERS', 4)
+"""Number of threads rendering QR codes in the background."""
+
+WIREGUARD_ADMIN_QR_SVG = getattr(settings, 'WIREGUARD_ADMIN_QR_SVG', False)
+"""Set this to True to render the peer QR code as SVG on the server instead of with JavaScript in the admin."""
+
+WIREGUARD_OUTBOX_LOCK_FILE = getattr(settings, 'WIREGUARD_OUTBOX_LOCK_FILE',
+                                     os.path.join(tempfile.gettempdir(), 'django_wireguard.lock'))
+"""Lock file serializing the kernel changes of every process of this host."""
+
+WIREGUARD_OUTBOX_BATCH_SIZE = getattr(settings, 'WIREGUARD_OUTBOX_BATCH_SIZE', 5000)
+"""Number of kernel intents applied per round."""
+
+WIREGUARD_OUTBOX_RETRY_DELAY = getattr(settings, 'WIREGUARD_OUTBOX_RETRY_DELAY', 5)
+"""Seconds before the first retry of a failed kernel intent, doubled on every failure."""
+
+WIREGUARD_OUTBOX_MAX_RETRY_DELAY = getattr(settings, 'WIREGUARD_OUTBOX_MAX_RETRY_DELAY', 300)
+"""Maximum seconds between two retries of a failed kernel intent."""
+
+WIREGUARD_OUTBOX_MAX_ATTEMPTS = getattr(settings, 'WIREGUARD_OUTBOX_MAX_ATTEMPTS', 10)
+"""Failed attempts after which a kernel intent is no longer retried, until retried from the admin."""
@@ -0,0 +1,438 @@
+"""
+Per-peer bandwidth shaping on WireGuard interfaces.
+
+Downloads are shaped on the interface egress: an HTB root qdisc with one class and
+one ``fq_codel`` leaf per limited peer, selected by a ``flower`` filter on the peer
+address. Uploads are policed on the interface ingress with a ``flower`` filter per peer.
+
+Class and filter handles are allocated per interface: every interface subnet, in
+creation order, gets a contiguous range of minors with one handle per address, so
+two peers of an interface never share a handle. Peers are removed by address,
+their handles are read back from the ``tc`` state of the interface.
+All the commands of a change are fed to one ``tc -batch`` invocation.
+
+Limits come from the peer ``rate_limit_down``/``rate_limit_up`` overrides,
+falling back on ``WIREGUARD_RATE_LIMITS_PROVIDER`` (e.g. tariff limits).
+"""
+import re
+import subprocess
+from ipaddress import IPv4Address, IPv4Network
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from django.utils.module_loading import import_string
+
+from django_wireguard import settings
+
+
+__all__ = ('ShapingException', 'PeerLimit', 'HandleMap', 'ShapingState', 'Shaper', 'get_handle_maps',
+           'get_peer_limits', 'apply_peer_limits', 'remove_peer_limits')
+
+
+_PREF = 10
+_DEFAULT_CLASS = 0xffff
+_RATE_UNITS = {'': 0.001, 'k': 1, 'm': 1000, 'g': 1000 ** 2, 't': 1000 ** 3}
+_CLASS = re.compile(r'^class htb 1:([0-9a-f]+) .*?\brate (\S+)', re.MULTILINE)
+_FILTER = re.compile(r'^filter .*\bpref %d flower\b.*\bhandle (0x[0-9a-f]+)' % _PREF)
+_FILTER_ADDRESS = re.compile(r'^\s*(?:dst_ip|src_ip) ([0-9.]+)', re.MULTILINE)
+_POLICE_RATE = re.compile(r'\bpolice \S+ rate (\S+)')
+
+
+class ShapingException(Exception):
+    """
+    Exception raised when the traffic control commands could not be applied.
+    """
+
+
+class PeerLimit:
+    """
+    Bandwidth limits of a peer.
+
+    :param address: peer address
+    :param rate_down: download limit in kbit/s, None for unlimited
+    :param rate_up: upload limit in kbit/s, None for unlimited
+    :param handle: class and filter handle, allocated by the interface :class:`HandleMap`
+    """
+    __slots__ = ('address', 'rate_down', 'rate_up', 'handle')
+
+    def __init__(self, address: str, rate_down: Optional[int] = None, rate_up: Optional[int] = None,
+                 handle: Optional[int] = None):
+        self.address = str(IPv4Address(address))
+        self.rate_down = rate_down
+        self.rate_up = rate_up
+        self.handle = handle
+
+    def __repr__(self):
+        return f"<PeerLimit {self.address} down={self.rate_down} up={self.rate_up} handle={self.handle}>"
+
+
+class HandleMap:
+    """
+    Handles of the peer addresses of an interface.
+
+    Each subnet, in creation order, takes the minors following the previous one,
+    the handle of an address is its offset in the subnet plus the subnet start.
+
+    :param networks: interface subnets, in creation order
+    """
+    __slots__ = ('ranges',)
+
+    def __init__(self, networks: Iterable[str]):
+        self.ranges = []
+        start = 0
+        for network in networks:
+            network = IPv4Network(network, strict=False)
+            self.ranges.append((network, start))
+            start += network.num_addresses
+
+    def get(self, address: str) -> int:
+        """
+        :param address: peer address
+        :return: the handle of the address
+        :raises ShapingException: the address is outside the subnets or past the last usable minor
+        """
+        address = IPv4Address(address)
+        for network, start in self.ranges:
+            if address in network:
+                handle = start + int(address) - int(network.network_address)
+                if not 0 < handle < _DEFAULT_CLASS:
+                    raise ShapingException(f"No shaping handle for {address}: the interface subnets hold more "
+                                           f"than {_DEFAULT_CLASS - 1} addresses")
+                return handle
+        raise ShapingException(f"No shaping handle for {address}: outside the interface subnets")
+
+
+class ShapingState:
+    """
+    Limits applied on an interface, as read from ``tc``.
+
+    :param ready: the root HTB qdisc, its default class and the ingress qdisc exist
+    :param classes: download rate in kbit/s by class minor
+    :param down: peer address of the download filters by handle
+    :param up: peer address and upload rate in kbit/s of the ingress filters by handle
+    """
+    __slots__ = ('ready', 'classes', 'down', 'up')
+
+    def __init__(self, ready: bool = False, classes: Optional[Dict[int, int]] = None,
+                 down: Optional[Dict[int, str]] = None, up: Optional[Dict[int, Tuple[str, int]]] = None):
+        self.ready = ready
+        self.classes = classes if classes is not None else {}
+        self.down = down if down is not None else {}
+        self.up = up if up is not None else {}
+
+    def handles(self, addresses: Iterable[str]) -> List[int]:
+        """
+        :param addresses: peer addresses
+        :return: the handles of the filters matching the addresses
+        """
+        addresses = set(addresses)
+        handles = {handle for handle, address in self.down.items() if address in addresses}
+        handles.update(handle for handle, (address, _) in self.up.items() if address in addresses)
+        return sorted(handles)
+
+
+def _parse_rate(rate: str) -> int:
+    """
+    Convert a ``tc`` rate, e.g. ``1500Kbit``, to kbit/s.
+    """
+    match = re.fullmatch(r'([\d.]+)([kmgt]?)bit', rate.lower())
+    if match is None:
+        raise ShapingException(f"Unexpected tc rate: {rate}")
+    return round(float(match[1]) * _RATE_UNITS[match[2]])
+
+
+def _parse_filters(output: str) -> Dict[int, Tuple[str, Optional[int]]]:
+    """
+    Parse the flower filters of ``tc filter show``, by handle.
+    """
+    filters = {}
+    for block in re.split(r'\n(?=filter )', output):
+        match = _FILTER.match(block)
+        address = _FILTER_ADDRESS.search(block)
+        if match is None or address is None:
+            continue
+        rate = _POLICE_RATE.search(block)
+        filters[int(match[1], 16)] = (address[1], _parse_rate(rate[1]) if rate else None)
+    return filters
+
+
+class Shaper:
+    """
+    Render and run the ``tc`` commands of an interface.
+
+    :param interface_name: WireGuard interface name
+    """
+
+    def __init__(self, interface_name: str):
+        self.interface_name = interface_name
+
+    def setup_commands(self) -> List[str]:
+        dev = self.interface_name
+        return [
+            f"qdisc replace dev {dev} root handle 1: htb default {_DEFAULT_CLASS:x}",
+            f"class replace dev {dev} parent 1: classid 1:{_DEFAULT_CLASS:x} htb rate {settings.WIREGUARD_SHAPING_LINK_RATE}",
+            f"qdisc replace dev {dev} parent 1:{_DEFAULT_CLASS:x} fq_codel",
+            f"qdisc replace dev {dev} ingress",
+        ]
+
+    def limit_commands(self, limit: PeerLimit) -> List[str]:
+        dev, handle = self.interface_name, limit.handle
+        if handle is None:
+            raise ShapingException(f"{limit.address} has no shaping handle")
+        commands = []
+        if limit.rate_down:
+            commands += [
+                f"class replace dev {dev} parent 1: classid 1:{handle:x} "
+                f"htb rate {limit.rate_down}kbit ceil {limit.rate_down}kbit",
+                # the leaf is numbered by the kernel, its major could clash with 1: or ffff:
+                f"qdisc replace dev {dev} parent 1:{handle:x} fq_codel",
+                f"filter replace dev {dev} parent 1: protocol ip pref {_PREF} handle {handle} "
+                f"flower dst_ip {limit.address}/32 classid 1:{handle:x}",
+            ]
+        if limit.rate_up:
+            # 100ms worth of traffic
+            burst = max(limit.rate_up * 1000 // 8 // 10, 16 * 1024)
+            commands.append(f"filter replace dev {dev} parent ffff: protocol ip pref {_PREF} handle {handle} "
+                            f"flower src_ip {limit.address}/32 action police rate {limit.rate_up}kbit "
+                            f"burst {burst} conform-exceed drop")
+        return commands
+
+    def remove_commands(self, handle: int, down: bool = True, up: bool = True) -> List[str]:
+        dev = self.interface_name
+        commands = []
+        if down:
+            commands += [f"filter del dev {dev} parent 1: protocol ip pref {_PREF} handle {handle} flower",
+                         f"class del dev {dev} classid 1:{handle:x}"]
+        if up:
+            commands.append(f"filter del dev {dev} parent ffff: protocol ip pref {_PREF} handle {handle} flower")
+        return commands
+
+    def sync(self, limits: Iterable[PeerLimit], dry_run: bool = False) -> str:
+        """
+        Bring the shaping of the interface in line with the limits of its peers.
+
+        Only the limits differing from the ``tc`` state are replaced, the limits
+        of the other peers are removed.
+
+        :param limits: limits of every peer of the interface
+        :param dry_run: only render the commands
+        :return: the rendered commands
+        """
+        limits = _by_handle(limits)
+        state = self.get_state(dry_run)
+        removals, commands = [], [] if state.ready else self.setup_commands()
+        for handle in sorted(set(state.classes).union(state.down, state.up).difference(limits)):
+            removals += self.remove_commands(handle, down=handle in state.classes or handle in state.down,
+                                             up=handle in state.up)
+        for handle, limit in limits.items():
+            down = (limit.rate_down, limit.address) if limit.rate_down else (None, None)
+            up = (limit.address, limit.rate_up) if limit.rate_up else None
+            stale_down = down != (state.classes.get(handle), state.down.get(handle))
+            stale_up = up != state.up.get(handle)
+            if stale_down or stale_up:
+                removals += self.remove_commands(handle, down=stale_down and not limit.rate_down,
+                                                 up=stale_up and not limit.rate_up)
+                commands += self.limit_commands(PeerLimit(limit.address, limit.rate_down if stale_down else None,
+                                                          limit.rate_up if stale_up else None, handle))
+        return self._run(removals, force=True, dry_run=dry_run) + self._run(commands, dry_run=dry_run)
+
+    def rebuild(self, limits: Iterable[PeerLimit], dry_run: bool = False) -> str:
+        """
+        Rebuild the shaping of the interface from scratch.
+
+        :param limits: limits of every peer of the interface
+        :param dry_run: only render the commands
+        :return: the rendered commands
+        """
+        limits = _by_handle(limits)
+        reset = [f"qdisc del dev {self.interface_name} root",
+                 f"qdisc del dev {self.interface_name} ingress"]
+        commands = self.setup_commands()
+        for limit in limits.values():
+            commands += self.limit_commands(limit)
+        return self._run(reset, force=True, dry_run=dry_run) + self._run(commands, dry_run=dry_run)
+
+    def apply(self, limits: Iterable[PeerLimit], dry_run: bool = False) -> str:
+        """
+        Replace the limits of some peers, the unlimited directions are removed.
+
+        Filters left on the peer addresses under another handle, e.g. after a
+        subnet was removed from the interface, are removed as well.
+
+        :param limits: peer limits
+        :param dry_run: only render the commands
+        :return: the rendered commands
+        """
+        limits = _by_handle(limits)
+        state = self.get_state(dry_run)
+        removals, commands = [], self.setup_commands()
+        for handle in state.handles(limit.address for limit in limits.values()):
+            if handle not in limits:
+                removals += self.remove_commands(handle)
+        for handle, limit in limits.items():
+            removals += self.remove_commands(handle, down=not limit.rate_down, up=not limit.rate_up)
+            commands += self.limit_commands(limit)
+        return self._run(removals, force=True, dry_run=dry_run) + self._run(commands, dry_run=dry_run)
+
+    def remove(self, addresses: Iterable[str], dry_run: bool = False) -> str:
+        """
+        Remove the limits of some peers, found by address in the ``tc`` state.
+
+        :param addresses: peer addresses
+        :param dry_run: only render the commands
+        :return: the rendered commands
+        """
+        commands = []
+        for handle in self.get_state(dry_run).handles(addresses):
+            commands += self.remove_commands(handle)
+        return self._run(commands, force=True, dry_run=dry_run)
+
+    def get_state(self, dry_run: bool = False) -> ShapingState:
+        """
+        Read the limits applied on the interface.
+
+        A missing interface or qdisc reads as an empty state.
+
+        :param dry_run: an unavailable ``tc`` reads as an empty state instead of failing
+        :return: the applied limits
+        """
+        dev = self.interface_name
+        outputs = []
+        for command in (['qdisc', 'show', 'dev', dev], ['class', 'show', 'dev', dev],
+                        ['filter', 'show', 'dev', dev, 'parent', '1:'],
+                        ['filter', 'show', 'dev', dev, 'parent', 'ffff:']):
+            try:
+                result = subprocess.run(['tc', *command], text=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            except OSError as e:
+                if dry_run or settings.WIREGUARD_SHAPING_DRY_RUN:
+                    return ShapingState()
+                raise ShapingException(f"tc {' '.join(command)} failed: {e}")
+            outputs.append('' if result.returncode else result.stdout)
+        qdiscs, classes, down, up = outputs
+
+        classes = {int(minor, 16): _parse_rate(rate) for minor, rate in _CLASS.findall(classes)}
+        ready = (re.search(r'^qdisc htb 1: root\b', qdiscs, re.MULTILINE) is not None
+                 and re.search(r'^qdisc ingress ffff:', qdiscs, re.MULTILINE) is not None
+                 and classes.pop(_DEFAULT_CLASS, None) is not None)
+        return ShapingState(ready, classes,
+                            {handle: address for handle, (address, _) in _parse_filters(down).items()},
+                            {handle: (address, rate) for handle, (address, rate) in _parse_filters(up).items()
+                             if rate is not None})
+
+    @staticmethod
+    def _run(commands: List[str], force: bool = False, dry_run: bool = False) -> str:
+        """
+        Feed the commands to one ``tc -batch``, with ``force`` failing commands are skipped.
+        """
+        if not commands:
+            return ''
+        command = ['tc', '-force', '-batch', '-'] if force else ['tc', '-batch', '-']
+        script = '\n'.join(commands) + '\n'
+        if not (dry_run or settings.WIREGUARD_SHAPING_DRY_RUN):
+            try:
+                result = subprocess.run(command, input=script, text=True,
+                                        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            except OSError as e:
+                raise ShapingException(f"{' '.join(command)} failed: {e}")
+            if result.returncode and not force:
+                raise ShapingException(f"{' '.join(command)} failed: {result.stderr.strip()}")
+        return f"# {' '.join(command)}\n{script}"
+
+
+def _by_handle(limits: Iterable[PeerLimit]) -> Dict[int, PeerLimit]:
+    by_handle = {}
+    for limit in limits:
+        if limit.handle is None:
+            raise ShapingException(f"{limit.address} has no shaping handle")
+        other = by_handle.setdefault(limit.handle, limit)
+        if other is not limit and other.address != limit.address:
+            raise ShapingException(f"{limit.address} and {other.address} share the shaping handle {limit.handle}")
+    return by_handle
+
+
+def get_handle_maps(interface_ids: Iterable[int]) -> Dict[int, HandleMap]:
+    """
+    Build the handle maps of interfaces, with one query.
+
+    :param interface_ids: WireguardInterface primary keys
+    :return: handle map by interface primary key
+    """
+    from django_wireguard.models import WireguardIPAddress
+
+    networks = {interface_id: [] for interface_id in interface_ids}
+    addresses = WireguardIPAddress.objects.filter(interface__in=networks.keys()).order_by('pk')
+    for interface_id, address in addresses.values_list('interface_id', 'address'):
+        networks[interface_id].append(address)
+    return {interface_id: HandleMap(interface_networks) for interface_id, interface_networks in networks.items()}
+
+
+def get_peer_limits(peers: Iterable) -> Dict[int, PeerLimit]:
+    """
+    Resolve the limits of peers: peer overrides first, then ``WIREGUARD_RATE_LIMITS_PROVIDER``.
+
+    :param peers: WireguardPeers with an address, with ``interface_ip`` selected to save queries
+    :return: limits by peer primary key
+    :raises ShapingException: a peer address has no handle on its interface
+    """
+    peers = [peer for peer in peers if peer.address]
+    handle_maps = get_handle_maps({peer.interface_ip.interface_id for peer in peers})
+    provided = {}
+    if settings.WIREGUARD_RATE_LIMITS_PROVIDER:
+        provider = import_string(settings.WIREGUARD_RATE_LIMITS_PROVIDER)
+        provided = provider([peer.pk for peer in peers])
+    limits = {}
+    for peer in peers:
+        rate_down, rate_up = provided.get(peer.pk, (None, None))
+        if peer.rate_limit_down is not None:
+            rate_down = peer.rate_limit_down
+        if peer.rate_limit_up is not None:
+            rate_up = peer.rate_limit_up
+        limits[peer.pk] = PeerLimit(peer.address, rate_down, rate_up,
+                                    handle_maps[peer.interface_ip.interface_id].get(peer.address))
+    return limits
+
+
+def _by_interface(peers: Iterable) -> Dict[str, List]:
+    interfaces = {}
+    for peer in peers:
+        # node interfaces are shaped by their agent
+        if peer.interface_ip.interface.is_local:
+            interfaces.setdefault(peer.interface_ip.interface.name, []).append(peer)
+    return interfaces
+
+
+def apply_peer_limits(peers: Iterable, dry_run: bool = False) -> str:
+    """
+    Apply the limits of peers, with one ``tc`` batch per interface.
+
+    Disabled peers have their limits removed.
+
+    :param peers: WireguardPeers, with ``interface_ip__interface`` selected to save queries
+    :param dry_run: only render the commands
+    :return: the rendered commands
+    """
+    if not settings.WIREGUARD_SHAPING:
+        return ''
+    rendered = ''
+    for interface_name, interface_peers in _by_interface(peers).items():
+        shaper = Shaper(interface_name)
+        enabled = [peer for peer in interface_peers if peer.status]
+        disabled = [peer.address for peer in interface_peers if not peer.status and peer.address]
+        rendered += shaper.apply(get_peer_limits(enabled).values(), dry_run=dry_run)
+        rendered += shaper.remove(disabled, dry_run=dry_run)
+    return rendered
+
+
+def remove_peer_limits(peers: Iterable, dry_run: bool = False) -> str:
+    """
+    Remove the limits of peers, with one ``tc`` batch per interface.
+
+    :param peers: WireguardPeers
+    :param dry_run: only render the commands
+    :return: the rendered commands
+    """
+    if not settings.WIREGUARD_SHAPING:
+        return ''
+    return ''.join(Shaper(interface_name).remove([peer.address for peer in interface_peers if peer.address],
+                                                 dry_run=dry_run)
+                   for interface_name, interface_peers in _by_interface(peers).items())
+
@@ -1,33 +1,22 @@
-from typing import Union, Optional
+from typing import Union, Optional, List
 
 from django.db.models import QuerySet
 
 from django_wireguard.models import WireguardInterface
+from django_wireguard.reconcile import reconcile, ReconcilePlan
 
 
-def sync_wireguard_interfaces(queryset: Optional[Union[QuerySet, WireguardInterface]] = None):
+def sync_wireguard_interfaces(queryset: Optional[Union[QuerySet, WireguardInterface]] = None,
+                              dry_run: bool = False) -> List[ReconcilePlan]:
     """
     Sync database WireguardInterface queryset or instance to WireGuard devices on the system.
 
+    Only the differences between the database and the kernel are applied,
+    peers missing from the database are removed from the devices.
+
     :param queryset: WireguardInterfaces to sync with the system
     :type queryset: WireguardInterface queryset or instance
+    :param dry_run: only compute the changes
+    :return: changes of each interface
     """
-    if queryset is None:
-        queryset = WireguardInterface.objects.all()
-    elif isinstance(queryset, WireguardInterface):
-        queryset = [queryset]
-
-    for interface in queryset:
-        interface.wg.set_interface(private_key=interface.private_key,
-                                   listen_port=interface.listen_port)
-
-        if interface.addresses:
-            interface.wg.set_ip_addresses(interface.get_address_list())
-
-        for address in interface.addresses.all():
-            for peer in address.peers.all():
-                if not peer.status:
-                    continue
-                # update/create the wireguard peer
-                interface.wg.set_peer(peer.public_key, peer.preshared_key,
-                                      peer.get_interface_allowed_ip())
+    return reconcile(queryset, dry_run=dry_run)
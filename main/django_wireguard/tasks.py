@@ -0,0 +1,30 @@
+from typing import Optional
+
+from celery import shared_task
+
+from django_wireguard.metering import sample_traffic as sample_peers_traffic, prune_traffic as prune_peers_traffic
+from django_wireguard.models import WireguardIPAddress, WireguardPoolEntry
+from django_wireguard.outbox import apply_intents
+
+
+@shared_task
+def refill_pool(interface_ip_id: Optional[int] = None) -> int:
+    interface_ip = WireguardIPAddress.objects.filter(pk=interface_ip_id).first() if interface_ip_id else None
+    if interface_ip_id and interface_ip is None:
+        return 0
+    return WireguardPoolEntry.objects.refill(interface_ip)
+
+
+@shared_task
+def sample_traffic() -> int:
+    return sample_peers_traffic()
+
+
+@shared_task
+def prune_traffic() -> int:
+    return prune_peers_traffic()
+
+
+@shared_task
+def apply_kernel_intents() -> int:
+    return len(apply_intents())
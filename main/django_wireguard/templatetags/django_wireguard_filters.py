@@ -1,6 +1,9 @@
 import base64
 
 from django import template
+from django.utils.safestring import mark_safe
+
+from django_wireguard.qr import render_qr_svg
 
 register = template.Library()
 
@@ -8,3 +11,8 @@ register = template.Library()
 @register.filter
 def base64encode(string: str) -> str:
     return base64.b64encode(string.encode('utf-8')).decode('ascii')
+
+
+@register.filter
+def qrcode_svg(string: str) -> str:
+    return mark_safe(render_qr_svg(string))
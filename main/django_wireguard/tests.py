@@ -0,0 +1,334 @@
+import os
+import tempfile
+from datetime import timedelta
+from unittest import mock
+
+from django.db import connection, transaction
+from django.test import SimpleTestCase, TestCase
+from django.utils import timezone
+
+from django_wireguard import outbox
+from django_wireguard.agent import LocalTransport, NodeAgent
+from django_wireguard.allocator import (AddressBitmap, allocate_addresses, get_free_address_count, release_addresses,
+                                        reserve_addresses)
+from django_wireguard.models import (WireguardInterface, WireguardIPAddress, WireguardKernelIntent, WireguardNode,
+                                     WireguardPeer, WireguardPoolEntry)
+from django_wireguard.nodes import NodeException, get_desired_state, record_node_report
+from django_wireguard.shaping import HandleMap, PeerLimit, Shaper, ShapingException
+from django_wireguard.wireguard import PeerState
+
+
+class NodeTestCase(TestCase):
+    def setUp(self):
+        self.node = WireguardNode.objects.create(name='node1', endpoint='203.0.113.10')
+        self.interface = WireguardInterface.objects.create(name='wg5', listen_port=51821, node=self.node)
+        self.interface_ip = WireguardIPAddress.objects.create(name='node1', address='10.9.0.1/24',
+                                                              interface=self.interface)
+        self.peer = WireguardPeer.objects.create(name='peer', interface_ip=self.interface_ip)
+
+
+class NodeStateTests(NodeTestCase):
+    def test_desired_state(self):
+        state = get_desired_state(self.node)
+        self.assertEqual(state['node'], 'node1')
+        interface, = state['interfaces']
+        self.assertEqual(interface['name'], 'wg5')
+        self.assertEqual(interface['listen_port'], 51821)
+        self.assertEqual(interface['addresses'], ['10.9.0.1/24'])
+        self.assertEqual([peer['public_key'] for peer in interface['peers']], [self.peer.public_key])
+
+    def test_report(self):
+        other = WireguardInterface.objects.create(name='wg6', listen_port=51822)
+        count = record_node_report(self.node, {
+            'interfaces': {'wg5': [[self.peer.public_key, 100, 200, 1700000000]], other.name: []},
+            'errors': {'wg5': ['boom']},
+        })
+        self.assertEqual(count, 1)
+        self.node.refresh_from_db()
+        self.assertIsNotNone(self.node.last_seen)
+        self.assertEqual(self.node.last_errors, 'wg5: boom')
+        self.assertEqual(self.peer.get_last_seen().timestamp(), 1700000000)
+
+    def test_malformed_report(self):
+        for report in ({'interfaces': {'wg5': [[self.peer.public_key]]}},
+                       {'interfaces': {'wg5': [[self.peer.public_key, 'many', 0, 0]]}},
+                       {'interfaces': ['wg5']},
+                       {'errors': {'wg5': 1}}):
+            with self.assertRaises(NodeException):
+                record_node_report(self.node, report)
+        self.node.refresh_from_db()
+        self.assertIsNone(self.node.last_seen)
+
+    def test_endpoint(self):
+        self.assertEqual(self.interface.get_endpoint(), '203.0.113.10:51821')
+        self.assertIn('Endpoint=203.0.113.10:51821\n', self.peer.get_config())
+
+    def test_config_follows_address(self):
+        version = self.peer.config_version
+        self.interface_ip.name = 'renamed'
+        self.interface_ip.save()
+        self.peer.refresh_from_db()
+        self.assertNotEqual(self.peer.config_version, version)
+
+
+class NodeAgentTests(NodeTestCase):
+    def test_run_once(self):
+        kernel = mock.Mock()
+        kernel.iter_peers.return_value = [PeerState(self.peer.public_key, None, [], 1700000000, 300, 400, 0)]
+        with mock.patch('django_wireguard.reconcile.WireGuard') as reconcile_wg, \
+                mock.patch('django_wireguard.agent.WireGuard') as agent_wg:
+            reconcile_wg.get_interface.return_value = None
+            agent_wg.get_interface.return_value = kernel
+            plan, = NodeAgent(LocalTransport(self.node), dry_run=True).run_once()
+
+        self.assertEqual(plan.interface_name, 'wg5')
+        self.assertEqual(plan.errors, [])
+        self.assertTrue(plan.create)
+        self.assertEqual([peer['public_key'] for peer in plan.peers_to_add], [self.peer.public_key])
+        reconcile_wg.create_interface.assert_not_called()
+        self.node.refresh_from_db()
+        self.assertIsNotNone(self.node.last_seen)
+        self.assertEqual(self.peer.get_last_seen().timestamp(), 1700000000)
+
+
+class ShapingHandleTests(SimpleTestCase):
+    def test_subnets_do_not_collide(self):
+        handles = HandleMap(['10.8.0.1/24', '10.9.0.1/24'])
+        self.assertEqual(handles.get('10.8.0.2'), 2)
+        self.assertEqual(handles.get('10.9.0.2'), 258)
+
+    def test_exhausted(self):
+        handles = HandleMap(['10.8.0.1/16', '10.9.0.1/24'])
+        self.assertEqual(handles.get('10.8.255.254'), 0xfffe)
+        for address in ('10.9.0.2', '10.10.0.2'):
+            with self.assertRaises(ShapingException):
+                handles.get(address)
+
+    def test_shared_handle(self):
+        with self.assertRaises(ShapingException):
+            Shaper('wg5').apply([PeerLimit('10.8.0.2', 1000, None, 2), PeerLimit('10.9.0.2', 1000, None, 2)],
+                                dry_run=True)
+
+
+class ShaperSyncTests(SimpleTestCase):
+    state = {
+        'qdisc': 'qdisc htb 1: root refcnt 2 r2q 10 default 0xffff\nqdisc ingress ffff: parent ffff:fff1\n',
+        'class': 'class htb 1:2 root prio 0 rate 1Mbit ceil 1Mbit burst 1600b cburst 1600b\n'
+                 'class htb 1:3 root prio 0 rate 1Mbit ceil 1Mbit burst 1600b cburst 1600b\n'
+                 'class htb 1:9 root prio 0 rate 1Mbit ceil 1Mbit burst 1600b cburst 1600b\n'
+                 'class htb 1:ffff root prio 0 rate 10Gbit ceil 10Gbit burst 0b cburst 0b\n',
+        '1:': ''.join(f'filter parent 1: protocol ip pref 10 flower chain 0 handle {handle:#x} classid 1:{handle:x}\n'
+                      f'  eth_type ipv4\n  dst_ip 10.8.0.{handle}\n  not_in_hw\n' for handle in (2, 3, 9)),
+        'ffff:': 'filter parent ffff: protocol ip pref 10 flower chain 0 handle 0x2\n  eth_type ipv4\n'
+                 '  src_ip 10.8.0.2\n  not_in_hw\n\taction order 1:  police 0x1 rate 500Kbit burst 16Kb mtu 2Kb '
+                 'action drop overhead 0b\n',
+    }
+
+    def setUp(self):
+        def tc(command, **kwargs):
+            return mock.Mock(returncode=0, stdout=self.state[command[-1] if command[-2] == 'parent' else command[1]])
+
+        patcher = mock.patch('django_wireguard.shaping.subprocess.run', side_effect=tc)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_only_differences(self):
+        limits = [PeerLimit('10.8.0.2', 1000, 500, 2), PeerLimit('10.8.0.3', 2000, None, 3),
+                  PeerLimit('10.8.0.4', None, 300, 4)]
+        commands = Shaper('wg5').sync(limits, dry_run=True)
+        self.assertNotIn('qdisc del', commands)
+        self.assertNotIn('1:2 ', commands)
+        self.assertIn('classid 1:3 htb rate 2000kbit', commands)
+        self.assertIn('handle 4 flower src_ip 10.8.0.4/32 action police rate 300kbit', commands)
+        self.assertIn('filter del dev wg5 parent 1: protocol ip pref 10 handle 9 flower', commands)
+        self.assertIn('class del dev wg5 classid 1:9', commands)
+        self.assertNotIn('htb default', commands)
+
+    def test_in_line(self):
+        limits = [PeerLimit('10.8.0.2', 1000, 500, 2), PeerLimit('10.8.0.3', 1000, None, 3),
+                  PeerLimit('10.8.0.9', 1000, None, 9)]
+        self.assertEqual(Shaper('wg5').sync(limits, dry_run=True), '')
+
+    def test_remove_by_address(self):
+        commands = Shaper('wg5').remove(['10.8.0.2'], dry_run=True)
+        self.assertIn('class del dev wg5 classid 1:2', commands)
+        self.assertIn('parent ffff: protocol ip pref 10 handle 2 flower', commands)
+        self.assertNotIn('handle 3', commands)
+
+
+class PoolTests(NodeTestCase):
+    def test_subnet_change(self):
+        with mock.patch('django_wireguard.settings.WIREGUARD_POOL_SIZE', 3):
+            WireguardPoolEntry.objects.refill(self.interface_ip)
+            self.assertEqual(self.interface_ip.pool.count(), 3)
+            self.interface_ip.address = '10.10.0.1/24'
+            with mock.patch('django_wireguard.tasks.refill_pool.delay') as refill, \
+                    self.captureOnCommitCallbacks(execute=True):
+                self.interface_ip.save()
+            refill.assert_called_once_with(self.interface_ip.pk)
+            self.assertFalse(self.interface_ip.pool.exists())
+            WireguardPoolEntry.objects.refill(self.interface_ip)
+            self.assertTrue(all(entry.address.startswith('10.10.0.')
+                                for entry in WireguardPoolEntry.objects.claim_many(self.interface_ip, 3)))
+
+
+class AddressBitmapTests(SimpleTestCase):
+    def test_reserved_addresses(self):
+        bitmap = AddressBitmap('10.8.0.1/29')
+        self.assertEqual(bitmap.free, 5)
+        for address in ('10.8.0.0', '10.8.0.1', '10.8.0.7'):
+            self.assertIn(address, bitmap)
+            self.assertFalse(bitmap.release(address))
+
+    def test_full_subnet(self):
+        bitmap = AddressBitmap('10.8.0.1/29')
+        self.assertEqual([str(bitmap.allocate()) for _ in range(5)],
+                         ['10.8.0.2', '10.8.0.3', '10.8.0.4', '10.8.0.5', '10.8.0.6'])
+        self.assertIsNone(bitmap.allocate())
+        self.assertEqual(bitmap.free, 0)
+
+    def test_reuse_released(self):
+        bitmap = AddressBitmap('10.8.0.1/29')
+        for _ in range(3):
+            bitmap.allocate()
+        self.assertTrue(bitmap.release('10.8.0.3'))
+        self.assertFalse(bitmap.release('10.8.0.3'))
+        self.assertEqual(str(bitmap.allocate()), '10.8.0.3')
+        self.assertEqual(str(bitmap.allocate()), '10.8.0.5')
+
+    def test_mark(self):
+        bitmap = AddressBitmap('10.8.0.1/29')
+        self.assertTrue(bitmap.mark('10.8.0.2'))
+        self.assertFalse(bitmap.mark('10.8.0.2'))
+        self.assertEqual(str(bitmap.allocate()), '10.8.0.3')
+        with self.assertRaises(ValueError):
+            bitmap.mark('10.9.0.2')
+
+    def test_stored(self):
+        bitmap = AddressBitmap('10.8.0.1/29')
+        bitmap.allocate()
+        stored = AddressBitmap('10.8.0.1/29', bytes(bitmap.bits), bitmap.hint, bitmap.allocated)
+        self.assertEqual(str(stored.allocate()), '10.8.0.3')
+        self.assertEqual(stored.free, 3)
+
+
+class AllocatorTests(NodeTestCase):
+    def setUp(self):
+        super().setUp()
+        self.interface_ip = WireguardIPAddress.objects.create(name='small', address='10.10.0.1/29',
+                                                              interface=self.interface)
+
+    def test_allocate_until_full(self):
+        self.assertEqual(allocate_addresses(self.interface_ip, 3), ['10.10.0.2', '10.10.0.3', '10.10.0.4'])
+        self.assertEqual(allocate_addresses(self.interface_ip, 3), ['10.10.0.5', '10.10.0.6'])
+        self.assertEqual(allocate_addresses(self.interface_ip), [])
+        self.interface_ip.refresh_from_db()
+        self.assertEqual(get_free_address_count(self.interface_ip), 0)
+
+    def test_reserve_and_release(self):
+        self.assertEqual(reserve_addresses(self.interface_ip, ['10.10.0.4', '10.10.0.5', '10.20.0.1']), [])
+        self.assertEqual(reserve_addresses(self.interface_ip, ['10.10.0.4']), ['10.10.0.4'])
+        release_addresses(self.interface_ip, ['10.10.0.4', '10.20.0.1'])
+        self.assertEqual(allocate_addresses(self.interface_ip, 3), ['10.10.0.2', '10.10.0.3', '10.10.0.4'])
+
+    def test_rebuilt_from_peers(self):
+        peer = WireguardPeer.objects.create(name='peer', interface_ip=self.interface_ip)
+        self.assertEqual(peer.address, '10.10.0.2')
+        WireguardIPAddress.objects.filter(pk=self.interface_ip.pk).update(address_bitmap=None)
+        self.interface_ip.refresh_from_db()
+        self.assertEqual(get_free_address_count(self.interface_ip), 4)
+        self.assertEqual(allocate_addresses(self.interface_ip), ['10.10.0.3'])
+
+
+class OutboxTests(TestCase):
+    def setUp(self):
+        lock_file = tempfile.NamedTemporaryFile(delete=False)
+        lock_file.close()
+        self.addCleanup(os.unlink, lock_file.name)
+        self.apply_interface = mock.Mock(return_value=[])
+        self.delay = mock.Mock()
+        for patcher in (mock.patch('django_wireguard.settings.WIREGUARD_OUTBOX_LOCK_FILE', lock_file.name),
+                        mock.patch('django_wireguard.settings.WIREGUARD_OUTBOX_MAX_ATTEMPTS', 2),
+                        mock.patch('django_wireguard.settings.WIREGUARD_POOL_SIZE', 0),
+                        mock.patch('django_wireguard.outbox._apply_interface', self.apply_interface),
+                        mock.patch('django_wireguard.tasks.apply_kernel_intents.delay', self.delay)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.interface = WireguardInterface.objects.create(name='wg7', listen_port=51827)
+        self.interface_ip = WireguardIPAddress.objects.create(name='local', address='10.11.0.1/24',
+                                                              interface=self.interface)
+        # the intents of the setup are not dispatched
+        WireguardKernelIntent.objects.all().delete()
+        connection._wireguard_intents = []
+
+    def create_peer(self) -> WireguardPeer:
+        with self.captureOnCommitCallbacks(execute=True):
+            return WireguardPeer.objects.create(name='peer', interface_ip=self.interface_ip)
+
+    def test_rollback(self):
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            with self.assertRaises(RuntimeError), transaction.atomic():
+                WireguardPeer.objects.create(name='peer', interface_ip=self.interface_ip)
+                self.assertTrue(WireguardKernelIntent.objects.exists())
+                raise RuntimeError
+        self.assertEqual(callbacks, [])
+        self.assertFalse(WireguardKernelIntent.objects.exists())
+        # a later commit does not apply the intents rolled back
+        self.create_peer()
+        (interface_name, intents), _ = self.apply_interface.call_args
+        self.assertEqual(len(intents), 1)
+
+    def test_inline(self):
+        peer = self.create_peer()
+        self.apply_interface.assert_called_once()
+        (interface_name, intents), _ = self.apply_interface.call_args
+        self.assertEqual(interface_name, 'wg7')
+        self.assertEqual([intent.public_key for intent in intents], [peer.public_key])
+        self.assertFalse(WireguardKernelIntent.objects.exists())
+        self.delay.assert_not_called()
+
+    def test_busy_lock(self):
+        with outbox._host_lock():
+            self.create_peer()
+        self.apply_interface.assert_not_called()
+        self.delay.assert_called_once_with()
+        self.assertEqual(WireguardKernelIntent.objects.due().count(), 1)
+
+    def test_retry_backoff(self):
+        self.apply_interface.return_value = [RuntimeError('boom')]
+        start = timezone.now()
+        self.create_peer()
+        # left to the periodic task, nothing is due before the backoff
+        self.delay.assert_not_called()
+        intent = WireguardKernelIntent.objects.get()
+        self.assertEqual(intent.attempts, 1)
+        self.assertIn('boom', intent.last_error)
+        self.assertGreaterEqual(intent.next_attempt_at, start + timedelta(seconds=5))
+        # not due yet
+        self.assertEqual(outbox.apply_intents(), [])
+
+        WireguardKernelIntent.objects.update(next_attempt_at=start)
+        with mock.patch('django_wireguard.settings.WIREGUARD_OUTBOX_MAX_ATTEMPTS', 3):
+            start = timezone.now()
+            self.assertEqual(len(outbox.apply_intents()), 1)
+        intent.refresh_from_db()
+        self.assertEqual(intent.attempts, 2)
+        self.assertGreaterEqual(intent.next_attempt_at, start + timedelta(seconds=10))
+
+    def test_dead_letter(self):
+        self.apply_interface.return_value = [RuntimeError('boom')]
+        self.create_peer()
+        WireguardKernelIntent.objects.update(next_attempt_at=timezone.now())
+        self.assertEqual(len(outbox.apply_intents()), 1)
+        intent = WireguardKernelIntent.objects.get()
+        self.assertEqual(intent.attempts, 2)
+        self.assertTrue(intent.is_failed)
+        self.assertEqual(WireguardKernelIntent.objects.failed().count(), 1)
+        # dead letters are no longer applied
+        self.assertEqual(outbox.apply_intents(), [])
+        self.assertEqual(self.apply_interface.call_count, 2)
+
+        self.apply_interface.return_value = []
+        self.assertEqual(WireguardKernelIntent.objects.failed().retry(), 1)
+        self.assertEqual(outbox.apply_intents(), [])
+        self.assertFalse(WireguardKernelIntent.objects.exists())
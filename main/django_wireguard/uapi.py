@@ -0,0 +1,275 @@
+"""
+Userspace WireGuard backend.
+
+Drives wireguard-go, boringtun or any implementation of the cross-platform
+configuration protocol through its ``<interface>.sock`` unix socket
+(https://www.wireguard.com/xplatform/). A whole peer set is written in one
+``set=1`` transaction and read back in one ``get=1`` stream.
+"""
+import base64
+import os
+import socket
+import subprocess
+from time import monotonic, sleep
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+from django_wireguard import settings
+from django_wireguard.wireguard import WireGuardException, PeerChunkError, PeerState, DeviceState
+
+
+__all__ = ('UAPIException', 'UAPIBackend')
+
+
+class UAPIException(WireGuardException):
+    """
+    Exception raised when the userspace implementation rejects a request.
+
+    :param errno: error number returned by the implementation
+    """
+
+    def __init__(self, message: str, errno: Optional[int] = None):
+        super().__init__(message)
+        self.errno = errno
+
+
+def _key_to_hex(key) -> str:
+    return base64.b64decode(str(key)).hex()
+
+
+def _key_from_hex(key: str) -> str:
+    return base64.b64encode(bytes.fromhex(key)).decode('ascii')
+
+
+def _format_endpoint(address: str, port: int) -> str:
+    if ':' in address:
+        address = f'[{address}]'
+    return f'{address}:{port}'
+
+
+def _encode_peer(peer: dict) -> List[str]:
+    """
+    Encode a peer struct as UAPI ``set`` lines.
+
+    :param peer: peer struct https://docs.pyroute2.org/wireguard.html
+    """
+    if 'public_key' not in peer:
+        raise ValueError('Peer Public key required')
+    lines = [f"public_key={_key_to_hex(peer['public_key'])}"]
+    if peer.get('remove'):
+        lines.append("remove=true")
+        return lines
+    if peer.get('update_only'):
+        lines.append("update_only=true")
+    if peer.get('preshared_key'):
+        lines.append(f"preshared_key={_key_to_hex(peer['preshared_key'])}")
+    if 'endpoint_addr' in peer and 'endpoint_port' in peer:
+        lines.append(f"endpoint={_format_endpoint(peer['endpoint_addr'], peer['endpoint_port'])}")
+    if 'persistent_keepalive' in peer:
+        lines.append(f"persistent_keepalive_interval={peer['persistent_keepalive']}")
+    if peer.get('replace_allowed_ips'):
+        lines.append("replace_allowed_ips=true")
+    lines += [f"allowed_ip={allowed_ip}" for allowed_ip in peer.get('allowed_ips', ())]
+    return lines
+
+
+class _PeerBuilder:
+    """
+    Accumulates the ``get`` lines of one peer.
+    """
+    __slots__ = ('public_key', 'preshared_key', 'endpoint', 'allowed_ips', 'latest_handshake',
+                 'rx_bytes', 'tx_bytes', 'persistent_keepalive')
+
+    def __init__(self, public_key: str):
+        self.public_key = public_key
+        self.preshared_key = None
+        self.endpoint = None
+        self.allowed_ips = []
+        self.latest_handshake = 0
+        self.rx_bytes = 0
+        self.tx_bytes = 0
+        self.persistent_keepalive = 0
+
+    def add(self, key: str, value: str):
+        if key == 'allowed_ip':
+            self.allowed_ips.append(value)
+        elif key == 'endpoint':
+            self.endpoint = value
+        elif key == 'preshared_key':
+            self.preshared_key = _key_from_hex(value)
+        elif key == 'last_handshake_time_sec':
+            self.latest_handshake = int(value)
+        elif key == 'rx_bytes':
+            self.rx_bytes = int(value)
+        elif key == 'tx_bytes':
+            self.tx_bytes = int(value)
+        elif key == 'persistent_keepalive_interval':
+            self.persistent_keepalive = int(value)
+
+    def build(self) -> PeerState:
+        return PeerState(public_key=self.public_key,
+                         endpoint=self.endpoint,
+                         allowed_ips=self.allowed_ips,
+                         latest_handshake=self.latest_handshake,
+                         rx_bytes=self.rx_bytes,
+                         tx_bytes=self.tx_bytes,
+                         persistent_keepalive=self.persistent_keepalive,
+                         preshared_key=self.preshared_key)
+
+
+class UAPIBackend:
+    """
+    Configure WireGuard devices through the userspace UAPI socket.
+    """
+    name = 'uapi'
+
+    @staticmethod
+    def socket_path(interface_name: str) -> str:
+        return os.path.join(settings.WIREGUARD_UAPI_SOCKET_DIR, f'{interface_name}.sock')
+
+    def _connect(self, interface_name: str) -> socket.socket:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(settings.WIREGUARD_UAPI_TIMEOUT)
+        try:
+            sock.connect(self.socket_path(interface_name))
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+    @staticmethod
+    def _read_lines(sock: socket.socket) -> Iterator[Tuple[str, str]]:
+        """
+        Yield the ``key=value`` pairs of a response, up to the terminating empty line.
+        """
+        with sock.makefile('r', encoding='ascii', newline='\n') as stream:
+            for line in stream:
+                line = line.rstrip('\n')
+                if not line:
+                    return
+                key, _, value = line.partition('=')
+                yield key, value
+        raise UAPIException("UAPI socket closed before the end of the response")
+
+    @staticmethod
+    def _check_errno(key: str, value: str):
+        if key == 'errno' and value != '0':
+            raise UAPIException(f"UAPI request failed with errno {value}", int(value))
+
+    def _set(self, interface_name: str, lines: Iterable[str]):
+        """
+        Send a ``set=1`` transaction.
+        """
+        request = 'set=1\n' + ''.join(f'{line}\n' for line in lines) + '\n'
+        with self._connect(interface_name) as sock:
+            sock.sendall(request.encode('ascii'))
+            for key, value in self._read_lines(sock):
+                self._check_errno(key, value)
+
+    def _get(self, interface_name: str) -> Iterator[Tuple[str, str]]:
+        """
+        Send a ``get=1`` request and stream the response pairs.
+        """
+        with self._connect(interface_name) as sock:
+            sock.sendall(b'get=1\n\n')
+            for key, value in self._read_lines(sock):
+                self._check_errno(key, value)
+                yield key, value
+
+    def create(self, interface_name: str):
+        """
+        Start the userspace implementation and wait for its socket.
+
+        :param interface_name: WireGuard interface name
+        """
+        path = self.socket_path(interface_name)
+        try:
+            subprocess.run([*settings.WIREGUARD_UAPI_COMMAND, interface_name], check=True,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                           timeout=settings.WIREGUARD_UAPI_TIMEOUT)
+        except (OSError, subprocess.SubprocessError) as e:
+            raise UAPIException(f"Cannot start userspace interface {interface_name}: {e}")
+        deadline = monotonic() + settings.WIREGUARD_UAPI_TIMEOUT
+        while not os.path.exists(path):
+            if monotonic() > deadline:
+                raise UAPIException(f"UAPI socket {path} did not appear")
+            sleep(0.05)
+
+    def set_device(self, interface_name: str, private_key=None, listen_port=None, fwmark=None, peer=None):
+        """
+        Set device parameters, and optionally one peer, in a single transaction.
+
+        :param interface_name: WireGuard interface name
+        """
+        lines = []
+        if private_key is not None:
+            lines.append(f"private_key={_key_to_hex(private_key)}")
+        if listen_port is not None:
+            lines.append(f"listen_port={listen_port}")
+        if fwmark is not None:
+            lines.append(f"fwmark={fwmark}")
+        if peer is not None:
+            lines += _encode_peer(peer)
+        self._set(interface_name, lines)
+
+    def apply_peers(self, interface_name: str, peers: Iterable[dict]) -> List[PeerChunkError]:
+        """
+        Set or remove peers in one ``set=1`` transaction.
+
+        :param interface_name: WireGuard interface name
+        :param peers: peer structs https://docs.pyroute2.org/wireguard.html
+        :return: a single failed chunk holding every peer if the transaction failed
+        """
+        lines, public_keys = [], []
+        for peer in peers:
+            lines += _encode_peer(peer)
+            public_keys.append(str(peer['public_key']))
+        if not public_keys:
+            return []
+        try:
+            self._set(interface_name, lines)
+        except (UAPIException, OSError) as e:
+            return [PeerChunkError(public_keys, e)]
+        return []
+
+    def iter_peers(self, interface_name: str) -> Iterator[PeerState]:
+        """
+        Stream the device peers, decoding each one as soon as its lines are read.
+
+        :param interface_name: WireGuard interface name
+        :return: iterator of peer states
+        """
+        peer = None
+        for key, value in self._get(interface_name):
+            if key == 'public_key':
+                if peer is not None:
+                    yield peer.build()
+                peer = _PeerBuilder(_key_from_hex(value))
+            elif peer is not None:
+                peer.add(key, value)
+        if peer is not None:
+            yield peer.build()
+
+    def dump(self, interface_name: str) -> DeviceState:
+        """
+        Read the device settings and all of its peers in one ``get=1`` stream.
+
+        :param interface_name: WireGuard interface name
+        :rtype: DeviceState
+        """
+        private_key, listen_port, fwmark, peers, peer = None, 0, 0, {}, None
+        for key, value in self._get(interface_name):
+            if key == 'public_key':
+                if peer is not None:
+                    peers[peer.public_key] = peer.build()
+                peer = _PeerBuilder(_key_from_hex(value))
+            elif peer is not None:
+                peer.add(key, value)
+            elif key == 'private_key':
+                private_key = _key_from_hex(value)
+            elif key == 'listen_port':
+                listen_port = int(value)
+            elif key == 'fwmark':
+                fwmark = int(value)
+        if peer is not None:
+            peers[peer.public_key] = peer.build()
+        return DeviceState(interface_name, private_key, listen_port, fwmark, peers)
@@ -0,0 +1,8 @@
+from django.urls import path
+from . import views
+
+# Endpoints of the wireguard_agent command running on the nodes.
+urlpatterns = [
+    path('node/state/', views.NodeStateApiView.as_view()),
+    path('node/report/', views.NodeReportApiView.as_view()),
+]
@@ -7,11 +7,12 @@ def purge_private_keys() -> int:
 
     :return: Removed keys count.
     """
+    from django_wireguard.configs import new_config_version
     from django_wireguard.models import WireguardPeer
 
     peers = WireguardPeer.objects.filter(private_key__isnull=False)
     if peers.exists():
-        peers.update(private_key=None)
+        peers.update(private_key=None, config_version=new_config_version())
 
     return peers.count()
 
@@ -0,0 +1,54 @@
+from django.contrib.auth.models import AnonymousUser
+from rest_framework import authentication, exceptions, permissions, status
+from rest_framework.response import Response
+from rest_framework.views import APIView
+
+from django_wireguard.models import WireguardNode
+from django_wireguard.nodes import NodeException, get_desired_state, record_node_report
+
+
+class NodeTokenAuthentication(authentication.BaseAuthentication):
+    """
+    Authenticate node agents with the ``Authorization: Token <token>`` header.
+    """
+    keyword = 'Token'
+
+    def authenticate(self, request):
+        header = authentication.get_authorization_header(request).split()
+        if not header or header[0].lower() != self.keyword.lower().encode():
+            return None
+        if len(header) != 2:
+            raise exceptions.AuthenticationFailed("Invalid token header.")
+        try:
+            node = WireguardNode.objects.get(token=header[1].decode())
+        except (WireguardNode.DoesNotExist, UnicodeError):
+            raise exceptions.AuthenticationFailed("Invalid token.")
+        return AnonymousUser(), node
+
+    def authenticate_header(self, request):
+        return self.keyword
+
+
+class IsNode(permissions.BasePermission):
+    def has_permission(self, request, view):
+        return isinstance(request.auth, WireguardNode)
+
+
+class NodeStateApiView(APIView):
+    authentication_classes = [NodeTokenAuthentication]
+    permission_classes = [IsNode]
+
+    def get(self, request, *args, **kwargs):
+        return Response(get_desired_state(request.auth), status=status.HTTP_200_OK)
+
+
+class NodeReportApiView(APIView):
+    authentication_classes = [NodeTokenAuthentication]
+    permission_classes = [IsNode]
+
+    def post(self, request, *args, **kwargs):
+        try:
+            peers = record_node_report(request.auth, request.data)
+        except NodeException as e:
+            return Response({'detail': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response({'peers': peers}, status=status.HTTP_200_OK)
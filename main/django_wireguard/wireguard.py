@@ -1,13 +1,22 @@
 import base64
+import errno
+import os
+import threading
 from ipaddress import IPv4Interface
 from enum import Enum
-from typing import Optional, List, Union
-from os import system
+from socket import AF_INET, AF_INET6, inet_pton
+from typing import Optional, List, Union, Iterable, Iterator
 from datetime import datetime
+from time import monotonic
 
+from django.utils.module_loading import import_string
 from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey, X25519PublicKey
 from pyroute2 import WireGuard as PyRouteWireGuard, IPRoute
+from pyroute2.netlink import NLM_F_REQUEST, NLM_F_ACK
+from pyroute2.netlink.exceptions import NetlinkError
+from pyroute2.netlink.generic.wireguard import wgmsg, WG_CMD_SET_DEVICE, WG_GENL_VERSION, \
+    WGPEER_F_REMOVE_ME, WGPEER_F_REPLACE_ALLOWEDIPS, WGPEER_F_UPDATE_ONLY
 
 from django_wireguard import settings
 
@@ -94,17 +103,483 @@ class WireGuardException(Exception):
     """
 
 
+class PeerChunkError:
+    """
+    Failure of a single batched set-device message.
+
+    :param public_keys: public keys of the peers carried by the failed message
+    :param error: the exception raised while sending the message
+    """
+    __slots__ = ('public_keys', 'error')
+
+    def __init__(self, public_keys: List[str], error: Exception):
+        self.public_keys = public_keys
+        self.error = error
+
+    def __repr__(self):
+        return f"<PeerChunkError peers={len(self.public_keys)} error={self.error!r}>"
+
+
+class WireGuardBatchError(WireGuardException):
+    """
+    Raised when one or more chunks of a batched peer update failed.
+
+    The peers of the other chunks have been applied.
+    The failed chunks are available as :attr:`errors`.
+    """
+
+    def __init__(self, errors: List[PeerChunkError]):
+        self.errors = errors
+        failed = sum(len(error.public_keys) for error in errors)
+        super().__init__(f"{len(errors)} netlink message(s) failed ({failed} peers): {errors[0].error}")
+
+
+class PeerState:
+    """
+    Kernel state of a single peer, as yielded by :meth:`WireGuard.iter_peers`.
+
+    :param public_key: base64 encoded public key
+    :param endpoint: ``host:port`` of the last known endpoint or None
+    :param allowed_ips: peer's AllowedIPs as CIDR strings
+    :param latest_handshake: latest handshake as UNIX epoch seconds, 0 if none happened
+    :param rx_bytes: received bytes counter
+    :param tx_bytes: transmitted bytes counter
+    :param persistent_keepalive: keepalive interval in seconds, 0 if disabled
+    :param preshared_key: base64 encoded preshared key, if exposed by the kernel
+    """
+    __slots__ = ('public_key', 'endpoint', 'allowed_ips', 'latest_handshake',
+                 'rx_bytes', 'tx_bytes', 'persistent_keepalive', 'preshared_key')
+
+    def __init__(self, public_key: str, endpoint: Optional[str], allowed_ips: List[str],
+                 latest_handshake: int, rx_bytes: int, tx_bytes: int, persistent_keepalive: int,
+                 preshared_key: Optional[str] = None):
+        self.public_key = public_key
+        self.endpoint = endpoint
+        self.allowed_ips = allowed_ips
+        self.latest_handshake = latest_handshake
+        self.rx_bytes = rx_bytes
+        self.tx_bytes = tx_bytes
+        self.persistent_keepalive = persistent_keepalive
+        self.preshared_key = preshared_key
+
+    def __repr__(self):
+        return f"<PeerState {self.public_key} handshake={self.latest_handshake}>"
+
+    @property
+    def latest_handshake_datetime(self) -> Optional[datetime]:
+        """
+        Latest handshake as local naive datetime.
+
+        :return: latest handshake or None if no handshake happened
+        :rtype: datetime, optional
+        """
+        if not self.latest_handshake:
+            return None
+        return datetime.fromtimestamp(self.latest_handshake)
+
+
+class PeerSnapshot:
+    """
+    A single dump of an interface's peers, indexed by public key.
+
+    Snapshots are shared through :meth:`WireGuard.get_snapshot` so that listing
+    N peers costs one kernel dump instead of N.
+
+    :param interface_name: WireGuard interface name
+    :param peers: peer states of the interface
+    """
+    __slots__ = ('interface_name', 'taken_at', '__taken_at_monotonic', '__peers')
+
+    def __init__(self, interface_name: str, peers: Iterable[PeerState]):
+        self.interface_name = interface_name
+        self.taken_at = datetime.now()
+        self.__taken_at_monotonic = monotonic()
+        self.__peers = {peer.public_key: peer for peer in peers}
+
+    def __len__(self):
+        return len(self.__peers)
+
+    def __iter__(self) -> Iterator[PeerState]:
+        return iter(self.__peers.values())
+
+    def __contains__(self, public_key):
+        return str(public_key) in self.__peers
+
+    @property
+    def age(self) -> float:
+        """
+        Seconds elapsed since the dump was taken.
+
+        :rtype: float
+        """
+        return monotonic() - self.__taken_at_monotonic
+
+    def get(self, public_key) -> Optional[PeerState]:
+        """
+        Peer state as recorded in this snapshot.
+
+        :param public_key: peer's public key
+        :return: peer state or None if the peer is unknown
+        :rtype: PeerState, optional
+        """
+        return self.__peers.get(str(public_key))
+
+    def latest_handshake(self, public_key) -> Optional[datetime]:
+        """
+        Latest handshake of a peer as recorded in this snapshot.
+
+        :param public_key: peer's public key
+        :return: latest handshake or None if the peer is unknown or never connected
+        :rtype: datetime, optional
+        """
+        peer = self.__peers.get(str(public_key))
+        if peer is None:
+            return None
+        return peer.latest_handshake_datetime
+
+
+class DeviceState:
+    """
+    Kernel state of a WireGuard interface and its peers, as returned by :meth:`WireGuard.dump`.
+
+    :param interface_name: WireGuard interface name
+    :param private_key: base64 encoded private key
+    :param listen_port: UDP listen port
+    :param fwmark: firewall mark
+    :param peers: peer states by public key
+    """
+    __slots__ = ('interface_name', 'private_key', 'listen_port', 'fwmark', 'peers')
+
+    def __init__(self, interface_name: str, private_key: Optional[str], listen_port: int, fwmark: int,
+                 peers: dict):
+        self.interface_name = interface_name
+        self.private_key = private_key
+        self.listen_port = listen_port
+        self.fwmark = fwmark
+        self.peers = peers
+
+
+def _decode_key(value) -> Optional[str]:
+    if isinstance(value, bytes):
+        value = value.decode('ascii')
+    return value
+
+
+def _decode_peer_state(peer) -> PeerState:
+    """
+    Decode a WGDEVICE_A_PEERS entry by attribute name.
+
+    :param peer: ``wgdevice_peer`` netlink attribute
+    :rtype: PeerState
+    """
+    public_key = _decode_key(peer.get_attr('WGPEER_A_PUBLIC_KEY'))
+
+    endpoint = peer.get_attr('WGPEER_A_ENDPOINT')
+    if endpoint is not None:
+        address = endpoint['addr']
+        if ':' in address:
+            address = f'[{address}]'
+        endpoint = f"{address}:{endpoint['port']}"
+
+    handshake = peer.get_attr('WGPEER_A_LAST_HANDSHAKE_TIME')
+    allowed_ips = peer.get_attr('WGPEER_A_ALLOWEDIPS') or ()
+
+    return PeerState(public_key=public_key,
+                     endpoint=endpoint,
+                     allowed_ips=[allowed_ip['addr'] for allowed_ip in allowed_ips if 'addr' in allowed_ip],
+                     latest_handshake=handshake['tv_sec'] if handshake is not None else 0,
+                     rx_bytes=peer.get_attr('WGPEER_A_RX_BYTES') or 0,
+                     tx_bytes=peer.get_attr('WGPEER_A_TX_BYTES') or 0,
+                     persistent_keepalive=peer.get_attr('WGPEER_A_PERSISTENT_KEEPALIVE_INTERVAL') or 0,
+                     preshared_key=_decode_key(peer.get_attr('WGPEER_A_PRESHARED_KEY')))
+
+
+# Sizes (in bytes) of the netlink attributes of a WireGuard peer,
+# used to estimate how many peers fit in a single set-device message.
+_NLA_HEADER_SIZE = 4
+_NLA_KEY_SIZE = _NLA_HEADER_SIZE + 32
+_NLA_U32_SIZE = _NLA_HEADER_SIZE + 4
+_NLA_ENDPOINT_SIZE = {AF_INET: _NLA_HEADER_SIZE + 16, AF_INET6: _NLA_HEADER_SIZE + 28}
+_NLA_ALLOWED_IP_SIZE = {AF_INET: 4 * _NLA_HEADER_SIZE + 4 + 4 + 4,
+                        AF_INET6: 4 * _NLA_HEADER_SIZE + 4 + 16 + 4}
+# nlmsghdr + genlmsghdr + WGDEVICE_A_PEERS header, the interface name is added on top
+_SET_DEVICE_OVERHEAD = 16 + 4 + _NLA_HEADER_SIZE
+
+
+def _ip_family(address: str) -> int:
+    return AF_INET6 if ':' in address else AF_INET
+
+
+def _build_peer_nla(peer: dict) -> (dict, int):
+    """
+    Encode a peer struct as a WGDEVICE_A_PEERS entry.
+
+    Accepts the same peer struct as :meth:`pyroute2.WireGuard.set`.
+
+    :param peer: peer struct https://docs.pyroute2.org/wireguard.html
+    :return: the peer netlink attributes and their estimated encoded size
+    :rtype: (dict, int)
+    """
+    if 'public_key' not in peer:
+        raise ValueError('Peer Public key required')
+
+    attrs = [['WGPEER_A_PUBLIC_KEY', str(peer['public_key'])]]
+    size = 2 * _NLA_HEADER_SIZE + _NLA_KEY_SIZE
+
+    if peer.get('remove'):
+        attrs.append(['WGPEER_A_FLAGS', WGPEER_F_REMOVE_ME])
+        return {'attrs': attrs}, size + _NLA_U32_SIZE
+
+    if 'endpoint_addr' in peer and 'endpoint_port' in peer:
+        attrs.append(['WGPEER_A_ENDPOINT', {'addr': peer['endpoint_addr'],
+                                            'port': peer['endpoint_port']}])
+        size += _NLA_ENDPOINT_SIZE[_ip_family(peer['endpoint_addr'])]
+
+    if peer.get('preshared_key'):
+        attrs.append(['WGPEER_A_PRESHARED_KEY', str(peer['preshared_key'])])
+        size += _NLA_KEY_SIZE
+
+    if 'persistent_keepalive' in peer:
+        attrs.append(['WGPEER_A_PERSISTENT_KEEPALIVE_INTERVAL', peer['persistent_keepalive']])
+        size += _NLA_U32_SIZE
+
+    flags = 0
+    if peer.get('update_only'):
+        flags |= WGPEER_F_UPDATE_ONLY
+    if peer.get('replace_allowed_ips'):
+        flags |= WGPEER_F_REPLACE_ALLOWEDIPS
+    attrs.append(['WGPEER_A_FLAGS', flags])
+    size += _NLA_U32_SIZE
+
+    if 'allowed_ips' in peer:
+        allowed_ips = []
+        for allowed_ip in peer['allowed_ips']:
+            if '/' not in allowed_ip:
+                raise ValueError(f"No CIDR set in allowed ip {allowed_ip}")
+            address, mask = allowed_ip.split('/')
+            family = _ip_family(address)
+            allowed_ips.append({'attrs': [['WGALLOWEDIP_A_FAMILY', family],
+                                          ['WGALLOWEDIP_A_IPADDR', inet_pton(family, address)],
+                                          ['WGALLOWEDIP_A_CIDR_MASK', int(mask)]]})
+            size += _NLA_ALLOWED_IP_SIZE[family]
+        attrs.append(['WGPEER_A_ALLOWEDIPS', allowed_ips])
+        size += _NLA_HEADER_SIZE
+
+    return {'attrs': attrs}, size
+
+
+class NetlinkConnectionManager:
+    """
+    Per-process, per-thread pyroute2 sockets.
+
+    Sockets are opened lazily by each thread of each process: forked workers never
+    reuse a socket inherited from their parent and threads never share one.
+    Calls failing with ENOBUFS or a socket error are retried once on a new socket.
+
+    :param factories: socket constructors by name
+    """
+    RECONNECT_ERRNOS = frozenset((errno.ENOBUFS, errno.EBADF, errno.ECONNRESET, errno.EPIPE, errno.ENOTSOCK))
+
+    def __init__(self, factories: dict):
+        self.__factories = factories
+        self.__local = threading.local()
+
+    def __sockets(self) -> dict:
+        local = self.__local
+        if getattr(local, 'pid', None) != os.getpid():
+            # first use in this thread, or thread state inherited through fork
+            local.pid = os.getpid()
+            local.sockets = {}
+        return local.sockets
+
+    def get(self, name: str):
+        """
+        Return the socket of the current thread, opening it if needed.
+
+        :param name: socket name
+        """
+        sockets = self.__sockets()
+        sock = sockets.get(name)
+        if sock is None:
+            sock = sockets[name] = self.__factories[name]()
+        return sock
+
+    def reset(self, name: Optional[str] = None):
+        """
+        Close the sockets of the current thread, they are reopened on next use.
+
+        :param name: socket name, all sockets if omitted
+        """
+        sockets = self.__sockets()
+        for sock_name in ([name] if name else list(sockets)):
+            sock = sockets.pop(sock_name, None)
+            if sock is not None:
+                try:
+                    sock.close()
+                except Exception:
+                    pass
+
+    @classmethod
+    def is_reconnect_error(cls, error: Exception) -> bool:
+        if isinstance(error, NetlinkError):
+            return error.code in cls.RECONNECT_ERRNOS
+        return isinstance(error, OSError) and error.errno in cls.RECONNECT_ERRNOS
+
+    def call(self, name: str, method: str, *args, **kwargs):
+        """
+        Call a socket method, reconnecting once on socket errors.
+
+        :param name: socket name
+        :param method: socket method name
+        """
+        try:
+            return getattr(self.get(name), method)(*args, **kwargs)
+        except (NetlinkError, OSError) as e:
+            if not self.is_reconnect_error(e):
+                raise
+            self.reset(name)
+        return getattr(self.get(name), method)(*args, **kwargs)
+
+
+connections = NetlinkConnectionManager({'wg': PyRouteWireGuard, 'ipr': IPRoute})
+"""Netlink sockets used by :class:`WireGuard`."""
+
+
+class NetlinkBackend:
+    """
+    Configure WireGuard devices through the kernel module generic netlink family.
+    """
+    name = 'netlink'
+
+    def create(self, interface_name: str):
+        """
+        Create the WireGuard device.
+
+        :param interface_name: WireGuard interface name
+        """
+        connections.call('ipr', 'link', 'add', ifname=interface_name, kind='wireguard')
+
+    def set_device(self, interface_name: str, **kwargs):
+        """
+        Set device parameters.
+
+        :param interface_name: WireGuard interface name
+        :param kwargs: :mod:`pyroute2.WireGuard.set` kwargs https://docs.pyroute2.org/wireguard.html
+        """
+        connections.call('wg', 'set', interface_name, **kwargs)
+
+    @staticmethod
+    def __chunk_peers(interface_name: str, peers: Iterable[dict]) -> Iterator[List[dict]]:
+        """
+        Split peer structs into lists of peer attributes fitting in one netlink message.
+
+        :param interface_name: WireGuard interface name
+        :param peers: peer structs https://docs.pyroute2.org/wireguard.html
+        :return: iterator of encoded peer lists
+        """
+        max_size = settings.WIREGUARD_NETLINK_MESSAGE_SIZE
+        overhead = _SET_DEVICE_OVERHEAD + _NLA_HEADER_SIZE + (len(interface_name) + 4) // 4 * 4
+        chunk, size = [], overhead
+        for peer in peers:
+            peer_nla, peer_size = _build_peer_nla(peer)
+            if chunk and size + peer_size > max_size:
+                yield chunk
+                chunk, size = [], overhead
+            chunk.append(peer_nla)
+            size += peer_size
+        if chunk:
+            yield chunk
+
+    def apply_peers(self, interface_name: str, peers: Iterable[dict]) -> List[PeerChunkError]:
+        """
+        Set or remove peers, packed into WG_CMD_SET_DEVICE messages of at most
+        ``WIREGUARD_NETLINK_MESSAGE_SIZE`` bytes.
+
+        :param interface_name: WireGuard interface name
+        :param peers: peer structs https://docs.pyroute2.org/wireguard.html
+        :return: the failed chunks
+        :rtype: list
+        """
+        errors = []
+        for chunk in self.__chunk_peers(interface_name, peers):
+            msg = wgmsg()
+            msg['cmd'] = WG_CMD_SET_DEVICE
+            msg['version'] = WG_GENL_VERSION
+            msg['attrs'].append(['WGDEVICE_A_IFNAME', interface_name])
+            msg['attrs'].append(['WGDEVICE_A_PEERS', chunk])
+            try:
+                connections.call('wg', 'nlm_request', msg, msg_type=connections.get('wg').prid,
+                                 msg_flags=NLM_F_REQUEST | NLM_F_ACK)
+            except (NetlinkError, OSError) as e:
+                public_keys = [peer['attrs'][0][1] for peer in chunk]
+                errors.append(PeerChunkError(public_keys, e))
+        return errors
+
+    def iter_peers(self, interface_name: str) -> Iterator[PeerState]:
+        """
+        Dump the device and yield the state of each peer.
+
+        :param interface_name: WireGuard interface name
+        :return: iterator of peer states
+        """
+        for msg in connections.call('wg', 'info', interface_name):
+            for peer in msg.get_attr('WGDEVICE_A_PEERS') or ():
+                yield _decode_peer_state(peer)
+
+    def dump(self, interface_name: str) -> DeviceState:
+        """
+        Dump the device settings and all of its peers.
+
+        :param interface_name: WireGuard interface name
+        :rtype: DeviceState
+        """
+        private_key, listen_port, fwmark, peers = None, 0, 0, {}
+        for msg in connections.call('wg', 'info', interface_name):
+            if private_key is None:
+                private_key = _decode_key(msg.get_attr('WGDEVICE_A_PRIVATE_KEY'))
+                listen_port = msg.get_attr('WGDEVICE_A_LISTEN_PORT') or 0
+                fwmark = msg.get_attr('WGDEVICE_A_FWMARK') or 0
+            for peer in msg.get_attr('WGDEVICE_A_PEERS') or ():
+                state = _decode_peer_state(peer)
+                peers[state.public_key] = state
+        return DeviceState(interface_name, private_key, listen_port, fwmark, peers)
+
+
+BACKENDS = {
+    'netlink': 'django_wireguard.wireguard.NetlinkBackend',
+    'uapi': 'django_wireguard.uapi.UAPIBackend',
+}
+"""Device backends selectable with ``WIREGUARD_BACKEND``, which also accepts a dotted path."""
+
+_backends = {}
+
+
+def get_backend():
+    """
+    Return the device backend selected by ``WIREGUARD_BACKEND``.
+
+    :return: NetlinkBackend, UAPIBackend or a custom backend instance
+    """
+    name = settings.WIREGUARD_BACKEND
+    backend = _backends.get(name)
+    if backend is None:
+        backend = _backends[name] = import_string(BACKENDS.get(name, name))()
+    return backend
+
+
 class WireGuard:
     """
     WireGuard Interface abstraction class.
 
     This class wraps :mod:`pyroute2` methods to manage a WireGuard interface via NetLink.
+    The WireGuard device itself is configured through the backend selected by
+    ``WIREGUARD_BACKEND``: the kernel module or a userspace implementation.
 
     :param interface_name: WireGuard Interface Name
     """
     __slots__ = ('__ifname', '__ifindex')
-    __wg = None
-    __ipr = None
+    __interfaces = {}
+    __snapshots = {}
 
     class ErrorCode(Enum):
         """
@@ -115,25 +590,48 @@ class WireGuard:
         NO_SUCH_DEVICE = 19
 
     def __init__(self, interface_name):
-        self.__connect_backend()
         self.__ifname = interface_name
         interface = self.__get_interface_index(interface_name)
         if not interface:
             raise WireGuardException("Interface does not exist.")
         self.__ifindex = interface
 
+    def __call(self, name: str, method: str, *args, **kwargs):
+        """
+        Call a netlink socket method, dropping the cached handle if the device is gone.
+        """
+        try:
+            return connections.call(name, method, *args, **kwargs)
+        except NetlinkError as e:
+            if e.code == self.ErrorCode.NO_SUCH_DEVICE.value:
+                self.invalidate_interface(self.__ifname)
+            raise
+
+    def __device(self, method: str, *args, **kwargs):
+        """
+        Call a device backend method, dropping the cached handle if the device is gone.
+        """
+        try:
+            return getattr(get_backend(), method)(self.__ifname, *args, **kwargs)
+        except NetlinkError as e:
+            if e.code == self.ErrorCode.NO_SUCH_DEVICE.value:
+                self.invalidate_interface(self.__ifname)
+            raise
+        except (FileNotFoundError, ConnectionRefusedError):
+            self.invalidate_interface(self.__ifname)
+            raise
+
     @classmethod
-    def __connect_backend(cls):
+    def invalidate_interface(cls, interface_name: Optional[str] = None):
         """
-        Initialize static pyroute backend objects.
+        Drop cached interface handles.
 
-        These attributes are made static such that they won't clog up the file descriptors
-        whenever too many are instantiated and not garbage collected.
+        :param interface_name: WireGuard interface name, all handles if omitted
         """
-        if cls.__wg is None:
-            cls.__wg = PyRouteWireGuard()
-        if cls.__ipr is None:
-            cls.__ipr = IPRoute()
+        if interface_name is None:
+            cls.__interfaces.clear()
+        else:
+            cls.__interfaces.pop(interface_name, None)
 
     @classmethod
     def create_interface(cls, interface_name: str) -> 'WireGuard':
@@ -145,10 +643,10 @@ class WireGuard:
         :return: WireGuard object handling the newly created interface
         :rtype: WireGuard
         """
-        cls.__connect_backend()
-        cls.__ipr.link('add', ifname=interface_name, kind='wireguard')
-        cls.__ipr.link('set', index=cls.__get_interface_index(interface_name), state='up')
-        return cls(interface_name)
+        get_backend().create(interface_name)
+        connections.call('ipr', 'link', 'set', index=cls.__get_interface_index(interface_name), state='up')
+        interface = cls.__interfaces[interface_name] = cls(interface_name)
+        return interface
 
     @classmethod
     def get_or_create_interface(cls, interface_name: str) -> ('WireGuard', bool):
@@ -157,17 +655,17 @@ class WireGuard:
 
         Create and enable (set state up) a new WireGuard interface.
         If this already exists, get it.
+        Handles are cached by name, an existing interface costs no netlink lookup.
 
         :param interface_name: WireGuard interface name
         :type interface_name: str
         :return: WireGuard object handling the interface, whether the interface has been created
         :rtype: (WireGuard, bool)
         """
-        cls.__connect_backend()
-        interface = cls.__get_interface_index(interface_name)
-        if not interface:
+        interface = cls.get_interface(interface_name)
+        if interface is None:
             return cls.create_interface(interface_name), True
-        return cls(interface_name), False
+        return interface, False
 
     @classmethod
     def get_interface(cls, interface_name: str) -> Optional['WireGuard']:
@@ -178,11 +676,15 @@ class WireGuard:
         :return: WireGuard object handling the interface or None
         :rtype: WireGuard, optional
         """
-        cls.__connect_backend()
+        interface = cls.__interfaces.get(interface_name)
+        if interface is not None:
+            return interface
         try:
-            return cls(interface_name)
+            interface = cls(interface_name)
         except WireGuardException:
             return None
+        cls.__interfaces[interface_name] = interface
+        return interface
 
     @classmethod
     def __get_interface_index(cls, interface_name: str) -> Optional[int]:
@@ -193,8 +695,7 @@ class WireGuard:
         :return: IPRoute device index
         :rtype: int, optional
         """
-        cls.__connect_backend()
-        interface: list = cls.__ipr.link_lookup(ifname=interface_name)
+        interface: list = connections.call('ipr', 'link_lookup', ifname=interface_name)
         if not interface:
             return None
         return interface[0]
@@ -216,7 +717,7 @@ class WireGuard:
         :return: list of IPv4 interfaces (IP with CIDR) as str
         :rtype: list
         """
-        interface_data = self.__ipr.get_addr(label=self.interface_name)
+        interface_data = self.__call('ipr', 'get_addr', label=self.interface_name)
         return list(map(
             lambda i: dict(i['attrs'])['IFA_ADDRESS'] + '/' + str(i['prefixlen']),
             interface_data
@@ -224,35 +725,33 @@ class WireGuard:
 
     def set_ip_addresses(self, ip_addresses: List[str]):
         """
-        Set the interface's addresses.
+        Add the missing addresses to the interface.
+
+        Firewall rules are handled by :mod:`django_wireguard.firewall`.
 
         :param ip_addresses: new addresses
         """
         old_ip_addresses = self.get_ip_addresses()
-        new_ip_addresses = []
         for address in ip_addresses:
             try:
                 address = IPv4Interface(address)
             except Exception as e:
                 raise ValueError(e)
 
-            new_ip_addresses.append(str(address))
-
-        for n, address in enumerate(new_ip_addresses):
-            ip, mask = address.split('/')
-            if address not in old_ip_addresses:
-                command = ''
-                self.__ipr.addr('add', self.__ifindex,
-                                address=ip, mask=int(mask))
-                command += f"iptables -t nat -A POSTROUTING -s {address} -o {settings.WIREGUARD_OUTPUT_INTERFACE} -j MASQUERADE;"
-                for other_address in new_ip_addresses[n+1:]:
-                    command += f'iptables -I FORWARD -s {address} -d {other_address} -j REJECT;' \
-                               f'iptables -I FORWARD -s {other_address} -d {address} -j REJECT;'
-                for other_address in old_ip_addresses:
-                    command += f'iptables -I FORWARD -s {address} -d {other_address} -j REJECT;' \
-                               f'iptables -I FORWARD -s {other_address} -d {address} -j REJECT;'
-                command += f'iptables -I FORWARD -s {address} -d 10.8.88.253/32 -j REJECT'
-                system(command)
+            if str(address) not in old_ip_addresses:
+                self.__call('ipr', 'addr', 'add', self.__ifindex,
+                            address=str(address.ip), mask=address.network.prefixlen)
+
+    def del_ip_addresses(self, ip_addresses: List[str]):
+        """
+        Remove addresses from the interface.
+
+        :param ip_addresses: addresses (IP with CIDR) to remove
+        """
+        for address in ip_addresses:
+            address = IPv4Interface(address)
+            self.__call('ipr', 'addr', 'del', self.__ifindex,
+                        address=str(address.ip), mask=address.network.prefixlen)
 
     def set_interface(self, **kwargs):
         """
@@ -260,7 +759,26 @@ class WireGuard:
 
         :param kwargs: :mod:`pyroute2.WireGuard.set` kwargs https://docs.pyroute2.org/wireguard.html
         """
-        self.__wg.set(self.__ifname, **kwargs)
+        self.__device('set_device', **kwargs)
+        if 'peer' in kwargs:
+            self.invalidate_snapshot()
+
+    def apply_peers(self, peers: Iterable[dict]) -> List[PeerChunkError]:
+        """
+        Set or remove many peers with as few backend round-trips as possible.
+
+        The netlink backend packs peers into WG_CMD_SET_DEVICE messages of at most
+        ``WIREGUARD_NETLINK_MESSAGE_SIZE`` bytes, a failing message does not stop
+        the following ones from being sent. The UAPI backend writes them in a
+        single transaction.
+
+        :param peers: peer structs https://docs.pyroute2.org/wireguard.html
+        :return: the failed chunks, empty if every peer has been applied
+        :rtype: list
+        """
+        errors = self.__device('apply_peers', peers)
+        self.invalidate_snapshot()
+        return errors
 
     def set_peer(self, public_key, preshared_key, allowed_ip, **kwargs):
         """
@@ -271,7 +789,7 @@ class WireGuard:
         :param allowed_ip peer's AllowedIP
         :param kwargs: peer struct kwargs https://docs.pyroute2.org/wireguard.html
         """
-        self.set_interface(peer={
+        self.set_peers({
             'public_key': str(public_key),
             'preshared_key': str(preshared_key),
             'allowed_ips': [allowed_ip],
@@ -283,35 +801,81 @@ class WireGuard:
         Set multiple peers
 
         :param peers: peer structs https://docs.pyroute2.org/wireguard.html
+        :raises: WireGuardBatchError if any chunk failed
         """
-        for peer in peers:
-            self.set_interface(peer=peer)
+        errors = self.apply_peers(peers)
+        if errors:
+            raise WireGuardBatchError(errors)
 
     def remove_peers(self, *public_keys):
         """
         Remove peers by public key
 
         :param public_keys: peers' public keys
+        :raises: WireGuardBatchError if any chunk failed
         """
-        for pubkey in public_keys:
-            peer = {'public_key': str(pubkey), 'remove': True}
-            self.set_interface(peer=peer)
+        self.set_peers(*({'public_key': str(pubkey), 'remove': True} for pubkey in public_keys))
     
+    def iter_peers(self) -> Iterator[PeerState]:
+        """
+        Dump the interface and yield the state of each peer.
+
+        Large interfaces are returned by the kernel across several messages;
+        peers are decoded one by one while walking them.
+
+        :return: iterator of peer states
+        """
+        return self.__device('iter_peers')
+
+    def dump(self) -> DeviceState:
+        """
+        Dump the interface settings and all of its peers at once.
+
+        :return: interface state
+        :rtype: DeviceState
+        """
+        return self.__device('dump')
+
     def get_latest_handshake_of_peers(self) -> dict:
-        peers = {}
-        for peer in self.__wg.info(self.__ifname)[0]['attrs'][6][1]:
-            public_key = peer['attrs'][0][1].decode("utf-8") 
-            latest_handshake = datetime.strptime(peer['attrs'][2][1]['latest handshake'], '%a %b %d %H:%M:%S %Y')
-            peers[public_key] = latest_handshake
-        return peers
-    
-    def get_latest_handshake_of_peer(self, public_key) -> dict:
-        for peer in self.__wg.info(self.__ifname)[0]['attrs'][6][1]:
-            if public_key == peer['attrs'][0][1].decode("utf-8") :
-                latest_handshake = datetime.strptime(peer['attrs'][2][1]['latest handshake'], '%a %b %d %H:%M:%S %Y')
-                return latest_handshake
-        else:
-            return None
+        """
+        Latest handshake of every peer on the interface.
+
+        :return: latest handshake (None if never connected) by public key
+        :rtype: dict
+        """
+        return {peer.public_key: peer.latest_handshake_datetime for peer in self.iter_peers()}
+
+    def get_latest_handshake_of_peer(self, public_key) -> Optional[datetime]:
+        """
+        Latest handshake of a peer, read from the shared interface snapshot.
+
+        :param public_key: peer's public key
+        :return: latest handshake or None if the peer is not on the interface
+        :rtype: datetime, optional
+        """
+        return self.get_snapshot().latest_handshake(public_key)
+
+    def get_snapshot(self, max_age: Optional[float] = None) -> PeerSnapshot:
+        """
+        Return the shared peer snapshot of the interface, dumping it again if too old.
+
+        :param max_age: max snapshot age in seconds, defaults to ``WIREGUARD_SNAPSHOT_TTL``
+        :return: peer snapshot of the interface
+        :rtype: PeerSnapshot
+        """
+        if max_age is None:
+            max_age = settings.WIREGUARD_SNAPSHOT_TTL
+        snapshot = self.__snapshots.get(self.__ifname)
+        if snapshot is None or snapshot.age > max_age:
+            snapshot = PeerSnapshot(self.__ifname, self.iter_peers())
+            self.__snapshots[self.__ifname] = snapshot
+        return snapshot
+
+    def invalidate_snapshot(self):
+        """
+        Drop the shared peer snapshot of the interface.
+        """
+        self.__snapshots.pop(self.__ifname, None)
 
     def delete(self):
         """
@@ -319,5 +883,7 @@ class WireGuard:
 
         Set state down and remove device.
         """
-        self.__ipr.link('set', index=self.__ifindex, state='down')
-        self.__ipr.link('delete', index=self.__ifindex)
+        self.invalidate_snapshot()
+        self.invalidate_interface(self.__ifname)
+        self.__call('ipr', 'link', 'set', index=self.__ifindex, state='down')
+        self.__call('ipr', 'link', 'delete', index=self.__ifindex)